@@ -4,25 +4,17 @@ import sys
 parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.insert(0, parentdir)
 import time
+import concurrent.futures
 import pifacerelayplus
+import pifacerelayplus.scheduler
 
 
 if __name__ == '__main__':
     pf = pifacerelayplus.PiFaceRelayPlus(pifacerelayplus.MOTOR_DC)
+    scheduler = pifacerelayplus.scheduler.MotorScheduler()
     while True:
-        for i in range(4):
-            pf.motors[i].forward()
-            time.sleep(pifacerelayplus.MOTOR_CONTROL_WINDOW)
-        time.sleep(0.25)
-        for i in range(4):
-            pf.motors[i].coast()
-            time.sleep(pifacerelayplus.MOTOR_CONTROL_WINDOW)
-        time.sleep(0.25)
-        for i in range(4):
-            pf.motors[i].reverse()
-            time.sleep(pifacerelayplus.MOTOR_CONTROL_WINDOW)
-        time.sleep(0.25)
-        for i in range(4):
-            pf.motors[i].brake()
-            time.sleep(pifacerelayplus.MOTOR_CONTROL_WINDOW)
-        time.sleep(0.25)
\ No newline at end of file
+        for command in ('forward', 'coast', 'reverse', 'brake'):
+            futures = [scheduler.submit(pf.motors[i], command)
+                       for i in range(4)]
+            concurrent.futures.wait(futures)
+            time.sleep(0.25)
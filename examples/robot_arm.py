@@ -1,5 +1,5 @@
-import time
 from pifacerelayplus import (PiFaceRelayPlus, RELAY)
+from pifacerelayplus.sequence import Sequence
 
 
 DIRECTION_INDEX = 0
@@ -21,10 +21,18 @@ class RobotArm(object):
         self.pfrp.relays[DIRECTION_INDEX].value = direction
 
     def set_relay_for_period(self, index, delay, direction):
-        self.set_direction(direction)
-        self.pfrp.relays[index].turn_on()
-        time.sleep(delay)
-        self.pfrp.relays[index].turn_off()
+        self.move_joints({index: delay}, direction)
+
+    def move_joints(self, delays, direction=0):
+        """Moves several joints at once. delays is {joint index: seconds}.
+        The joints share the direction relay.
+        """
+        sequence = Sequence()
+        # change direction and joint relays together
+        sequence.add(0, self.pfrp.relays[DIRECTION_INDEX], direction)
+        for index, delay in delays.items():
+            sequence.pulse(self.pfrp.relays[index], 0, delay)
+        return sequence.play()
 
     def move_base(self, delay, direction=0):
         self.set_relay_for_period(BASE_INDEX, delay, direction)
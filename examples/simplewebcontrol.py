@@ -19,84 +19,20 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
-import json
 import argparse
+import asyncio
 import subprocess
-import http.server
-import urllib.parse
-from pifacerelayplus import PiFaceRelayPlus, RELAY
+from pifacerelayplus import PiFaceRelayPlusBus, RELAY
+from pifacerelayplus.webcontrol import (
+    DEFAULT_PORT,
+    RELAY_PORT_SET,
+    WebControlServer,
+)
 
 
-DEFAULT_PORT = 8000
-RELAY_PORT_SET = "b{board_index}_relay_port"
-RELAY_PORT_AND = "b{board_index}_relay_port__and"
-RELAY_PORT_OR = "b{board_index}_relay_port__or"
 GET_IP_CMD = "hostname -I"
 
 
-class PiFaceRelayPlusWebHandler(http.server.BaseHTTPRequestHandler):
-    """Handles PiFace Relay Plus web control requests"""
-
-    # List of PiFace Relay Plus boards
-    pfrps = []
-
-    def do_GET(self):
-        statuses = []
-        for i, board in enumerate(self.pfrps):
-            # get the board status
-            status = self.get_status(board)
-            self.update_relay_port(board, i, status)
-            statuses.append(status)
-
-        # reply with JSON
-        self.send_response(200)
-        self.send_header("Content-type", "application/json")
-        # for access from other sources
-        self.send_header("Access-Control-Allow-Origin", "*");
-        self.send_header("Access-Control-Expose-Headers",
-                         "Access-Control-Allow-Origin");
-        self.send_header("Access-Control-Allow-Headers",
-                         "Origin, X-Requested-With, Content-Type, Accept");
-        self.end_headers()
-        self.wfile.write(bytes(json.dumps(statuses), 'utf-8'))
-
-    def get_status(self, board):
-        return {"x_port": board.x_port.value,
-                "relay_port": board.relay_port.value}
-
-    def update_relay_port(self, board, index, status):
-        # parse the query string
-        qs = urllib.parse.urlparse(self.path).query
-        qcomponents = urllib.parse.parse_qs(qs)
-        # set the output
-        key_set = RELAY_PORT_SET.format(board_index=index)
-        key_and = RELAY_PORT_AND.format(board_index=index)
-        key_or = RELAY_PORT_OR.format(board_index=index)
-        # SET
-        if key_set in qcomponents:
-            value = self.parse_query_value(qcomponents[key_set][0])
-            board.relay_port.value = value
-            status['relay_port'] = value
-        # AND
-        elif key_and in qcomponents:
-            mask = self.parse_query_value(qcomponents[key_and][0])
-            value = board.relay_port.value & mask
-            board.relay_port.value = value
-            status['relay_port'] = value
-        # OR
-        elif key_or in qcomponents:
-            mask = self.parse_query_value(qcomponents[key_or][0])
-            value = board.relay_port.value | mask
-            board.relay_port.value = value
-            status['relay_port'] = value
-
-    def parse_query_value(self, query_value):
-        try:
-            return int(query_value)  # dec
-        except ValueError:
-            return int(query_value, 16)  # hex
-
-
 def get_my_ip():
     """Returns this computers IP address as a string."""
     output = subprocess.check_output(GET_IP_CMD, shell=True).decode('utf-8')
@@ -120,16 +56,10 @@ if __name__ == "__main__":
     args = parser.parse_args()
 
     # set up a list of PiFace Relay Plus boards (with 'relay' plus-board)
-    PiFaceRelayPlusWebHandler.pfrps =[]
-    for hardware_addr in range(args.num_boards):
-        try:
-            pfrp = PiFaceRelayPlus(plus_board=RELAY,
-                                   init_board=args.init_board,
-                                   hardware_addr=hardware_addr)
-        except:
-            pass
-        else:
-            PiFaceRelayPlusWebHandler.pfrps.append(pfrp)
+    boards = PiFaceRelayPlusBus(plus_boards=RELAY,
+                                hardware_addrs=range(args.num_boards),
+                                init_board=args.init_board)
+    server = WebControlServer(boards, port=int(args.port))
 
     print("""Starting simple PiFace web control ({n}x PiFace Relay Plus) at:
 
@@ -139,17 +69,13 @@ Change the relay_port with:
 
     http://{addr}:{port}?{relay_port_set_string}=0xAA
 
-""".format(n=len(PiFaceRelayPlusWebHandler.pfrps),
+""".format(n=len(server.boards),
            addr=get_my_ip(),
            port=args.port,
            relay_port_set_string=RELAY_PORT_SET.format(board_index=0)))
 
     # run the server
-    server_address = ('', int(args.port))
     try:
-        httpd = http.server.HTTPServer(server_address,
-                                       PiFaceRelayPlusWebHandler)
-        httpd.serve_forever()
+        asyncio.run(server.serve_forever())
     except KeyboardInterrupt:
         print('^C received, shutting down server')
-        httpd.socket.close()
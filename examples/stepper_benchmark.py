@@ -0,0 +1,22 @@
+#!/usr/bin/env python3
+"""Measures the highest step rate a stepper motor can be driven at."""
+import os
+import sys
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, parentdir)
+import pifacerelayplus
+
+
+STEPS = 2000
+
+
+if __name__ == '__main__':
+    pf = pifacerelayplus.PiFaceRelayPlus(pifacerelayplus.MOTOR_STEPPER,
+                                         shadow_registers=True)
+    stepper = pf.motors[0]
+    # no delay between steps: as fast as the SPI bus allows
+    rate = stepper.forward(STEPS, step_delay=0)
+    print("Max step rate: {:.0f} steps/s".format(rate))
+    rate = stepper.reverse(STEPS, step_delay=0.001, acceleration=5000)
+    print("Ramped move to 1000 steps/s: {:.0f} steps/s average".format(rate))
+    stepper.coast()
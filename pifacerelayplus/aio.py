@@ -0,0 +1,294 @@
+"""asyncio support for PiFace Relay Plus.
+
+Input events are read from the interrupt GPIO using the event loop's file
+descriptor readiness instead of a detector process and dispatcher thread,
+so any number of boards can share one loop without extra threads.
+"""
+import os
+import select
+import asyncio
+import pifacecommon.interrupts
+import pifacecommon.mcp23s17
+
+
+DEFAULT_QUEUE_SIZE = 64
+
+
+def _interrupt_device(chip):
+    """Returns the interrupt line of the SPI backend of chip (if it has one)
+    or the interrupt GPIO.
+    """
+    return getattr(chip.spi, 'interrupt_device',
+                   pifacecommon.interrupts.GPIO_INTERRUPT_DEVICE_VALUE)
+
+
+def _get_loop(loop=None):
+    if loop is not None:
+        return loop
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.get_event_loop()
+
+
+class InterruptLine(object):
+    """The interrupt GPIO (``/sys/class/gpio/gpio25/value``) watched by an
+    asyncio event loop. ``callback`` is called from the loop every time the
+    line fires.
+
+    Edges on the sysfs value file are signalled with ``POLLPRI`` which the
+    loop's selector does not watch, so the file is registered with an
+    edge-triggered epoll object and the epoll file descriptor is given to
+    the loop instead.
+    """
+
+    def __init__(self, callback, loop=None,
+                 device=pifacecommon.interrupts.GPIO_INTERRUPT_DEVICE_VALUE):
+        self.callback = callback
+        self.loop = loop
+        self.device = device
+        self.fd = None
+        self._epoll = None
+        self._seekable = False
+
+    def open(self):
+        """Starts watching the interrupt line."""
+        self.loop = _get_loop(self.loop)
+        self.fd = os.open(self.device, os.O_RDONLY | os.O_NONBLOCK)
+        try:
+            os.lseek(self.fd, 0, os.SEEK_SET)
+        except OSError:
+            self._seekable = False  # a pipe, used for simulated interrupts
+        else:
+            self._seekable = True
+        self._epoll = select.epoll()
+        self._epoll.register(
+            self.fd, select.EPOLLIN | select.EPOLLPRI | select.EPOLLET)
+        self.loop.add_reader(self._epoll.fileno(), self._ready)
+
+    def close(self):
+        """Stops watching the interrupt line."""
+        if self._epoll is None:
+            return
+        self.loop.remove_reader(self._epoll.fileno())
+        self._epoll.close()
+        os.close(self.fd)
+        self._epoll = None
+        self.fd = None
+
+    def asserted(self):
+        """Returns whether the (active low) interrupt line is asserted, or
+        ``None`` if its level cannot be read back.
+        """
+        if not self._seekable:
+            return None
+        return self._read_value()[:1] == b'0'
+
+    def _read_value(self):
+        if self._seekable:
+            os.lseek(self.fd, 0, os.SEEK_SET)
+        try:
+            return os.read(self.fd, 64)
+        except BlockingIOError:
+            return b''
+
+    def _ready(self):
+        self._epoll.poll(0)
+        # reading the value re-arms the sysfs edge notification
+        self._read_value()
+        self.callback()
+
+
+class AsyncInputEventListener(object):
+    """Listens for events on the input port from an asyncio event loop and
+    calls the mapped callback functions. Callbacks may be plain functions
+    or coroutine functions; coroutines are scheduled as tasks on the loop.
+
+    >>> def print_flag(event):
+    ...     print(event.interrupt_flag)
+    ...
+    >>> listener = pifacerelayplus.aio.AsyncInputEventListener(pfrp)
+    >>> listener.register(0, pifacerelayplus.IODIR_ON, print_flag)
+    >>> listener.activate()
+
+    The listener is also an asynchronous iterator over every
+    :class:`pifacerelayplus.InputEvent`:
+
+    >>> async for event in listener:
+    ...     print(event.x_port)
+
+    Give it a :class:`pifacerelayplus.debounce.Debouncer` to filter contact
+    bounce on the board instead of using settle times.
+    """
+
+    def __init__(self, chip, loop=None,
+                 settle_time=pifacecommon.interrupts.DEFAULT_SETTLE_TIME,
+                 queue_size=DEFAULT_QUEUE_SIZE,
+                 debouncer=None):
+        self.chip = chip
+        self.loop = loop
+        self.settle_time = settle_time
+        self.queue_size = queue_size
+        self.debouncer = debouncer
+        self.pin_function_maps = list()
+        self.interrupt_line = None
+        self._last_event_time = [0]*8
+        self._queue = None
+        self._tasks = set()
+
+    def register(self, pin_num, direction, callback,
+                 settle_time=pifacecommon.interrupts.DEFAULT_SETTLE_TIME):
+        """Registers a pin number and direction to a callback function.
+
+        :param pin_num: The pin number (on GPIOB).
+        :type pin_num: int
+        :param direction: The event direction
+            (use: IODIR_ON/IODIR_OFF/IODIR_BOTH)
+        :type direction: int
+        :param callback: The function (or coroutine function) to run when
+            the event is detected.
+        :type callback: function
+        :param settle_time: Time within which subsequent events are ignored.
+        :type settle_time: int
+        """
+        self.pin_function_maps.append(
+            pifacecommon.interrupts.PinFunctionMap(
+                pin_num, direction, callback, settle_time))
+
+    def activate(self):
+        """Starts watching the interrupt line on the event loop."""
+        self.loop = _get_loop(self.loop)
+        self.interrupt_line = InterruptLine(self.handle_interrupt, self.loop,
+                                            _interrupt_device(self.chip))
+        self.interrupt_line.open()
+        # release the line in case an interrupt is already pending
+        self.chip.clear_interrupts(pifacecommon.mcp23s17.GPIOB)
+        if self.debouncer is not None:
+            self.debouncer.start(self)
+
+    def deactivate(self):
+        """Stops watching the interrupt line."""
+        if self.interrupt_line is not None:
+            self.interrupt_line.close()
+            self.interrupt_line = None
+        if self.debouncer is not None:
+            self.debouncer.stop()
+
+    def handle_interrupt(self):
+        """Reads the interrupt registers from the board and dispatches the
+        event (if this board caused the interrupt).
+        """
+        event = self.chip.read_input_event()
+        if event is None:
+            return  # the interrupt has not been flagged on this board
+        self.handle_event(event)
+
+    def handle_event(self, event):
+        """Dispatches an event read from the board (through the debouncer,
+        if there is one).
+        """
+        if self.debouncer is not None:
+            self.debouncer.process(event)
+        else:
+            self.dispatch(event)
+
+    def dispatch(self, event):
+        """Sends an event to the matching callbacks and to anyone iterating
+        over the listener. Without a debouncer, events that occur within the
+        settle time of the previous event on the same pin are assumed to be
+        bouncing and are dropped.
+        """
+        callbacks = [fm.callback for fm in self.pin_function_maps
+                     if pifacecommon.interrupts._event_matches_pin_function_map(
+                         event, fm)]
+        settle_time = self.settle_time
+        for pin_function_map in self.pin_function_maps:
+            if pin_function_map.pin_num == event.pin_num:
+                settle_time = pin_function_map.settle_time
+                break
+
+        if self.debouncer is None:
+            threshold_time = (self._last_event_time[event.pin_num] +
+                              settle_time)
+            if event.timestamp <= threshold_time:
+                return
+            self._last_event_time[event.pin_num] = event.timestamp
+
+        for callback in callbacks:
+            if asyncio.iscoroutinefunction(callback):
+                task = self.loop.create_task(callback(event))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+            else:
+                callback(event)
+
+        if self._queue is not None:
+            if self._queue.full():
+                self._queue.get_nowait()  # drop the oldest event
+            self._queue.put_nowait(event)
+
+    def __aiter__(self):
+        if self._queue is None:
+            self._queue = asyncio.Queue(self.queue_size)
+        return self
+
+    async def __anext__(self):
+        return await self._queue.get()
+
+
+class AsyncBusEventListener(object):
+    """Listens for input events on every board of a
+    :class:`pifacerelayplus.PiFaceRelayPlusBus` using the one shared
+    interrupt line. Each board has its own
+    :class:`AsyncInputEventListener` for registering callbacks or iterating
+    over events; only the boards that caused an interrupt are read.
+
+    >>> boards = pifacerelayplus.PiFaceRelayPlusBus(pifacerelayplus.RELAY)
+    >>> listener = pifacerelayplus.aio.AsyncBusEventListener(boards)
+    >>> listener[1].register(4, pifacerelayplus.IODIR_ON, print)
+    >>> listener.activate()
+    """
+
+    def __init__(self, boards, loop=None):
+        self.boards = boards
+        self.loop = loop
+        self.interrupt_line = None
+        self.listeners = dict((board.hardware_addr,
+                               AsyncInputEventListener(board, loop))
+                              for board in boards)
+
+    def __getitem__(self, hardware_addr):
+        return self.listeners[hardware_addr]
+
+    def activate(self):
+        """Starts watching the interrupt line on the event loop."""
+        self.loop = _get_loop(self.loop)
+        for listener in self.listeners.values():
+            listener.loop = self.loop
+        device = pifacecommon.interrupts.GPIO_INTERRUPT_DEVICE_VALUE
+        for board in self.boards:
+            device = _interrupt_device(board)
+            break
+        self.interrupt_line = InterruptLine(self.handle_interrupt, self.loop,
+                                            device)
+        self.interrupt_line.open()
+        for board in self.boards:
+            board.clear_interrupts(pifacecommon.mcp23s17.GPIOB)
+        for listener in self.listeners.values():
+            if listener.debouncer is not None:
+                listener.debouncer.start(listener)
+
+    def deactivate(self):
+        """Stops watching the interrupt line."""
+        if self.interrupt_line is not None:
+            self.interrupt_line.close()
+            self.interrupt_line = None
+        for listener in self.listeners.values():
+            if listener.debouncer is not None:
+                listener.debouncer.stop()
+
+    def handle_interrupt(self):
+        """Reads the interrupting boards and dispatches their events."""
+        events = self.boards.read_interrupts(self.interrupt_line.asserted)
+        for event in events:
+            self.listeners[event.chip.hardware_addr].handle_event(event)
@@ -0,0 +1,301 @@
+"""Benchmarks for the common PiFace Relay Plus operations.
+
+Run against a board::
+
+    $ python3 -m pifacerelayplus.benchmark --plus-board relay
+
+or against the simulator (``--simulate``) with a per-transaction latency::
+
+    $ python3 -m pifacerelayplus.benchmark --simulate --latency 0.00005
+
+Every benchmark reports the wall time and the number of SPI transactions
+per operation. Use ``--json`` to save the results for comparing releases.
+
+``--startup`` instead measures setting up every board on the bus (with
+``--simulate``, eight simulated boards)::
+
+    $ python3 -m pifacerelayplus.benchmark --startup --simulate
+"""
+import argparse
+import asyncio
+import collections
+import json
+import sys
+import time
+import tracemalloc
+import pifacecommon.mcp23s17
+import pifacerelayplus
+import pifacerelayplus.aio
+import pifacerelayplus.simulator
+from .version import __version__
+
+
+DEFAULT_ITERATIONS = 1000
+PLUS_BOARDS = {'none': None,
+               'relay': pifacerelayplus.RELAY,
+               'motor_dc': pifacerelayplus.MOTOR_DC,
+               'button': pifacerelayplus.BUTTON}
+
+
+class BenchmarkResult(collections.namedtuple(
+        'BenchmarkResult',
+        ['name', 'operations', 'seconds', 'transactions'])):
+    """The outcome of one benchmark."""
+    __slots__ = ()
+
+    @property
+    def rate(self):
+        """Operations per second."""
+        return self.operations / self.seconds if self.seconds else 0
+
+    @property
+    def latency(self):
+        """Seconds per operation."""
+        return self.seconds / self.operations if self.operations else 0
+
+    @property
+    def transactions_per_operation(self):
+        return self.transactions / float(self.operations)
+
+
+class StartupResult(collections.namedtuple(
+        'StartupResult',
+        ['boards', 'seconds', 'memory', 'transactions'])):
+    """The cost of setting up a bus of boards. ``memory`` is the number of
+    bytes still allocated afterwards and ``transactions`` is ``None`` unless
+    the SPI backend counts them.
+    """
+    __slots__ = ()
+
+
+class TransactionCounter(object):
+    """Counts the SPI transactions of a board (through ``spi_callback``)."""
+
+    def __init__(self, board):
+        self.count = 0
+        board.spi_callback = self
+
+    def __call__(self, bytes_to_send):
+        self.count += 1
+
+
+def _measure(name, board, operations, function):
+    counter = TransactionCounter(board)
+    start = time.perf_counter()
+    function()
+    seconds = time.perf_counter() - start
+    board.spi_callback = None
+    return BenchmarkResult(name, operations, seconds, counter.count)
+
+
+def benchmark_relay_toggle(board, iterations):
+    relay = board.relays[0]
+
+    def run():
+        for i in range(iterations):
+            relay.toggle()
+    return _measure('relay toggle', board, iterations, run)
+
+
+def benchmark_port_write(board, iterations):
+    start = board.relay_port.value
+
+    def run():
+        # every value differs from the last, so no write is suppressed
+        for i in range(iterations):
+            board.relay_port.value = (start + 1 + i) & 0xf
+    return _measure('relay port write', board, iterations, run)
+
+
+def benchmark_input_read(board, iterations):
+    def run():
+        for i in range(iterations):
+            board.x_port.value
+    return _measure('input read', board, iterations, run)
+
+
+def benchmark_init_board(board, iterations):
+    iterations = max(iterations // 10, 1)
+
+    def run():
+        for i in range(iterations):
+            board.init_board(board.gpioa_conf, board.gpiob_conf)
+    return _measure('init_board', board, iterations, run)
+
+
+def benchmark_motor_command(board, iterations):
+    if not hasattr(board, 'motors') or board.plus_board != \
+            pifacerelayplus.MOTOR_DC:
+        return None
+    motor = board.motors[0]
+
+    # coast and brake don't use the inrush budget
+    def run():
+        for i in range(iterations // 2):
+            motor.coast()
+            motor.brake()
+    return _measure('motor command', board, iterations // 2 * 2, run)
+
+
+def benchmark_interrupt_latency(board, iterations):
+    """Triggers interrupts from software by comparing x-pin 0 against a
+    default value that doesn't match (INTCON/DEFVAL) and times how long the
+    callback takes to run.
+    """
+    pcmcp = pifacecommon.mcp23s17
+    iterations = max(iterations // 10, 1)
+    mask = 0x10
+    if not board.gpiob_conf['direction'] & mask:
+        return None  # x-pin 0 is an output on this plus board
+    latencies = []
+
+    async def run():
+        triggered = asyncio.Event()
+        listener = pifacerelayplus.aio.AsyncInputEventListener(board)
+        listener.register(4, pifacerelayplus.IODIR_BOTH,
+                          lambda event: triggered.set(), settle_time=0)
+        listener.activate()
+        try:
+            level = board.gpiob.value & mask
+            board.defvalb.value = level
+            board.intconb.value = mask
+            for i in range(iterations):
+                await asyncio.sleep(0)
+                triggered.clear()
+                start = time.perf_counter()
+                board.defvalb.value = level ^ mask
+                await asyncio.wait_for(triggered.wait(), 1)
+                latencies.append(time.perf_counter() - start)
+                board.defvalb.value = level
+                board.clear_interrupts(pcmcp.GPIOB)
+        finally:
+            listener.deactivate()
+            board.intconb.value = 0
+            board.defvalb.value = 0
+
+    counter = TransactionCounter(board)
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(run())
+    finally:
+        loop.close()
+        board.spi_callback = None
+    return BenchmarkResult('interrupt to callback', len(latencies),
+                           sum(latencies), counter.count)
+
+
+BENCHMARKS = (
+    benchmark_relay_toggle,
+    benchmark_port_write,
+    benchmark_input_read,
+    benchmark_init_board,
+    benchmark_motor_command,
+    benchmark_interrupt_latency,
+)
+
+
+def run_benchmarks(board, iterations=DEFAULT_ITERATIONS):
+    """Runs every benchmark that applies to the board and returns a list of
+    :class:`BenchmarkResult`.
+    """
+    results = []
+    for benchmark in BENCHMARKS:
+        result = benchmark(board, iterations)
+        if result is not None:
+            results.append(result)
+    return results
+
+
+def measure_startup(plus_board=pifacerelayplus.RELAY, spi=None):
+    """Measures setting up a :class:`pifacerelayplus.PiFaceRelayPlusBus` and
+    returns a :class:`StartupResult`.
+    """
+    transactions = getattr(spi, 'transactions', None)
+    tracemalloc.start()
+    try:
+        start = time.perf_counter()
+        boards = pifacerelayplus.PiFaceRelayPlusBus(plus_board, spi=spi)
+        seconds = time.perf_counter() - start
+        memory = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    if transactions is not None:
+        transactions = spi.transactions - transactions
+    return StartupResult(len(boards), seconds, memory, transactions)
+
+
+def format_startup(result):
+    return "{} boards in {:.2f} ms, {:.0f} KiB, {} SPI transactions".format(
+        result.boards, result.seconds * 1e3, result.memory / 1024.0,
+        result.transactions)
+
+
+def format_results(results):
+    lines = ["{:<24}{:>10}{:>14}{:>14}{:>10}".format(
+        "benchmark", "ops", "ops/s", "latency (us)", "SPI/op")]
+    for r in results:
+        lines.append("{:<24}{:>10}{:>14.0f}{:>14.1f}{:>10.2f}".format(
+            r.name, r.operations, r.rate, r.latency * 1e6,
+            r.transactions_per_operation))
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark PiFace Relay Plus operations.")
+    parser.add_argument('-p', '--plus-board', choices=sorted(PLUS_BOARDS),
+                        default='relay')
+    parser.add_argument('-a', '--hardware-addr', type=int, default=0)
+    parser.add_argument('-n', '--iterations', type=int,
+                        default=DEFAULT_ITERATIONS)
+    parser.add_argument('--shadow', action='store_true',
+                        help="Use shadow registers.")
+    parser.add_argument('--simulate', action='store_true',
+                        help="Use the simulated SPI bus instead of a board.")
+    parser.add_argument('--latency', type=float, default=0,
+                        help="Simulated time per SPI transaction (seconds).")
+    parser.add_argument('--startup', action='store_true',
+                        help="Measure setting up every board on the bus.")
+    parser.add_argument('--json', help="Also write the results to this file.")
+    args = parser.parse_args(argv)
+
+    if args.startup:
+        spi = None
+        if args.simulate:
+            spi = pifacerelayplus.simulator.SimulatedSPIBus(
+                hardware_addrs=range(pifacerelayplus.MAX_BOARDS),
+                latency=args.latency, realtime=True)
+        result = measure_startup(PLUS_BOARDS[args.plus_board], spi)
+        print(format_startup(result))
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump({'version': __version__,
+                           'simulated': args.simulate,
+                           'startup': result._asdict()},
+                          f, indent=2)
+        return
+
+    spi = None
+    if args.simulate:
+        spi = pifacerelayplus.simulator.SimulatedSPIBus(
+            hardware_addrs=(args.hardware_addr,), latency=args.latency,
+            realtime=True)
+    board = pifacerelayplus.PiFaceRelayPlus(
+        plus_board=PLUS_BOARDS[args.plus_board],
+        hardware_addr=args.hardware_addr,
+        shadow_registers=args.shadow,
+        spi=spi)
+
+    results = run_benchmarks(board, args.iterations)
+    print(format_results(results))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'version': __version__,
+                       'simulated': args.simulate,
+                       'shadow_registers': args.shadow,
+                       'results': [r._asdict() for r in results]},
+                      f, indent=2)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,6 +1,15 @@
+import collections
+import contextlib
+import math
+import multiprocessing
+import pifacecommon.core
 import pifacecommon.interrupts
 import pifacecommon.mcp23s17
+import pifacecommon.spi
+import select
+import threading
 import time
+from .layout import BoardLayout, ChannelGroup
 
 
 # /dev/spidev<bus>.<chipselect>
@@ -13,19 +22,109 @@ MOTOR_DC_COAST_BITS = (1, 1)  # Z, Z
 MOTOR_DC_REVERSE_BITS = (0, 1)  # L, H
 MOTOR_DC_FORWARD_BITS = (1, 0)  # H, L
 MOTOR_DC_BRAKE_BITS = (0, 0)  # L, L
+_MOTOR_DC_STATES = {MOTOR_DC_COAST_BITS: 'coast',
+                    MOTOR_DC_REVERSE_BITS: 'reverse',
+                    MOTOR_DC_FORWARD_BITS: 'forward',
+                    MOTOR_DC_BRAKE_BITS: 'brake'}
+_MOTOR_DC_BITS = dict((state, bits)
+                      for bits, state in _MOTOR_DC_STATES.items())
 
 # Plus boards
 # Motor board IC datasheet: http://www.ti.com/lit/ds/symlink/drv8835.pdf
-# RELAY, MOTOR_DC, MOTOR_STEPPER = range(3)
-RELAY, MOTOR_DC, BUTTON = range(3)
+RELAY, MOTOR_DC, BUTTON, MOTOR_STEPPER = range(4)
+
+# Boards on one chip select are told apart by the 3 hardware address bits
+MAX_BOARDS = 8
 
 DEFAULT_GPIOA_CONF = {'value': 0, 'direction': 0, 'pullup': 0}
 DEFAULT_GPIOB_CONF = {'value': 0, 'direction': 0xff, 'pullup': 0xff}
 
+IOCONFIG = (pifacecommon.mcp23s17.BANK_OFF |
+            pifacecommon.mcp23s17.INT_MIRROR_OFF |
+            pifacecommon.mcp23s17.SEQOP_ON |
+            pifacecommon.mcp23s17.DISSLW_OFF |
+            pifacecommon.mcp23s17.HAEN_ON |
+            pifacecommon.mcp23s17.ODR_OFF |
+            pifacecommon.mcp23s17.INTPOL_LOW)
+
+
+def _layouts():
+    pcmcp = pifacecommon.mcp23s17
+    outputs = {'value': 0, 'direction': 0, 'pullup': 0}
+    inputs = {'value': 0, 'direction': 0xff, 'pullup': 0xff}
+    # every plus board has the x-pins (upper nibble of GPIOB, inverted) and
+    # the relays (lower nibble of GPIOA, order is reversed)
+    x_pins = [(pcmcp.GPIOB, i, True) for i in range(4, 8)]
+    relays = [(pcmcp.GPIOA, i, False) for i in range(3, -1, -1)]
+    ports = {'x_port': (pcmcp.GPIOB, 0xf0, True),
+             'relay_port': (pcmcp.GPIOA, 0x0f, False)}
+    return {
+        None: BoardLayout({'x_pins': x_pins, 'relays': relays},
+                          ports, outputs, inputs),
+        RELAY: BoardLayout(
+            {'x_pins': x_pins,
+             'relays': relays + [(pcmcp.GPIOA, i, False)
+                                 for i in range(4, 8)],
+             'y_pins': [(pcmcp.GPIOB, i, True) for i in range(4)]},
+            dict(ports,
+                 relay_port=(pcmcp.GPIOA, 0xff, False),
+                 y_port=(pcmcp.GPIOB, 0x0f, True)),
+            outputs, inputs),
+        MOTOR_DC: BoardLayout(
+            {'x_pins': x_pins,
+             'relays': relays,
+             # (pin1, pin2) of each motor
+             'motors': [(pcmcp.GPIOB, 3, True), (pcmcp.GPIOB, 2, True),
+                        (pcmcp.GPIOB, 1, True), (pcmcp.GPIOB, 0, True),
+                        (pcmcp.GPIOA, 4, False), (pcmcp.GPIOA, 5, False),
+                        (pcmcp.GPIOA, 6, False), (pcmcp.GPIOA, 7, False)]},
+            ports, outputs, outputs, motors='dc'),
+        MOTOR_STEPPER: BoardLayout(
+            {'x_pins': x_pins,
+             'relays': relays,
+             # the four driver inputs of each stepper
+             'motors': ([(pcmcp.GPIOB, i, True) for i in range(4)] +
+                        [(pcmcp.GPIOA, i, False) for i in range(4, 8)])},
+            ports, outputs, outputs, motors='stepper'),
+        BUTTON: BoardLayout(
+            {'x_pins': x_pins,
+             'relays': relays,
+             'leds': [(pcmcp.GPIOA, i, False) for i in range(4, 8)],
+             'buttons': [(pcmcp.GPIOB, i, True) for i in range(4)]},
+            dict(ports,
+                 led_port=(pcmcp.GPIOA, 0xf0, False),
+                 button_port=(pcmcp.GPIOB, 0x0f, True)),
+            outputs, inputs),
+    }
+
+# The pins of each plus board (None is the base board on its own)
+LAYOUTS = _layouts()
+
 # You cannot make two motor controls within this time window (feel free
 # to adjust this for your power supply)
 MOTOR_CONTROL_WINDOW = 0.150 # 150ms
-_motor_last_control_time = 0
+
+# passes over the boards read_interrupts makes while the line stays asserted
+MAX_INTERRUPT_PASSES = 8
+
+# groups of GPIOB channels returned by get_inputs
+_INPUT_GROUPS = ('x_pins', 'y_pins', 'buttons')
+
+# Registers that read/write the output latches, mapped to their GPIO port
+_LATCH_REGISTERS = {
+    pifacecommon.mcp23s17.GPIOA: pifacecommon.mcp23s17.GPIOA,
+    pifacecommon.mcp23s17.GPIOB: pifacecommon.mcp23s17.GPIOB,
+    pifacecommon.mcp23s17.OLATA: pifacecommon.mcp23s17.GPIOA,
+    pifacecommon.mcp23s17.OLATB: pifacecommon.mcp23s17.GPIOB,
+}
+_OUTPUT_LATCHES = {
+    pifacecommon.mcp23s17.GPIOA: pifacecommon.mcp23s17.OLATA,
+    pifacecommon.mcp23s17.GPIOB: pifacecommon.mcp23s17.OLATB,
+}
+_DIRECTION_REGISTERS = {
+    pifacecommon.mcp23s17.IODIRA: pifacecommon.mcp23s17.GPIOA,
+    pifacecommon.mcp23s17.IODIRB: pifacecommon.mcp23s17.GPIOB,
+}
 
 
 class NoPiFaceRelayPlusDetectedError(Exception):
@@ -42,107 +141,392 @@ class MotorForwardReverseError(Exception):
 
 
 class MotorTooSoonError(Exception):
-    """This exception is thrown when more than one motor is turned on
-    within a small time window as it will draw too much current and
-    reset the Raspberry Pi.
+    """This exception is thrown when more than one motor (on the same board)
+    is turned on within a small time window as it will draw too much current
+    and reset the Raspberry Pi.
     """
     pass
 
 
+class MotorInrushBudget(object):
+    """Keeps track of motors being turned on so that no more than
+    ``max_starts`` motors draw their inrush current within
+    ``MOTOR_CONTROL_WINDOW`` of each other. Each board has its own budget.
+    """
+
+    def __init__(self, max_starts=1, window=None):
+        self.max_starts = max_starts
+        self.window = window
+        # motors told to keep running, which don't draw inrush current
+        self.starts_suppressed = 0
+        self._start_times = collections.deque()
+        self._lock = threading.Lock()
+
+    def next_start_time(self, now=None):
+        """Returns the earliest time another motor can be turned on."""
+        if now is None:
+            now = time.time()
+        with self._lock:
+            return self._next_start_time(now)
+
+    def _next_start_time(self, now):
+        window = MOTOR_CONTROL_WINDOW if self.window is None else self.window
+        while self._start_times and self._start_times[0] + window < now:
+            self._start_times.popleft()
+        if len(self._start_times) < self.max_starts:
+            return now
+        return self._start_times[0] + window
+
+    def start(self, count=1):
+        """Records ``count`` motors being turned on together.
+
+        :raises: MotorTooSoonError
+        """
+        now = time.time()
+        with self._lock:
+            # forget the starts which have left the window
+            self._next_start_time(now)
+            if len(self._start_times) + count > self.max_starts:
+                raise MotorTooSoonError()
+            self._start_times.extend([now] * count)
+
+    def suppress(self, count=1):
+        """Records ``count`` motors being told to keep going the way they
+        already are, which doesn't use up the budget.
+        """
+        with self._lock:
+            self.starts_suppressed += count
+
+
+# used by motors that are not given the budget of a board
+_default_inrush_budget = MotorInrushBudget()
+
+
 class MotorDC(object):
-    """A motor driver attached to a PiFace Relay Plus. Uses DRV8835."""
+    """A motor driver attached to a PiFace Relay Plus. Uses DRV8835.
+
+    Turning a motor on (forward/reverse) uses up the inrush budget of its
+    board for ``MOTOR_CONTROL_WINDOW``; coasting and braking don't draw any
+    extra current so they can be done at any time. Neither does telling a
+    motor to keep going in the direction it already is.
+    """
 
-    def __init__(self, pin1, pin2):
+    def __init__(self, pin1, pin2, inrush_budget=None):
         self.pin1 = pin1
         self.pin2 = pin2
+        if inrush_budget is None:
+            inrush_budget = _default_inrush_budget
+        self.inrush_budget = inrush_budget
         self._current_state = 'brake'
+        # commands from different threads must not interleave
+        self._lock = threading.RLock()
 
-    def _check_time(self):
-        global _motor_last_control_time
-        if time.time() > _motor_last_control_time + MOTOR_CONTROL_WINDOW:
-            # past the window - we can control the motor
-            _motor_last_control_time = time.time()
+    def _check_time(self, state):
+        if self._current_state == state:
+            self.inrush_budget.suppress()
         else:
-            raise MotorTooSoonError()
+            self.inrush_budget.start()
 
     def coast(self):
         """Sets the motor so that it is coasting."""
-        self._check_time()
-        self.pin1.value = MOTOR_DC_COAST_BITS[0]
-        self.pin2.value = MOTOR_DC_COAST_BITS[1]
-        self._current_state = 'coast'
+        with self._lock:
+            self.pin1.value = MOTOR_DC_COAST_BITS[0]
+            self.pin2.value = MOTOR_DC_COAST_BITS[1]
+            self._current_state = 'coast'
 
     def reverse(self):
         """Sets the motor so that it is moving in reverse."""
-        if self._current_state == 'forward':
-            raise MotorForwardReverseError('reverse', self._current_state)
-        else:
-            self._check_time()
-            self.pin1.value = MOTOR_DC_REVERSE_BITS[0]
-            self.pin2.value = MOTOR_DC_REVERSE_BITS[1]
-            self._current_state = 'reverse'
+        with self._lock:
+            if self._current_state == 'forward':
+                raise MotorForwardReverseError('reverse', self._current_state)
+            else:
+                self._check_time('reverse')
+                self.pin1.value = MOTOR_DC_REVERSE_BITS[0]
+                self.pin2.value = MOTOR_DC_REVERSE_BITS[1]
+                self._current_state = 'reverse'
 
     def forward(self):
         """Sets the motor so that it is moving forward."""
-        if self._current_state == 'reverse':
-            raise MotorForwardReverseError('forward', self._current_state)
-        else:
-            self._check_time()
-            self.pin1.value = MOTOR_DC_FORWARD_BITS[0]
-            self.pin2.value = MOTOR_DC_FORWARD_BITS[1]
-            self._current_state = 'forward'
+        with self._lock:
+            if self._current_state == 'reverse':
+                raise MotorForwardReverseError('forward', self._current_state)
+            else:
+                self._check_time('forward')
+                self.pin1.value = MOTOR_DC_FORWARD_BITS[0]
+                self.pin2.value = MOTOR_DC_FORWARD_BITS[1]
+                self._current_state = 'forward'
 
     def brake(self):
         """Stop the motor."""
-        self._check_time()
-        self.pin1.value = MOTOR_DC_BRAKE_BITS[0]
-        self.pin2.value = MOTOR_DC_BRAKE_BITS[1]
-        self._current_state = 'brake'
+        with self._lock:
+            self.pin1.value = MOTOR_DC_BRAKE_BITS[0]
+            self.pin2.value = MOTOR_DC_BRAKE_BITS[1]
+            self._current_state = 'brake'
+
+
+class MotorStepper(object):
+    """A stepper motor driver attached to a PiFace Relay Plus. Uses DRV8835.
+
+    The step sequence is turned into register bit patterns up front so each
+    step is a single register write. Steps are timed against absolute
+    deadlines and can be ramped up to and down from full speed with a
+    constant acceleration. With shadow registers the other bits of the
+    register come from the cached output latch, so each step is one SPI
+    write.
+
+    >>> pfrp = pifacerelayplus.PiFaceRelayPlus(
+    ...     pifacerelayplus.MOTOR_STEPPER, shadow_registers=True)
+    >>> rate = pfrp.motors[0].forward(200, step_delay=0.002,
+    ...                               acceleration=2000)
+    """
+
+    full_step_states = (0xa, 0x6, 0x5, 0x9)
+    half_step_states = (0xa, 0x2, 0x6, 0x4, 0x5, 0x1, 0x9, 0x8)
+
+    def __init__(self, index, chip, half_step=True):
+        self.chip = chip
+        channels = chip.layout.groups['motors'].channels
+        self._pins = ChannelGroup(channels[4 * index:4 * index + 4])
+        (self._address, self._mask), = self._pins.masks.items()
+        self.step_states = (self.half_step_states if half_step
+                            else self.full_step_states)
+        self._patterns = tuple(self._to_pattern(state)
+                               for state in self.step_states)
+        self._step_index = 0
+
+    def _to_pattern(self, state):
+        return self._pins.encode(state)[self._address][1]
+
+    def set_stepper(self, value):
+        """Sets the four driver inputs of this stepper to value."""
+        self._write_pattern(self._to_pattern(value))
+
+    def _write_pattern(self, pattern):
+        self.chip._write_latch_bits(self._address, self._mask, pattern)
+
+    def _send_steps(self, direction, steps, step_delay, acceleration):
+        """Steps the motor and returns the achieved steps per second."""
+        times = step_times(steps, step_delay, acceleration)
+        num_patterns = len(self._patterns)
+        index = self._step_index
+        start = time.perf_counter()
+        for step_time in times:
+            index = (index + direction) % num_patterns
+            delay = start + step_time - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            self._write_pattern(self._patterns[index])
+        elapsed = time.perf_counter() - start
+        self._step_index = index
+        if steps < 2 or elapsed == 0:
+            return 0.0
+        return (steps - 1) / elapsed
+
+    def coast(self):
+        """Sets the motor so that it is coasting."""
+        self.set_stepper(0x0)
+
+    def reverse(self, steps, step_delay, acceleration=None):
+        """Moves the motor in reverse and returns the achieved steps per
+        second.
+
+        :param steps: The number of steps to move.
+        :type steps: int
+        :param step_delay: The time between steps at full speed (seconds).
+        :type step_delay: float
+        :param acceleration: Ramp up/down at this rate (steps/s/s), or
+            ``None`` to start and stop at full speed.
+        :type acceleration: float
+        """
+        return self._send_steps(-1, steps, step_delay, acceleration)
+
+    def forward(self, steps, step_delay, acceleration=None):
+        """Moves the motor forward and returns the achieved steps per
+        second. See :meth:`reverse` for the parameters.
+        """
+        return self._send_steps(1, steps, step_delay, acceleration)
+
+    def brake(self):
+        """Stop the motor."""
+        self.set_stepper(0xf)
+
+
+def step_times(steps, step_delay, acceleration=None):
+    """Returns the time of each step (seconds from the first step) for a move
+    of ``steps`` steps at a top speed of one step per ``step_delay``, ramping
+    up and down with a constant ``acceleration`` (steps/s/s) if given.
+    A ``step_delay`` of 0 steps as fast as possible, without a ramp.
+
+    >>> step_times(4, 0.01)
+    [0.0, 0.01, 0.02, 0.03]
+    """
+    if step_delay < 0 or (acceleration is not None and acceleration < 0):
+        raise ValueError(
+            "step_delay and acceleration cannot be negative.")
+    intervals = steps - 1
+    if intervals <= 0:
+        return [0.0] * steps
+    if not acceleration or step_delay == 0:
+        return [i * step_delay for i in range(steps)]
+
+    speed = 1.0 / step_delay
+    # steps spent ramping up (and down), limited to half of the move
+    ramp = min(speed * speed / (2.0 * acceleration), intervals / 2.0)
+    speed = math.sqrt(2.0 * acceleration * ramp)
+    ramp_time = speed / acceleration
+    total_time = 2 * ramp_time + (intervals - 2 * ramp) / speed
+    times = []
+    for position in range(steps):
+        if position < ramp:
+            t = math.sqrt(2.0 * position / acceleration)
+        elif position <= intervals - ramp:
+            t = ramp_time + (position - ramp) / speed
+        else:
+            t = total_time - math.sqrt(
+                2.0 * (intervals - position) / acceleration)
+        times.append(t)
+    return times
+
+
+class BoardState(collections.namedtuple('BoardState',
+                                        ['plus_board', 'address',
+                                         'registers'])):
+    """An immutable copy of (part of) the register file of a PiFace Relay
+    Plus, as returned by :meth:`PiFaceRelayPlus.snapshot`. ``registers``
+    holds the raw register values starting at register ``address``. Inputs
+    and outputs are decoded the same way as the pins on the board object.
+    Ports that the plus board does not have are ``None``.
+    """
+    __slots__ = ()
 
+    def register(self, address):
+        """Returns the raw value of the register at address."""
+        return self.registers[address - self.address]
 
-# class MotorStepper(object):
-#     """A stepper motor driver attached to a PiFace Relay Plus. Uses DRV8835."""
+    @property
+    def gpioa(self):
+        return self.register(pifacecommon.mcp23s17.GPIOA)
 
-#     step_states = (0xa, 0x2, 0x6, 0x4, 0x5, 0x1, 0x9, 0x8)
+    @property
+    def gpiob(self):
+        return self.register(pifacecommon.mcp23s17.GPIOB)
 
-#     def __init__(self, index, chip):
-#         self.chip = chip
-#         if index == 0:
-#             self.set_stepper = self._set_stepper0
-#         else:
-#             self.set_stepper = self._set_stepper1
+    def _port(self, name):
+        port = _layout(self.plus_board).ports.get(name)
+        if port is not None:
+            return port.decode(self.register(port.address))
 
-#     def _set_stepper0(self, value):
-#         """GPIOB lower nibble, polarity reversed."""
-#         gpiob = self.chip.gpiob.value & 0xf0
-#         self.chip.gpiob.value = gpiob | ((value & 0xf) ^ 0xf)
+    def _channels(self, name):
+        group = _layout(self.plus_board).groups.get(name)
+        if group is not None:
+            return group.values(group.decode(self.registers, self.address))
 
-#     def _set_stepper1(self, value):
-#         """GPIOA upper nibble, normal polarity."""
-#         gpioa = self.chip.gpioa.value & 0x0f
-#         self.chip.gpioa.value = gpioa | ((value & 0xf) << 4)
+    relay_port = property(lambda self: self._port('relay_port'))
+    relays = property(lambda self: self._channels('relays'))
+    x_port = property(lambda self: self._port('x_port'))
+    x_pins = property(lambda self: self._channels('x_pins'))
+    y_port = property(lambda self: self._port('y_port'))
+    y_pins = property(lambda self: self._channels('y_pins'))
+    button_port = property(lambda self: self._port('button_port'))
+    buttons = property(lambda self: self._channels('buttons'))
+    led_port = property(lambda self: self._port('led_port'))
+    leds = property(lambda self: self._channels('leds'))
 
-#     def _send_steps(self, step_states, steps, step_delay):
-#         for i in range(steps):
-#             step_index = i % len(step_states)
-#             self.set_stepper(step_states[step_index])
-#             time.sleep(step_delay)
 
-#     def coast(self):
-#         """Sets the motor so that it is coasting."""
-#         self.set_stepper(0x0)
+def _layout(plus_board):
+    return LAYOUTS.get(plus_board, LAYOUTS[None])
 
-#     def reverse(self, steps, step_delay):
-#         """Sets the motor so that it is moving in reverse."""
-#         self._send_steps(reversed(self.step_states), steps, step_delay)
 
-#     def forward(self, steps, step_delay):
-#         """Sets the motor so that it is moving forward."""
-#         self._send_steps(self.step_states, steps, step_delay)
+_lazy_lock = threading.RLock()
+
+
+class _lazy(object):
+    """An attribute which is built the first time it is used and then
+    stored on the instance.
+    """
 
-#     def brake(self):
-#         """Stop the motor."""
-#         self.set_stepper(0xf)
+    def __init__(self, build):
+        self.build = build
+        self.__doc__ = build.__doc__
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        with _lazy_lock:
+            if self.name not in instance.__dict__:
+                instance.__dict__[self.name] = self.build(instance)
+            return instance.__dict__[self.name]
+
+
+class _PinBit(pifacecommon.mcp23s17.MCP23S17RegisterBit):
+    """A pin of a board. Toggling it is one read-modify-write of the
+    output latch under the port lock, so toggles from other threads aren't
+    lost.
+    """
+
+    def toggle(self):
+        self.chip._toggle_latch_bits(self.address, 1 << self.bit_num)
+
+
+class _PinBitNeg(pifacecommon.mcp23s17.MCP23S17RegisterBitNeg):
+    """An inverted pin of a board, toggled like :class:`_PinBit`."""
+
+    def toggle(self):
+        self.chip._toggle_latch_bits(self.address, 1 << self.bit_num)
+
+
+class _PortRegister(pifacecommon.mcp23s17.MCP23S17RegisterBase):
+    """A port of a board (a :class:`pifacerelayplus.layout.Port`). Writes
+    only change the bits of the port and are made under the port lock, so
+    they don't undo changes made to the rest of the register by other
+    threads.
+    """
+
+    def __init__(self, port, chip):
+        super(_PortRegister, self).__init__(port.address, chip)
+        self.port = port
+        pin_class = _PinBitNeg if port.inverted else _PinBit
+        self.bits = [pin_class(i, port.address, chip)
+                     for i in range(8) if port.mask & (1 << i)]
+        self._all = (1 << len(self.bits)) - 1
+
+    @property
+    def value(self):
+        return self.port.decode(self.chip.read(self.address))
+
+    @value.setter
+    def value(self, v):
+        mask, bits = self.port.encode(v)
+        self.chip._write_latch_bits(self.address, mask, bits)
+
+    def all_high(self):
+        self.value = self._all
+
+    def all_low(self):
+        self.value = 0
+
+    all_on = all_high
+    all_off = all_low
+
+    def toggle(self):
+        """Toggles every bit of the port with one SPI write."""
+        self.chip._toggle_latch_bits(self.address, self.port.mask)
+
+
+def _lazy_register(address):
+    return _lazy(lambda chip:
+                 pifacecommon.mcp23s17.MCP23S17Register(address, chip))
+
+
+def _lazy_pins(name):
+    return _lazy(lambda chip: chip._pins(name))
+
+
+def _lazy_port(name):
+    return _lazy(lambda chip: chip._port(name))
 
 
 class PiFaceRelayPlus(pifacecommon.mcp23s17.MCP23S17,
@@ -156,6 +540,40 @@ class PiFaceRelayPlus(pifacecommon.mcp23s17.MCP23S17,
     0
     >>> pfrp.relays[3].turn_on()
     >>> pfrp.motor[2].forward()
+
+    With ``shadow_registers=True`` the output latches of GPIOA and GPIOB are
+    kept in memory. Output reads are served from the cache and bit writes
+    only cost one SPI write instead of a read-modify-write:
+
+    >>> pfrp = pifacerelayplus.PiFaceRelayPlus(pifacerelayplus.RELAY,
+    ...                                        shadow_registers=True)
+    >>> pfrp.relays[3].turn_on()
+    >>> pfrp.spi_transactions_saved
+    1
+
+    Writing an output latch with the value it already has is skipped, so
+    re-asserting the same outputs every cycle costs no SPI writes. Without
+    shadow registers only bit and masked writes are checked, against the
+    latch read back from the board:
+
+    >>> pfrp.relay_port.value = 0x01  # relay 3 is already on
+    >>> pfrp.writes_suppressed
+    1
+
+    If something else may have reset the board, call :meth:`init_board` or
+    :meth:`resync_registers` first.
+
+    ``spi`` replaces ``/dev/spidev<bus>.<chip_select>`` with any object that
+    has a ``spisend(bytes_to_send)`` method, such as
+    :class:`pifacerelayplus.simulator.SimulatedSPIBus`.
+
+    With a ``journal`` (:class:`pifacerelayplus.journal.StateJournal`) every
+    output latch write is recorded and ``warm_start=True`` restores the
+    board with :meth:`warm_start` instead of :meth:`init_board`.
+
+    The pins are built from ``layout`` (a
+    :class:`pifacerelayplus.layout.BoardLayout` from :data:`LAYOUTS`),
+    which also says which pins share a register.
     """
 
     def __init__(self,
@@ -163,118 +581,579 @@ class PiFaceRelayPlus(pifacecommon.mcp23s17.MCP23S17,
                  hardware_addr=0,
                  bus=DEFAULT_SPI_BUS,
                  chip_select=DEFAULT_SPI_CHIP_SELECT,
-                 init_board=True):
-        super(PiFaceRelayPlus, self).__init__(hardware_addr, bus, chip_select)
+                 init_board=True,
+                 shadow_registers=False,
+                 spi=None,
+                 journal=None,
+                 warm_start=False):
+        # must be set before the SPI device is opened
+        self.spi = spi
+        # see pifacerelayplus.trace
+        self.tracer = None
+        # MCP23S17.__init__ is skipped, the registers are built when used
+        pifacecommon.spi.SPIDevice.__init__(self, bus, chip_select)
+        self.hardware_addr = hardware_addr
 
         pcmcp = pifacecommon.mcp23s17
 
-        # input_pins are always the upper nibble of GPIOB
-        self.x_pins = [pcmcp.MCP23S17RegisterBitNeg(i, pcmcp.GPIOB, self)
-                           for i in range(4, 8)]
-        self.x_port = pcmcp.MCP23S17RegisterNibbleNeg(pcmcp.UPPER_NIBBLE,
-                                                      pcmcp.GPIOB,
-                                                      self)
-
-        # self.relay_port = pcmcp.MCP23S17Register(pcmcp.GPIOA, self)
-        self.relay_port = pcmcp.MCP23S17RegisterNibble(pcmcp.LOWER_NIBBLE,
-                                                       pcmcp.GPIOA,
-                                                       self)
-
-
-        # Relays are always lower nibble of GPIOA, order is reversed
-        self.relays = list(reversed([pcmcp.MCP23S17RegisterBit(i,
-                                                               pcmcp.GPIOA,
-                                                               self)
-                                     for i in range(0, 4)]))
-
-        if plus_board == RELAY:
-            # append 4 relays
-            self.relays.extend([pcmcp.MCP23S17RegisterBit(i, pcmcp.GPIOA, self)
-                                for i in range(4, 8)])
-
-            self.relay_port = pcmcp.MCP23S17Register(pcmcp.GPIOA, self)
-
-            # add the y port
-            self.y_pins = [pcmcp.MCP23S17RegisterBitNeg(i, pcmcp.GPIOB, self)
-                           for i in range(4)]
-            self.y_port = pcmcp.MCP23S17RegisterNibbleNeg(pcmcp.LOWER_NIBBLE,
-                                                          pcmcp.GPIOB,
-                                                          self)
-            gpioa_conf = {'value': 0, 'direction': 0, 'pullup': 0}
-            gpiob_conf = {'value': 0, 'direction': 0xff, 'pullup': 0xff}
-
-        elif plus_board == MOTOR_DC:
-            self.motors = [
-                MotorDC(
-                    pin1=pcmcp.MCP23S17RegisterBitNeg(3, pcmcp.GPIOB, self),
-                    pin2=pcmcp.MCP23S17RegisterBitNeg(2, pcmcp.GPIOB, self)),
-                MotorDC(
-                    pin1=pcmcp.MCP23S17RegisterBitNeg(1, pcmcp.GPIOB, self),
-                    pin2=pcmcp.MCP23S17RegisterBitNeg(0, pcmcp.GPIOB, self)),
-                MotorDC(pin1=pcmcp.MCP23S17RegisterBit(4, pcmcp.GPIOA, self),
-                        pin2=pcmcp.MCP23S17RegisterBit(5, pcmcp.GPIOA, self)),
-                MotorDC(pin1=pcmcp.MCP23S17RegisterBit(6, pcmcp.GPIOA, self),
-                        pin2=pcmcp.MCP23S17RegisterBit(7, pcmcp.GPIOA, self)),
-            ]
-            gpioa_conf = {'value': 0, 'direction': 0, 'pullup': 0}
-            gpiob_conf = {'value': 0, 'direction': 0, 'pullup': 0}
-
-        # elif plus_board == MOTOR_STEPPER:
-        #     self.motors = [MotorStepper(i, self) for i in range(2)]
-        #     gpioa_conf = {'value': 0, 'direction': 0, 'pullup': 0}
-        #     gpiob_conf = {'value': 0, 'direction': 0, 'pullup': 0}
-
-        elif plus_board == BUTTON:
-            # append 4 LEDs
-            self.leds = [pcmcp.MCP23S17RegisterBit(i, pcmcp.GPIOA, self)
-                         for i in range(4, 8)]
-            self.led_port = pcmcp.MCP23S17RegisterNibble(pcmcp.UPPER_NIBBLE,
-                                                         pcmcp.GPIOA,
-                                                         self)
-            # add the buttons
-            self.buttons = [pcmcp.MCP23S17RegisterBitNeg(i, pcmcp.GPIOB, self)
-                            for i in range(4)]
-            self.button_port = pcmcp.MCP23S17RegisterNibbleNeg(pcmcp.LOWER_NIBBLE,
-                                                               pcmcp.GPIOB,
-                                                               self)
-            gpioa_conf = {'value': 0, 'direction': 0, 'pullup': 0}
-            gpiob_conf = {'value': 0, 'direction': 0xff, 'pullup': 0xff}
+        self.plus_board = plus_board
+        self.shadow_registers = shadow_registers
+        self.journal = journal
+        self._sequential = False
+        self.spi_transactions_saved = 0
+        self.writes_suppressed = 0
+        # last values written to the output latches (None until known)
+        self._latches = {pcmcp.GPIOA: None, pcmcp.GPIOB: None}
+        # one lock per port so GPIOA and GPIOB can be written concurrently
+        self._port_locks = {pcmcp.GPIOA: threading.RLock(),
+                            pcmcp.GPIOB: threading.RLock()}
+        self._directions = {pcmcp.GPIOA: 0xff, pcmcp.GPIOB: 0xff}
+        self._batch_depth = 0
+        # thread ident of the thread running the batch
+        self._batch_owner = None
+        self._pending_latches = {}
+        self._pending_masks = {}
+        # latch values the pending latches were worked out from
+        self._batch_bases = {}
+        self.inrush_budget = MotorInrushBudget()
 
-        else:
-            gpioa_conf = DEFAULT_GPIOA_CONF
-            gpiob_conf = DEFAULT_GPIOB_CONF
+        # pins, ports and motors are built from the layout when they are
+        # first used
+        self.layout = _layout(plus_board)
+        self.relay_port_mask = self.layout.ports['relay_port'].mask
+        gpioa_conf = dict(self.layout.gpioa_conf)
+        gpiob_conf = dict(self.layout.gpiob_conf)
 
-        if init_board:
+        self.gpioa_conf = gpioa_conf
+        self.gpiob_conf = gpiob_conf
+
+        if warm_start:
+            self.warm_start(gpioa_conf, gpiob_conf)
+        elif init_board:
             self.init_board(gpioa_conf, gpiob_conf)
+        elif self.shadow_registers:
+            self.resync_registers()
+
+    iodira = _lazy_register(pifacecommon.mcp23s17.IODIRA)
+    iodirb = _lazy_register(pifacecommon.mcp23s17.IODIRB)
+    ipola = _lazy_register(pifacecommon.mcp23s17.IPOLA)
+    ipolb = _lazy_register(pifacecommon.mcp23s17.IPOLB)
+    gpintena = _lazy_register(pifacecommon.mcp23s17.GPINTENA)
+    gpintenb = _lazy_register(pifacecommon.mcp23s17.GPINTENB)
+    defvala = _lazy_register(pifacecommon.mcp23s17.DEFVALA)
+    defvalb = _lazy_register(pifacecommon.mcp23s17.DEFVALB)
+    intcona = _lazy_register(pifacecommon.mcp23s17.INTCONA)
+    intconb = _lazy_register(pifacecommon.mcp23s17.INTCONB)
+    iocon = _lazy_register(pifacecommon.mcp23s17.IOCON)
+    gppua = _lazy_register(pifacecommon.mcp23s17.GPPUA)
+    gppub = _lazy_register(pifacecommon.mcp23s17.GPPUB)
+    intfa = _lazy_register(pifacecommon.mcp23s17.INTFA)
+    intfb = _lazy_register(pifacecommon.mcp23s17.INTFB)
+    intcapa = _lazy_register(pifacecommon.mcp23s17.INTCAPA)
+    intcapb = _lazy_register(pifacecommon.mcp23s17.INTCAPB)
+    gpioa = _lazy_register(pifacecommon.mcp23s17.GPIOA)
+    gpiob = _lazy_register(pifacecommon.mcp23s17.GPIOB)
+    olata = _lazy_register(pifacecommon.mcp23s17.OLATA)
+    olatb = _lazy_register(pifacecommon.mcp23s17.OLATB)
+
+    def _no_plus_board_attribute(self, name):
+        return AttributeError(
+            "This PiFace Relay Plus (plus_board={}) has no `{}`.".format(
+                self.plus_board, name))
+
+    x_pins = _lazy_pins('x_pins')
+    x_port = _lazy_port('x_port')
+    relays = _lazy_pins('relays')
+    relay_port = _lazy_port('relay_port')
+    y_pins = _lazy_pins('y_pins')
+    y_port = _lazy_port('y_port')
+    leds = _lazy_pins('leds')
+    led_port = _lazy_port('led_port')
+    buttons = _lazy_pins('buttons')
+    button_port = _lazy_port('button_port')
+
+    @_lazy
+    def motors(self):
+        """The motors of the MOTOR_DC or MOTOR_STEPPER plus board."""
+        if self.layout.motors == 'dc':
+            pins = self._pins('motors')
+            return [MotorDC(pin1=pin1,
+                            pin2=pin2,
+                            inrush_budget=self.inrush_budget)
+                    for pin1, pin2 in zip(pins[0::2], pins[1::2])]
+        elif self.layout.motors == 'stepper':
+            return [MotorStepper(i, self)
+                    for i in range(len(self.layout.groups['motors']) // 4)]
+        raise self._no_plus_board_attribute('motors')
+
+    def _pins(self, name):
+        """Returns a pin object for every channel of a layout group."""
+        group = self.layout.groups.get(name)
+        if group is None:
+            raise self._no_plus_board_attribute(name)
+        pins = []
+        for channel in group.channels:
+            pin_class = _PinBitNeg if channel.inverted else _PinBit
+            pins.append(pin_class(channel.bit_num, channel.address, self))
+        return pins
+
+    def _port(self, name):
+        """Returns the register object of a layout port."""
+        port = self.layout.ports.get(name)
+        if port is None:
+            raise self._no_plus_board_attribute(name)
+        return _PortRegister(port, self)
+
+    def read(self, address):
+        """Returns the value of the address specified. Output latches are
+        served from memory when using shadow registers or inside a
+        :meth:`batch`. Other threads see the latches as they were before
+        the batch until it has been sent.
+        """
+        port = _LATCH_REGISTERS.get(address)
+        if port is not None:
+            if (self._batch_owner == threading.get_ident() and
+                    port in self._pending_latches):
+                pending = self._pending_latches[port]
+                mask = self._pending_masks[port]
+                if (address != port or mask == 0xff or
+                        (self.shadow_registers and
+                         self._directions[port] == 0)):
+                    self.spi_transactions_saved += 1
+                    return pending
+                # pins not written in this batch come from the board
+                value = super(PiFaceRelayPlus, self).read(address)
+                return (value & ~mask) | (pending & mask)
+            # input pins still have to be read from the board
+            if self.shadow_registers and (address != port or
+                                          self._directions[port] == 0):
+                self.spi_transactions_saved += 1
+                return self._latches[port]
+        return super(PiFaceRelayPlus, self).read(address)
+
+    def write(self, data, address):
+        """Writes data to the address specified, keeping the shadow
+        registers up to date. Inside a :meth:`batch` output latch writes are
+        held back until the batch finishes.
+        """
+        port = _LATCH_REGISTERS.get(address)
+        if port is None:
+            super(PiFaceRelayPlus, self).write(data, address)
+            if self.shadow_registers and address in _DIRECTION_REGISTERS:
+                self._directions[_DIRECTION_REGISTERS[address]] = data
+            return
+
+        with self._port_locks[port]:
+            if self._batch_depth > 0:
+                if port in self._pending_latches:
+                    self.spi_transactions_saved += 1
+                self._pending_latches[port] = data
+                self._pending_masks[port] = 0xff
+                return
+            if self.shadow_registers and self._latches[port] == data:
+                # already written, nothing would change
+                self._suppress_write()
+                return
+            super(PiFaceRelayPlus, self).write(data, address)
+            self._latches[port] = data
+            if self.journal is not None:
+                self.journal.record(self.hardware_addr, self.plus_board,
+                                    port, data)
+
+    def write_bit(self, value, bit_num, address):
+        """Writes the value given to the bit in the address specified. With
+        shadow registers the old byte comes from the cached output latch.
+        """
+        port = _LATCH_REGISTERS.get(address)
+        if port is None:
+            super(PiFaceRelayPlus, self).write_bit(value, bit_num, address)
+            return
+        with self._port_locks[port]:
+            self._write_latch_bit(value, bit_num, address, port)
+
+    def _suppress_write(self):
+        self.writes_suppressed += 1
+        self.spi_transactions_saved += 1
+
+    def _write_latch_bit(self, value, bit_num, address, port):
+        bit_mask = pifacecommon.core.get_bit_mask(bit_num)
+        if port in self._pending_latches:
+            old_byte = self._pending_latches[port]
+            self.spi_transactions_saved += 2
+        elif self.shadow_registers:
+            old_byte = self._latches[port]
+            self.spi_transactions_saved += 1
+        else:
+            old_byte = super(PiFaceRelayPlus, self).read(_OUTPUT_LATCHES[port])
+
+        if value:
+            new_byte = old_byte | bit_mask
+        else:
+            new_byte = old_byte & ~bit_mask
+
+        if self._batch_depth > 0:
+            self._batch_bases.setdefault(port, old_byte)
+            self._pending_latches[port] = new_byte
+            self._pending_masks[port] = (
+                self._pending_masks.get(port, 0) | bit_mask)
+        elif new_byte == old_byte:
+            # compared with the byte just read (or the shadow register)
+            self._suppress_write()
+        else:
+            self.write(new_byte, address)
+
+    def write_masked(self, value, mask):
+        """Sets the relay port bits in ``mask`` to ``value``, leaving the
+        others alone, and returns the new relay port value. This costs one
+        SPI write, plus a read of the output latch unless shadow registers
+        are on, and is atomic across threads.
+
+        On the RELAY plus board the relay port is all 8 relays, otherwise it
+        is the lower nibble of GPIOA.
+
+        >>> pfrp.write_masked(0b0101, 0b0111)
+        5
+
+        :param value: The new value of the masked bits.
+        :type value: int
+        :param mask: The bits to change.
+        :type mask: int
+        """
+        mask &= self.relay_port_mask
+        new_latch = self._write_latch_bits(pifacecommon.mcp23s17.GPIOA,
+                                           mask, value & mask)
+        return new_latch & self.relay_port_mask
+
+    def _write_latch_bits(self, address, mask, value):
+        """Sets the bits in mask of the output latch at address to value
+        with one SPI write and returns the new latch value.
+        """
+        port = _LATCH_REGISTERS[address]
+        with self._port_locks[port]:
+            latch = self._output_latch(port)
+            new_latch = (latch & ~mask) | value
+            if self._batch_depth > 0:
+                self._batch_bases.setdefault(port, latch)
+            elif new_latch == latch:
+                # compared with the latch just read (or the shadow register)
+                self._suppress_write()
+                return new_latch
+            self.write(new_latch, port)
+        return new_latch
+
+    def _toggle_latch_bits(self, address, mask):
+        """Toggles the bits in mask of the output latch at address with one
+        SPI write and returns the new latch value.
+        """
+        port = _LATCH_REGISTERS[address]
+        with self._port_locks[port]:
+            latch = self._output_latch(port)
+            if self._batch_depth > 0:
+                self._batch_bases.setdefault(port, latch)
+            new_latch = latch ^ mask
+            self.write(new_latch, port)
+        return new_latch
+
+    def _output_latch(self, port):
+        """Returns the value of the output latch of port. Without shadow
+        registers it is read from the board, which something else may have
+        written to since.
+        """
+        latch = self._latches[port]
+        if (latch is None or not self.shadow_registers or
+                port in self._pending_latches):
+            latch = self.read(_OUTPUT_LATCHES[port])
+        return latch
+
+    def set_bits(self, mask):
+        """Turns on the relays in ``mask`` with one SPI write."""
+        return self.write_masked(0xff, mask)
+
+    def clear_bits(self, mask):
+        """Turns off the relays in ``mask`` with one SPI write."""
+        return self.write_masked(0, mask)
+
+    def toggle_bits(self, mask):
+        """Toggles the relays in ``mask`` with one SPI write."""
+        mask &= self.relay_port_mask
+        new_latch = self._toggle_latch_bits(pifacecommon.mcp23s17.GPIOA, mask)
+        return new_latch & self.relay_port_mask
+
+    def set_relays(self, values):
+        """Sets the relays with one SPI write. ``values`` is either a
+        sequence of 0s and 1s starting with relay 0 (relays after the end of
+        it are left alone) or a bit mask of every relay (relay ``i`` is bit
+        ``i``).
+
+        >>> pfrp.set_relays([1, 0, 1])
+        >>> pfrp.snapshot().relays
+        (1, 0, 1, 0, 0, 0, 0, 0)
+        """
+        self._write_channels('relays', values)
+
+    def set_leds(self, values):
+        """Sets the LEDs of the BUTTON plus board with one SPI write, like
+        :meth:`set_relays`.
+        """
+        self._write_channels('leds', values)
+
+    def get_inputs(self):
+        """Returns the values of the x-pins followed by the y-pins or
+        buttons, read with one SPI read.
+
+        >>> pfrp.get_inputs()
+        (0, 1, 0, 0, 0, 0, 0, 0)
+        """
+        gpiob = (self.read(pifacecommon.mcp23s17.GPIOB),)
+        values = ()
+        for name in _INPUT_GROUPS:
+            group = self.layout.groups.get(name)
+            if group is not None:
+                values += group.values(
+                    group.decode(gpiob, pifacecommon.mcp23s17.GPIOB))
+        return values
+
+    def set_motors(self, states):
+        """Sets the DC motors to ``states`` ('forward', 'reverse', 'brake',
+        'coast' or ``None`` to leave a motor alone) with one SPI write per
+        GPIO register.
+
+        Nothing is written if a motor would go straight between forward and
+        reverse (:class:`MotorForwardReverseError`) or if turning on the
+        motors would exceed the inrush budget (:class:`MotorTooSoonError`).
+        Motors which are already going the way they are told don't count
+        towards the budget.
+
+        >>> pfrp.set_motors(['forward', None, 'brake'])
+        """
+        if self.layout.motors != 'dc':
+            raise self._no_plus_board_attribute('DC motors')
+        motors = self.motors
+        if len(states) > len(motors):
+            raise ValueError("Too many states ({}) for {} motors.".format(
+                len(states), len(motors)))
+        with contextlib.ExitStack() as stack:
+            for motor in motors:
+                stack.enter_context(motor._lock)
+            vector = channels = starts = running = 0
+            for i, (motor, state) in enumerate(zip(motors, states)):
+                if state is None:
+                    continue
+                if state not in _MOTOR_DC_BITS:
+                    raise ValueError("Unknown motor state `{}`.".format(state))
+                if {state, motor._current_state} == {'forward', 'reverse'}:
+                    raise MotorForwardReverseError(state,
+                                                   motor._current_state)
+                if state == motor._current_state:
+                    running += state in ('forward', 'reverse')
+                elif state in ('forward', 'reverse'):
+                    starts += 1
+                pin1, pin2 = _MOTOR_DC_BITS[state]
+                vector |= (pin1 | (pin2 << 1)) << (2 * i)
+                channels |= 0b11 << (2 * i)
+            if starts:
+                self.inrush_budget.start(starts)
+            if running:
+                self.inrush_budget.suppress(running)
+            group = self.layout.groups['motors']
+            for address, (mask, bits) in group.encode(vector,
+                                                      channels).items():
+                self._write_latch_bits(address, mask, bits)
+            for motor, state in zip(motors, states):
+                if state is not None:
+                    motor._current_state = state
+
+    def _write_channels(self, name, values):
+        """Sets the channels of a layout group with one SPI write per GPIO
+        register.
+        """
+        group = self.layout.groups.get(name)
+        if group is None:
+            raise self._no_plus_board_attribute(name)
+        if isinstance(values, int):
+            vector, channels = values, None
+        else:
+            vector, channels = group.vector(values)
+        for address, (mask, bits) in group.encode(vector, channels).items():
+            self._write_latch_bits(address, mask, bits)
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Collects every change to the output latches (relays, LEDs and
+        motor pins) made inside the ``with`` block and sends them with at
+        most one SPI write per GPIO register when the block exits. If the
+        outermost ``with`` block raises, nothing is sent and the DC motors
+        keep the states they had before it.
+
+        >>> with pfrp.batch():
+        ...     pfrp.relays[0].turn_on()
+        ...     pfrp.relays[5].turn_off()
+        ...
+
+        Other threads wait for the batch to finish before writing to the
+        output latches or commanding the DC motors, and read the output
+        latches as they were before it.
+        """
+        pcmcp = pifacecommon.mcp23s17
+        with contextlib.ExitStack() as stack:
+            # motor locks before port locks, like the motor commands
+            motors = self.motors if self.layout.motors == 'dc' else []
+            for motor in motors:
+                stack.enter_context(motor._lock)
+            stack.enter_context(self._port_locks[pcmcp.GPIOA])
+            stack.enter_context(self._port_locks[pcmcp.GPIOB])
+            motor_states = [motor._current_state for motor in motors]
+            self._batch_depth += 1
+            self._batch_owner = threading.get_ident()
+            try:
+                yield self
+            except BaseException:
+                self._batch_depth -= 1
+                if self._batch_depth == 0:
+                    self._batch_owner = None
+                    self._discard_batch()
+                    for motor, state in zip(motors, motor_states):
+                        motor._current_state = state
+                raise
+            else:
+                self._batch_depth -= 1
+                if self._batch_depth == 0:
+                    self._batch_owner = None
+                    self._flush_batch()
+
+    def _discard_batch(self):
+        pending = self._pending_latches
+        self._pending_latches = {}
+        self._pending_masks = {}
+        self._batch_bases = {}
+        return pending
+
+    def _flush_batch(self):
+        bases = self._batch_bases
+        pending = self._discard_batch()
+        for port in sorted(pending):
+            if bases.get(port) == pending[port]:
+                self._suppress_write()  # the batch changed nothing
+            else:
+                self.write(pending[port], port)
+
+    def read_registers(self, address, count):
+        """Returns ``count`` consecutive registers starting at ``address``
+        as bytes, read in a single SPI transaction using the sequential
+        address pointer. If the board has been configured without
+        sequential mode, it is turned on for the read and IOCON is put back
+        afterwards (two more SPI writes).
+        """
+        pcmcp = pifacecommon.mcp23s17
+        ctrl_byte = self._get_spi_control_byte(pcmcp.READ_CMD)
+        request = bytes((ctrl_byte, address)) + bytes(count)
+        if not self._sequential:
+            ioconfig = super(PiFaceRelayPlus, self).read(pcmcp.IOCON)
+            if ioconfig & pcmcp.SEQOP_OFF:
+                super(PiFaceRelayPlus, self).write(
+                    ioconfig & ~pcmcp.SEQOP_OFF, pcmcp.IOCON)
+                try:
+                    data = self.spisend(request)
+                finally:
+                    super(PiFaceRelayPlus, self).write(ioconfig, pcmcp.IOCON)
+                return bytes(data[2:])
+            self._sequential = True
+        data = self.spisend(request)
+        return bytes(data[2:])
+
+    def snapshot(self,
+                 start=pifacecommon.mcp23s17.IODIRA,
+                 end=pifacecommon.mcp23s17.OLATB):
+        """Reads the registers from ``start`` to ``end`` (inclusive) in one
+        SPI burst and returns them as a :class:`BoardState`. The range must
+        include GPIOA and GPIOB.
+
+        Reading GPIOB (and INTCAPB, which the default range includes) clears
+        any pending interrupt on the input port, just like reading the
+        input port does. An :class:`InputEventListener` running at the same
+        time can miss the input change that raised it.
+
+        >>> state = pfrp.snapshot()
+        >>> state.relays
+        (0, 1, 0, 0, 0, 0, 0, 0)
+        >>> state.x_port
+        0
+        """
+        pcmcp = pifacecommon.mcp23s17
+        if not start <= pcmcp.GPIOA < pcmcp.GPIOB <= end:
+            raise ValueError(
+                "Snapshot range must include GPIOA and GPIOB.")
+        registers = self.read_registers(start, end - start + 1)
+        return BoardState(self.plus_board, start, registers)
+
+    def resync_registers(self):
+        """Reloads the shadow registers (output latches and pin directions)
+        from the board. Use this if something else has written to the board.
+        """
+        pcmcp = pifacecommon.mcp23s17
+        iodira, iodirb = self.read_registers(pcmcp.IODIRA, 2)
+        olata, olatb = self.read_registers(pcmcp.OLATA, 2)
+        self._directions[pcmcp.GPIOA] = iodira
+        self._directions[pcmcp.GPIOB] = iodirb
+        self._latches[pcmcp.GPIOA] = olata
+        self._latches[pcmcp.GPIOB] = olatb
+
+    def open_fd(self, spi_device):
+        if self.spi is None:
+            super(PiFaceRelayPlus, self).open_fd(spi_device)
+
+    def close_fd(self):
+        if self.spi is None:
+            super(PiFaceRelayPlus, self).close_fd()
+
+    def spisend(self, bytes_to_send):
+        """Sends bytes via the SPI bus (or the ``spi`` backend)."""
+        tracer = self.tracer
+        if tracer is not None:
+            start = time.perf_counter()
+        if self.spi is not None:
+            if self.spi_callback is not None:
+                self.spi_callback(bytes_to_send)
+            received = self.spi.spisend(bytes_to_send)
+        else:
+            received = super(PiFaceRelayPlus, self).spisend(bytes_to_send)
+        if tracer is not None:
+            tracer.record(self, bytes_to_send, received, start,
+                          time.perf_counter())
+        return received
+
+    def _uses_gpio_interrupts(self):
+        """Returns whether the board is on the real SPI bus (its own or a
+        shared one), so its interrupt line is the Raspberry Pi's GPIO.
+        """
+        return (self.spi is None or
+                isinstance(self.spi, pifacecommon.spi.SPIDevice))
+
+    def _interrupt_pins(self):
+        return 0xF0 | (self.gpiob_conf['direction'] & 0x0F)
 
     def enable_interrupts(self):
-        """Enables interrupts."""
-        self.gpintenb.value = 0xF0
-        self.gpio_interrupts_enable()
+        """Enables interrupts on the X-port and any other inputs of GPIOB
+        (the Y-port or buttons).
+        """
+        self.gpintenb.value = self._interrupt_pins()
+        if self._uses_gpio_interrupts():
+            self.gpio_interrupts_enable()
 
     def disable_interrupts(self):
         """Disables interrupts."""
         self.gpintenb.value = 0x00
-        self.gpio_interrupts_disable()
+        if self._uses_gpio_interrupts():
+            self.gpio_interrupts_disable()
 
     def init_board(self,
                    gpioa_conf=DEFAULT_GPIOA_CONF,
                    gpiob_conf=DEFAULT_GPIOB_CONF):
         """Initialise the board with given GPIO configurations."""
-        ioconfig = (pifacecommon.mcp23s17.BANK_OFF |
-                    pifacecommon.mcp23s17.INT_MIRROR_OFF |
-                    pifacecommon.mcp23s17.SEQOP_OFF |
-                    pifacecommon.mcp23s17.DISSLW_OFF |
-                    pifacecommon.mcp23s17.HAEN_ON |
-                    pifacecommon.mcp23s17.ODR_OFF |
-                    pifacecommon.mcp23s17.INTPOL_LOW)
-        self.iocon.value = ioconfig
-        if self.iocon.value != ioconfig:
-            raise NoPiFaceRelayPlusDetectedError(
-                "No PiFace Relay Plus board detected (hardware_addr={h}, "
-                "bus={b}, chip_select={c}).".format(h=self.hardware_addr,
-                                                    b=self.bus,
-                                                    c=self.chip_select))
+        self._forget_latches()
+        self.iocon.value = IOCONFIG
+        if self.iocon.value != IOCONFIG:
+            raise self._not_detected_error()
         else:
             # finish configuring the board
             # GPIOA
@@ -286,8 +1165,332 @@ class PiFaceRelayPlus(pifacecommon.mcp23s17.MCP23S17,
             self.iodirb.value = gpiob_conf['direction']
             self.gppub.value = gpiob_conf['pullup']
 
+            self._sequential = True
             self.enable_interrupts()
 
+            if 'motors' in vars(self):
+                # motors built before a re-init are back to the start
+                self._restore_motor_states()
+
+    def warm_start(self,
+                   gpioa_conf=DEFAULT_GPIOA_CONF,
+                   gpiob_conf=DEFAULT_GPIOB_CONF):
+        """Brings the board up without disturbing outputs which are already
+        right. The configuration is read back in one SPI burst and only the
+        registers that differ are written (output latches before pin
+        directions). The output latches are set to what the ``journal``
+        recorded, or left alone if the board has kept its configuration
+        since the last run. Motor states are restored from the latches.
+        """
+        pcmcp = pifacecommon.mcp23s17
+        self._forget_latches()
+        configured = self.iocon.value == IOCONFIG
+        if not configured:
+            # the board has been reset
+            self.iocon.value = IOCONFIG
+            if self.iocon.value != IOCONFIG:
+                raise self._not_detected_error()
+        self._sequential = True
+        registers = self.read_registers(pcmcp.IODIRA, pcmcp.OLATB + 1)
+
+        latches = {pcmcp.GPIOA: gpioa_conf['value'],
+                   pcmcp.GPIOB: gpiob_conf['value']}
+        if configured:
+            latches[pcmcp.GPIOA] = registers[pcmcp.OLATA]
+            latches[pcmcp.GPIOB] = registers[pcmcp.OLATB]
+        if self.journal is not None:
+            latches.update(self.journal.latches(self.hardware_addr,
+                                                self.plus_board))
+
+        wanted = ((pcmcp.OLATA, latches[pcmcp.GPIOA]),
+                  (pcmcp.OLATB, latches[pcmcp.GPIOB]),
+                  (pcmcp.IODIRA, gpioa_conf['direction']),
+                  (pcmcp.IODIRB, gpiob_conf['direction']),
+                  (pcmcp.GPPUA, gpioa_conf['pullup']),
+                  (pcmcp.GPPUB, gpiob_conf['pullup']),
+                  (pcmcp.GPINTENB, self._interrupt_pins()))
+        for address, value in wanted:
+            if registers[address] != value:
+                self.write(value, address)
+            else:
+                self.spi_transactions_saved += 1
+        for port, latch in latches.items():
+            self._latches[port] = latch
+            if self.journal is not None:
+                self.journal.record(self.hardware_addr, self.plus_board,
+                                    port, latch)
+        self._directions[pcmcp.GPIOA] = gpioa_conf['direction']
+        self._directions[pcmcp.GPIOB] = gpiob_conf['direction']
+        if self._uses_gpio_interrupts():
+            self.gpio_interrupts_enable()
+
+        self._restore_motor_states()
+
+    def _restore_motor_states(self):
+        """Works out the DC motor states from the known latches."""
+        for motor in getattr(self, 'motors', ()):
+            if isinstance(motor, MotorDC):
+                motor._current_state = _MOTOR_DC_STATES[
+                    (self._latched_pin_value(motor.pin1),
+                     self._latched_pin_value(motor.pin2))]
+
+    def _forget_latches(self):
+        """Stops trusting the known output latches (the board may have been
+        reset), so the next writes aren't suppressed.
+        """
+        pcmcp = pifacecommon.mcp23s17
+        for port in (pcmcp.GPIOA, pcmcp.GPIOB):
+            with self._port_locks[port]:
+                self._latches[port] = None
+
+    def _latched_pin_value(self, pin):
+        """Returns the value of an output pin from its known latch."""
+        value = (self._latches[pin.address] >> pin.bit_num) & 1
+        if isinstance(pin, pifacecommon.mcp23s17.MCP23S17RegisterBitNeg):
+            value ^= 1
+        return value
+
+    def read_input_event(self):
+        """Returns an :class:`InputEvent` for the interrupt flagged on the
+        input port, or ``None`` if there isn't one. INTFB, INTCAPA and
+        INTCAPB are read in one sequential transfer, which also clears the
+        interrupt.
+        """
+        pcmcp = pifacecommon.mcp23s17
+        interrupt_flag, _, interrupt_capture = self.read_registers(
+            pcmcp.INTFB, pcmcp.INTCAPB - pcmcp.INTFB + 1)
+        if interrupt_flag == 0:
+            return None
+        return InputEvent(
+            interrupt_flag, interrupt_capture, self, time.time())
+
+    def _not_detected_error(self):
+        return NoPiFaceRelayPlusDetectedError(
+            "No PiFace Relay Plus board detected (hardware_addr={h}, "
+            "bus={b}, chip_select={c}).".format(h=self.hardware_addr,
+                                                b=self.bus,
+                                                c=self.chip_select))
+
+
+# IOCON bits which say a chip is there and answering to its address
+_IOCON_PROBE_MASK = (pifacecommon.mcp23s17.BANK_ON |
+                     pifacecommon.mcp23s17.HAEN_ON)
+
+
+def _spi_control_byte(hardware_addr, read_write_cmd):
+    return 0x40 | ((hardware_addr & 7) << 1) | read_write_cmd
+
+
+def detect_boards(bus=DEFAULT_SPI_BUS,
+                  chip_select=DEFAULT_SPI_CHIP_SELECT,
+                  hardware_addrs=range(MAX_BOARDS),
+                  spi=None):
+    """Returns the hardware addresses which have a board.
+
+    Chips ignore their address pins until hardware addressing is switched
+    on, so IOCON is written once to address 0 (which every unconfigured
+    chip answers to) and then read back from each address. Chips which
+    already had hardware addressing on keep the rest of their old
+    configuration, so only the BANK and HAEN bits are checked (boards are
+    fully configured by :meth:`PiFaceRelayPlus.init_board`).
+
+    >>> pifacerelayplus.detect_boards()
+    [0, 1, 3]
+    """
+    pcmcp = pifacecommon.mcp23s17
+    device = spi
+    if device is None:
+        device = pifacecommon.spi.SPIDevice(bus, chip_select)
+    try:
+        device.spisend(bytes((_spi_control_byte(0, pcmcp.WRITE_CMD),
+                              pcmcp.IOCON,
+                              IOCONFIG)))
+        found = []
+        for hardware_addr in hardware_addrs:
+            ctrl_byte = _spi_control_byte(hardware_addr, pcmcp.READ_CMD)
+            iocon = device.spisend(bytes((ctrl_byte, pcmcp.IOCON, 0)))[2]
+            if iocon & _IOCON_PROBE_MASK == IOCONFIG & _IOCON_PROBE_MASK:
+                found.append(hardware_addr)
+        return found
+    finally:
+        if spi is None:
+            device.close_fd()
+
+
+# the pins flagged by each value of an interrupt flag register
+_FLAGGED_PINS = tuple(tuple(pin_num for pin_num in range(8)
+                            if flag & (1 << pin_num))
+                      for flag in range(256))
+
+
+class InputEvent(collections.namedtuple('InputEvent',
+                                        ['interrupt_flag',
+                                         'interrupt_capture',
+                                         'chip',
+                                         'timestamp',
+                                         'pin_num',
+                                         'direction',
+                                         'changed_pins',
+                                         'x_port',
+                                         'y_port',
+                                         'button_port'])):
+    """An interrupt event from the input port (GPIOB), decoded when it is
+    read. ``changed_pins`` are the flagged pins (``pin_num`` is the lowest)
+    and the X-port, Y-port and button nibbles are the input port as it was
+    captured when the interrupt happened, so callbacks don't need to read
+    the board again. Ports that the plus board does not have are ``None``.
+
+    >>> event = pifacerelayplus.InputEvent(0x10, 0xef, pfrp, time.time())
+    >>> event.pin_num, event.direction, event.x_port
+    (4, 0, 1)
+    """
+    __slots__ = ()
+
+    def __new__(cls, interrupt_flag, interrupt_capture, chip, timestamp):
+        changed_pins = _FLAGGED_PINS[interrupt_flag]
+        if changed_pins:
+            pin_num = changed_pins[0]
+            direction = (interrupt_capture >> pin_num) & 1
+        else:
+            pin_num = direction = None
+        lower_nibble = 0xf ^ (interrupt_capture & 0x0f)
+        plus_board = chip.plus_board
+        return super(InputEvent, cls).__new__(
+            cls, interrupt_flag, interrupt_capture, chip, timestamp,
+            pin_num, direction, changed_pins,
+            0xf ^ (interrupt_capture >> 4),
+            lower_nibble if plus_board == RELAY else None,
+            lower_nibble if plus_board == BUTTON else None)
+
+    def __str__(self):
+        s = "interrupt_flag:    {flag}\n" \
+            "interrupt_capture: {capture}\n" \
+            "pin_num:           {pin_num}\n" \
+            "direction:         {direction}\n" \
+            "chip:              {chip}\n" \
+            "timestamp:         {timestamp}"
+        return s.format(flag=bin(self.interrupt_flag),
+                        capture=bin(self.interrupt_capture),
+                        pin_num=self.pin_num,
+                        direction=self.direction,
+                        chip=self.chip,
+                        timestamp=self.timestamp)
+
+    def __getnewargs__(self):
+        return tuple(self)[:4]
+
+
+class PiFaceRelayPlusBus(object):
+    """Every PiFace Relay Plus on one SPI bus/chip select. The boards share
+    one interrupt line, so when it fires :meth:`read_interrupts` works out
+    which board(s) caused it.
+
+    Boards are found with :func:`detect_boards` (one IOCON read per
+    hardware address) and only those are set up. Every board shares one
+    SPI file descriptor, which :meth:`close` closes.
+
+    :param plus_boards: The plus board of every board, or a dict mapping
+        hardware addresses to plus boards.
+    :param hardware_addrs: The hardware addresses to probe.
+    :param spi: SPI backend to share instead of opening
+        ``/dev/spidev<bus>.<chip_select>``.
+
+    >>> boards = pifacerelayplus.PiFaceRelayPlusBus(pifacerelayplus.RELAY)
+    >>> [board.hardware_addr for board in boards]
+    [0, 1, 3]
+    >>> boards[3].relays[0].turn_on()
+    """
+
+    def __init__(self,
+                 plus_boards=None,
+                 bus=DEFAULT_SPI_BUS,
+                 chip_select=DEFAULT_SPI_CHIP_SELECT,
+                 hardware_addrs=range(MAX_BOARDS),
+                 init_board=True,
+                 spi=None,
+                 **board_kwargs):
+        self.bus = bus
+        self.chip_select = chip_select
+        self.boards = collections.OrderedDict()
+        # most recently interrupting board first
+        self._interrupt_order = []
+        self._own_spi = spi is None
+        if spi is None:
+            spi = pifacecommon.spi.SPIDevice(bus, chip_select)
+        self.spi = spi
+
+        if init_board:
+            hardware_addrs = detect_boards(hardware_addrs=hardware_addrs,
+                                           spi=spi)
+        for hardware_addr in hardware_addrs:
+            if isinstance(plus_boards, dict):
+                plus_board = plus_boards.get(hardware_addr)
+            else:
+                plus_board = plus_boards
+            board = PiFaceRelayPlus(plus_board=plus_board,
+                                    hardware_addr=hardware_addr,
+                                    bus=bus,
+                                    chip_select=chip_select,
+                                    init_board=False,
+                                    spi=spi,
+                                    **board_kwargs)
+            if init_board:
+                board.init_board(board.gpioa_conf, board.gpiob_conf)
+            self.boards[hardware_addr] = board
+            self._interrupt_order.append(board)
+
+    def close(self):
+        """Closes the shared SPI file descriptor (if the bus opened it)."""
+        if self._own_spi and self.spi is not None:
+            self.spi.close_fd()
+            self.spi = None
+
+    def __getitem__(self, hardware_addr):
+        return self.boards[hardware_addr]
+
+    def __iter__(self):
+        return iter(self.boards.values())
+
+    def __len__(self):
+        return len(self.boards)
+
+    def read_interrupts(self, line_asserted=None):
+        """Returns an :class:`InputEvent` for every board that has flagged
+        an interrupt on its input port. Reading the capture register clears
+        the interrupt on that board.
+
+        Boards are checked most recently interrupting first. If
+        ``line_asserted`` is given it is called after each interrupting
+        board has been cleared; once it returns ``False`` no other board
+        can be holding the line and the remaining boards are not read. If
+        the line is still asserted after every board has been read (a board
+        flagged another interrupt meanwhile) the boards are read again, up
+        to :data:`MAX_INTERRUPT_PASSES` times, as the line only interrupts
+        on its falling edge. If it returns ``None`` (level unknown) every
+        board is read once.
+
+        :param line_asserted: Returns whether the interrupt line is still
+            asserted.
+        :type line_asserted: function
+        """
+        events = []
+        for _ in range(MAX_INTERRUPT_PASSES):
+            flagged = False
+            for board in list(self._interrupt_order):
+                event = board.read_input_event()
+                if event is None:
+                    continue
+                flagged = True
+                events.append(event)
+                self._interrupt_order.remove(board)
+                self._interrupt_order.insert(0, board)
+                if line_asserted is not None and line_asserted() is False:
+                    return events
+            if (not flagged or line_asserted is None or
+                    line_asserted() is not True):
+                break
+        return events
+
 
 class InputEventListener(pifacecommon.interrupts.PortEventListener):
     """Listens for events on the input port and calls the mapped callback
@@ -299,7 +1502,113 @@ class InputEventListener(pifacecommon.interrupts.PortEventListener):
     >>> listener = pifacerelayplus.InputEventListener()
     >>> listener.register(0, pifacerelayplus.IODIR_ON, print_flag)
     >>> listener.activate()
+
+    Give it a :class:`pifacerelayplus.debounce.Debouncer` to filter contact
+    bounce on the board instead of using settle times.
     """
-    def __init__(self, chip):
+    def __init__(self, chip, return_after_kbdint=True, debouncer=None):
         super(InputEventListener, self).__init__(pifacecommon.mcp23s17.GPIOB,
-                                                 chip)
+                                                 chip,
+                                                 return_after_kbdint)
+        self.debouncer = debouncer
+        # read events in one burst and decode them in this process
+        self.event_queue = _InputEventQueue(self.pin_function_maps, chip,
+                                            debouncer is not None)
+        self.detector = multiprocessing.Process(
+            target=_watch_input_events,
+            args=(chip, self.event_queue, return_after_kbdint))
+        if debouncer is None:
+            self.dispatcher = threading.Thread(
+                target=pifacecommon.interrupts.handle_events,
+                args=(self.pin_function_maps,
+                      self.event_queue,
+                      pifacecommon.interrupts._event_matches_pin_function_map,
+                      self.TERMINATE_SIGNAL))
+        else:
+            self.dispatcher = threading.Thread(
+                target=self._handle_debounced_events)
+
+    def activate(self):
+        if self.debouncer is not None:
+            self.debouncer.start(self)
+        super(InputEventListener, self).activate()
+
+    def deactivate(self):
+        super(InputEventListener, self).deactivate()
+        if self.debouncer is not None:
+            self.debouncer.stop()
+
+    def dispatch(self, event):
+        """Calls the callbacks matching an event passed on by the
+        debouncer.
+        """
+        for pin_function_map in self.pin_function_maps:
+            if pifacecommon.interrupts._event_matches_pin_function_map(
+                    event, pin_function_map):
+                pin_function_map.callback(event)
+
+    def _handle_debounced_events(self):
+        while True:
+            event = self.event_queue.get()
+            if event == self.TERMINATE_SIGNAL:
+                return
+            self.debouncer.process(event)
+
+
+class _InputEventQueue(pifacecommon.interrupts.EventQueue):
+    """Sends events from the detector process as (interrupt_flag,
+    interrupt_capture, timestamp) and rebuilds them around the listening
+    process's chip.
+    """
+
+    def __init__(self, pin_function_maps, chip, debounced=False):
+        super(_InputEventQueue, self).__init__(pin_function_maps)
+        self.chip = chip
+        self.debounced = debounced
+
+    def add_event(self, event):
+        if self.debounced:
+            self.put(event)  # the debouncer sees every edge, not settle times
+        else:
+            super(_InputEventQueue, self).add_event(event)
+
+    def put(self, thing):
+        if isinstance(thing, InputEvent):
+            thing = (thing.interrupt_flag,
+                     thing.interrupt_capture,
+                     thing.timestamp)
+        super(_InputEventQueue, self).put(thing)
+
+    def get(self):
+        thing = super(_InputEventQueue, self).get()
+        if isinstance(thing, tuple):
+            interrupt_flag, interrupt_capture, timestamp = thing
+            thing = InputEvent(
+                interrupt_flag, interrupt_capture, self.chip, timestamp)
+        return thing
+
+
+def _watch_input_events(chip, event_queue, return_after_kbdint=False):
+    """Waits for input events on chip and adds them to the event queue (see
+    :func:`pifacecommon.interrupts.watch_port_events`).
+    """
+    gpio25 = open(pifacecommon.interrupts.GPIO_INTERRUPT_DEVICE_VALUE, 'r')
+    epoll = select.epoll()
+    epoll.register(gpio25, select.EPOLLIN | select.EPOLLET)
+    try:
+        while True:
+            try:
+                epoll.poll()
+            except KeyboardInterrupt:
+                if return_after_kbdint:
+                    return
+                raise
+            except InterruptedError:
+                pass
+
+            event = chip.read_input_event()
+            if event is not None:
+                event_queue.add_event(event)
+    finally:
+        epoll.close()
+        gpio25.close()
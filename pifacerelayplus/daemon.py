@@ -0,0 +1,585 @@
+"""A daemon which owns the SPI bus so that several processes can share
+PiFace Relay Plus boards.
+
+The daemon is the only process that talks to the boards, so there is one
+copy of the output latches, the motor states and the motor inrush budget.
+It publishes the state of every board in a small memory-mapped file which
+clients read without any system calls, and takes commands over a Unix
+socket::
+
+    $ python3 -m pifacerelayplus.daemon --plus-board relay
+
+Clients have the same ``relays``/``relay_port``/``x_pins``/``motors`` API as
+:class:`pifacerelayplus.PiFaceRelayPlus`:
+
+>>> pfrp = pifacerelayplus.daemon.BoardClient(hardware_addr=0)
+>>> pfrp.relays[3].turn_on()
+>>> pfrp.x_pins[0].value
+0
+
+Commands made inside :meth:`BoardClient.batch` are sent as one message and
+written to the board with at most one SPI write per GPIO register:
+
+>>> with pfrp.batch():
+...     pfrp.relays[0].turn_on()
+...     pfrp.motors[2].forward()
+...
+
+Each message is a line of JSON holding a list of commands (see
+:data:`COMMANDS`), and each reply is a line of JSON: ``{"ok": true}`` or
+the error raised by the failing command (commands before it are still
+applied).
+
+The state file is a header (``MAGIC``, ``VERSION``, a sequence number)
+followed by a record for each hardware address: present, plus board,
+GPIOA, GPIOB and the state of each motor. The sequence number is odd
+while the daemon is writing, so readers retry until they see the same
+even number before and after reading a record. A reader that keeps
+seeing an odd number for :data:`STALE_STATE_TIMEOUT` seconds (the daemon
+died while writing) raises :class:`StaleStateError`.
+
+The socket is created with :data:`SOCKET_MODE` and the state file with
+:data:`STATE_MODE`, so only the daemon's user and group can use them.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import mmap
+import os
+import socket
+import struct
+import threading
+import time
+import pifacecommon.mcp23s17
+import pifacerelayplus
+from .core import (
+    LAYOUTS,
+    MAX_BOARDS,
+    MotorForwardReverseError,
+    MotorTooSoonError,
+)
+
+
+DEFAULT_SOCKET_PATH = '/run/pifacerelayplus.sock'
+DEFAULT_STATE_PATH = '/dev/shm/pifacerelayplus'
+DEFAULT_POLL_INTERVAL = 0.01  # seconds
+STALE_STATE_TIMEOUT = 1.0  # seconds
+STATE_READ_RETRY_INTERVAL = 0.0005  # seconds
+SOCKET_MODE = 0o660
+STATE_MODE = 0o640
+
+MAGIC = b'PFRD'
+VERSION = 1
+HEADER_SIZE = 16
+RECORD_SIZE = 8
+STATE_SIZE = HEADER_SIZE + RECORD_SIZE * MAX_BOARDS
+_SEQUENCE = struct.Struct('<I')
+_SEQUENCE_OFFSET = 8
+# record: present, plus board, GPIOA, GPIOB, motor 0 to 3
+_RECORD = struct.Struct('8B')
+_NO_PLUS_BOARD = 0xff
+MOTOR_STATES = (None, 'coast', 'reverse', 'forward', 'brake')
+
+COMMANDS = {
+    # [name, hardware_addr, *args]
+    'set': "group ('relays' or 'leds'), index, value",
+    'toggle': "group, index",
+    'port': "port ('relay_port' or 'led_port'), value",
+    'relays': "values (list or bit mask), like set_relays",
+    'leds': "values, like set_leds",
+    'motor': "index, state ('forward', 'reverse', 'brake' or 'coast')",
+    'motors': "states, like set_motors",
+}
+_GROUPS = ('relays', 'leds')
+_PORTS = ('relay_port', 'led_port')
+
+
+class DaemonError(Exception):
+    """The daemon could not carry out a command."""
+    pass
+
+
+class StaleStateError(DaemonError):
+    """The state file was left half written."""
+    pass
+
+
+_ERRORS = dict((error.__name__, error)
+               for error in (MotorForwardReverseError, MotorTooSoonError,
+                             ValueError, IndexError, TypeError,
+                             AttributeError, DaemonError))
+
+
+def _remote_error(name, message):
+    """Returns the exception raised in the daemon."""
+    error_class = _ERRORS.get(name, DaemonError)
+    error = error_class.__new__(error_class)
+    Exception.__init__(error, message)
+    return error
+
+
+def _command_board(boards, command):
+    """Returns the board a command is for."""
+    try:
+        return boards[command[1]]
+    except (KeyError, IndexError, TypeError):
+        raise DaemonError("No board for command `{}`.".format(command))
+
+
+def _run_command(board, command):
+    """Carries out one command on its board."""
+    name, args = command[0], command[2:]
+    if name == 'set' and args[0] in _GROUPS:
+        getattr(board, args[0])[args[1]].value = args[2]
+    elif name == 'toggle' and args[0] in _GROUPS:
+        getattr(board, args[0])[args[1]].toggle()
+    elif name == 'port' and args[0] in _PORTS:
+        getattr(board, args[0]).value = args[1]
+    elif name == 'relays':
+        board.set_relays(args[0])
+    elif name == 'leds':
+        board.set_leds(args[0])
+    elif name == 'motor' and args[1] in MOTOR_STATES[1:]:
+        getattr(board.motors[args[0]], args[1])()
+    elif name == 'motors':
+        board.set_motors(args[0])
+    else:
+        raise DaemonError("Unknown command `{}`.".format(command))
+
+
+class StateFile(object):
+    """The memory-mapped state of every board, written by the daemon
+    (``writable=True``) and read by clients.
+
+    :param timeout: How long readers wait for a write to finish before
+        raising :class:`StaleStateError` (seconds).
+    """
+
+    def __init__(self, path=DEFAULT_STATE_PATH, writable=False,
+                 timeout=STALE_STATE_TIMEOUT):
+        self.path = path
+        self.timeout = timeout
+        if writable:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, STATE_MODE)
+            try:
+                # the file may be left over with other permissions
+                os.fchmod(fd, STATE_MODE)
+                os.ftruncate(fd, STATE_SIZE)
+                self._mmap = mmap.mmap(fd, STATE_SIZE)
+            finally:
+                os.close(fd)
+            self._mmap[:] = bytes(STATE_SIZE)
+            self._mmap[:len(MAGIC) + 1] = MAGIC + bytes((VERSION,))
+        else:
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                self._mmap = mmap.mmap(fd, STATE_SIZE,
+                                       prot=mmap.PROT_READ)
+            finally:
+                os.close(fd)
+            if self._mmap[:len(MAGIC) + 1] != MAGIC + bytes((VERSION,)):
+                raise DaemonError("{} is not a board state file.".format(
+                    path))
+        self._sequence = 0
+
+    def _offset(self, hardware_addr):
+        return HEADER_SIZE + RECORD_SIZE * hardware_addr
+
+    def write(self, records):
+        """Publishes {hardware_addr: record} (see :func:`board_record`)."""
+        self._sequence += 1
+        _SEQUENCE.pack_into(self._mmap, _SEQUENCE_OFFSET, self._sequence)
+        for hardware_addr, record in records.items():
+            _RECORD.pack_into(self._mmap, self._offset(hardware_addr),
+                              *record)
+        self._sequence += 1
+        _SEQUENCE.pack_into(self._mmap, _SEQUENCE_OFFSET, self._sequence)
+
+    def read(self, hardware_addr):
+        """Returns the record of a board as a tuple of (present, plus board,
+        GPIOA, GPIOB, motor states...).
+        """
+        offset = self._offset(hardware_addr)
+        deadline = None
+        while True:
+            sequence = _SEQUENCE.unpack_from(self._mmap, _SEQUENCE_OFFSET)[0]
+            if not sequence & 1:
+                record = _RECORD.unpack_from(self._mmap, offset)
+                if (_SEQUENCE.unpack_from(self._mmap, _SEQUENCE_OFFSET)[0] ==
+                        sequence):
+                    return record
+            # the daemon is writing
+            now = time.monotonic()
+            if deadline is None:
+                deadline = now + self.timeout
+            elif now > deadline:
+                raise StaleStateError(
+                    "{} has been half written for {} seconds, is the "
+                    "daemon running?".format(self.path, self.timeout))
+            time.sleep(STATE_READ_RETRY_INTERVAL)
+
+    def close(self):
+        self._mmap.close()
+
+
+def board_record(board, gpiob=None):
+    """Returns the state file record of a board. GPIOB is read from the
+    board unless it is given.
+    """
+    pcmcp = pifacecommon.mcp23s17
+    if gpiob is None:
+        gpiob = board.read(pcmcp.GPIOB)
+    motors = [0] * 4
+    if board.layout.motors == 'dc':
+        for i, motor in enumerate(board.motors):
+            motors[i] = MOTOR_STATES.index(motor._current_state)
+    plus_board = board.plus_board
+    return (1,
+            _NO_PLUS_BOARD if plus_board is None else plus_board,
+            board.read(pcmcp.GPIOA),
+            gpiob,
+            *motors)
+
+
+class BoardDaemon(object):
+    """Owns ``boards`` (such as a
+    :class:`pifacerelayplus.PiFaceRelayPlusBus` created with
+    ``shadow_registers=True``), publishes their state to ``state_path``
+    and serves commands on ``socket_path``.
+
+    :param poll_interval: How often to read the inputs (seconds).
+    """
+
+    def __init__(self, boards, socket_path=DEFAULT_SOCKET_PATH,
+                 state_path=DEFAULT_STATE_PATH,
+                 poll_interval=DEFAULT_POLL_INTERVAL):
+        self.boards = dict((board.hardware_addr, board) for board in boards)
+        self.socket_path = socket_path
+        self.state_path = state_path
+        self.poll_interval = poll_interval
+        self.state = None
+        self._server = None
+        self._poller = None
+        self._inputs = {}  # hardware_addr -> last GPIOB read
+        self._writers = set()
+
+    async def start(self):
+        """Publishes the state of every board and starts serving."""
+        self.state = StateFile(self.state_path, writable=True)
+        self.poll()
+        if self.poll_interval is not None:
+            self._poller = asyncio.ensure_future(self._poll())
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)  # left over from the last run
+        self._server = await asyncio.start_unix_server(
+            self.handle_connection, self.socket_path)
+        os.chmod(self.socket_path, SOCKET_MODE)
+
+    async def serve_forever(self):
+        await self.start()
+        async with self._server:
+            await self._server.serve_forever()
+
+    def close(self):
+        if self._poller is not None:
+            self._poller.cancel()
+        for writer in self._writers:
+            writer.close()
+        if self._server is not None:
+            self._server.close()
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+        if self.state is not None:
+            self.state.close()
+            os.unlink(self.state_path)
+            self.state = None
+
+    def poll(self):
+        """Reads the inputs of every board and publishes any changes."""
+        records = {}
+        for hardware_addr, board in self.boards.items():
+            gpiob = board.read(pifacecommon.mcp23s17.GPIOB)
+            if self._inputs.get(hardware_addr) != gpiob:
+                self._inputs[hardware_addr] = gpiob
+                records[hardware_addr] = board_record(board, gpiob)
+        if records:
+            self.state.write(records)
+
+    async def _poll(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            self.poll()
+
+    def run_commands(self, commands):
+        """Carries out a list of commands with the output latch writes of
+        each board batched together, publishes the new state and returns
+        the reply.
+        """
+        changed = {}
+        reply = {'ok': True}
+        with contextlib.ExitStack() as stack:
+            for index, command in enumerate(commands):
+                try:
+                    board = _command_board(self.boards, command)
+                    if board.hardware_addr not in changed:
+                        # this board's latch writes are flushed together
+                        changed[board.hardware_addr] = board
+                        stack.enter_context(board.batch())
+                    _run_command(board, command)
+                except Exception as e:
+                    reply = {'error': type(e).__name__,
+                             'message': str(e),
+                             'index': index}
+                    break
+        records = {}
+        for hardware_addr, board in changed.items():
+            gpiob = None
+            if board.gpiob_conf['direction'] == 0xff:
+                gpiob = self._inputs.get(hardware_addr)  # all inputs
+            records[hardware_addr] = board_record(board, gpiob)
+            self._inputs[hardware_addr] = records[hardware_addr][3]
+        if records:
+            self.state.write(records)
+        return reply
+
+    async def handle_connection(self, reader, writer):
+        self._writers.add(writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    commands = json.loads(line.decode())
+                    if not isinstance(commands, list):
+                        raise ValueError("Expected a list of commands.")
+                except ValueError as e:
+                    reply = {'error': 'DaemonError', 'message': str(e)}
+                else:
+                    reply = self.run_commands(commands)
+                writer.write(json.dumps(reply).encode() + b'\n')
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+
+class _ClientPin(object):
+    """A relay, LED or input of a :class:`BoardClient`."""
+
+    def __init__(self, client, group, index):
+        self.client = client
+        self.group = group
+        self.index = index
+
+    @property
+    def value(self):
+        return self.client._channels(self.group)[self.index]
+
+    @value.setter
+    def value(self, data):
+        self.client.send(['set', self.client.hardware_addr, self.group,
+                          self.index, data])
+
+    def turn_on(self):
+        self.value = 1
+
+    def turn_off(self):
+        self.value = 0
+
+    def toggle(self):
+        self.client.send(['toggle', self.client.hardware_addr, self.group,
+                          self.index])
+
+
+class _ClientPort(object):
+    """A port of a :class:`BoardClient`."""
+
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    @property
+    def value(self):
+        return self.client._port(self.name)
+
+    @value.setter
+    def value(self, data):
+        self.client.send(['port', self.client.hardware_addr, self.name,
+                          data])
+
+
+class _ClientMotor(object):
+    """A DC motor of a :class:`BoardClient`."""
+
+    def __init__(self, client, index):
+        self.client = client
+        self.index = index
+
+    @property
+    def state(self):
+        """The state of the motor, as the daemon last published it."""
+        return MOTOR_STATES[self.client._record()[4 + self.index]]
+
+    def _command(self, state):
+        self.client.send(['motor', self.client.hardware_addr, self.index,
+                          state])
+
+    def coast(self):
+        self._command('coast')
+
+    def reverse(self):
+        self._command('reverse')
+
+    def forward(self):
+        self._command('forward')
+
+    def brake(self):
+        self._command('brake')
+
+
+class BoardClient(object):
+    """A board owned by a :class:`BoardDaemon`. Reading pins and ports
+    reads the state file; everything else is sent to the daemon.
+    """
+
+    def __init__(self, hardware_addr=0, socket_path=DEFAULT_SOCKET_PATH,
+                 state_path=DEFAULT_STATE_PATH):
+        self.hardware_addr = hardware_addr
+        self.state = StateFile(state_path)
+        present, plus_board = self._record()[:2]
+        if not present:
+            self.state.close()
+            raise DaemonError(
+                "The daemon has no board at hardware address {}.".format(
+                    hardware_addr))
+        self.plus_board = None if plus_board == _NO_PLUS_BOARD else plus_board
+        self.layout = LAYOUTS.get(self.plus_board, LAYOUTS[None])
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.connect(socket_path)
+        self._replies = self._socket.makefile('rb')
+        self._lock = threading.RLock()
+        self._batch = None
+
+        groups = self.layout.groups
+        for name in ('relays', 'x_pins', 'y_pins', 'leds', 'buttons'):
+            if name in groups:
+                setattr(self, name, [_ClientPin(self, name, i)
+                                     for i in range(len(groups[name]))])
+        for name in self.layout.ports:
+            setattr(self, name, _ClientPort(self, name))
+        if self.layout.motors == 'dc':
+            self.motors = [_ClientMotor(self, i)
+                           for i in range(len(groups['motors']) // 2)]
+
+    def _record(self):
+        return self.state.read(self.hardware_addr)
+
+    def _registers(self):
+        return self._record()[2:4]
+
+    def _channels(self, name):
+        group = self.layout.groups[name]
+        return group.values(group.decode(self._registers(),
+                                         pifacecommon.mcp23s17.GPIOA))
+
+    def _port(self, name):
+        port = self.layout.ports[name]
+        return port.decode(
+            self._registers()[port.address - pifacecommon.mcp23s17.GPIOA])
+
+    def set_relays(self, values):
+        self.send(['relays', self.hardware_addr, values])
+
+    def set_leds(self, values):
+        self.send(['leds', self.hardware_addr, values])
+
+    def set_motors(self, states):
+        self.send(['motors', self.hardware_addr, states])
+
+    def get_inputs(self):
+        values = ()
+        for name in ('x_pins', 'y_pins', 'buttons'):
+            if name in self.layout.groups:
+                values += self._channels(name)
+        return values
+
+    def send(self, *commands):
+        """Sends commands to the daemon (or adds them to the batch) and
+        raises the error of the first one that failed.
+        """
+        with self._lock:
+            if self._batch is not None:
+                self._batch.extend(commands)
+                return
+            self._send(list(commands))
+
+    def _send(self, commands):
+        self._socket.sendall(json.dumps(commands).encode() + b'\n')
+        line = self._replies.readline()
+        if not line:
+            raise DaemonError("The daemon closed the connection.")
+        reply = json.loads(line.decode())
+        if 'error' in reply:
+            raise _remote_error(reply['error'], reply['message'])
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Sends every command made inside the ``with`` block as one
+        message when the block exits.
+        """
+        with self._lock:
+            outer = self._batch is None
+            if outer:
+                self._batch = []
+            try:
+                yield self
+            finally:
+                if outer:
+                    commands, self._batch = self._batch, None
+            if outer and commands:
+                self._send(commands)
+
+    def close(self):
+        self._replies.close()
+        self._socket.close()
+        self.state.close()
+
+
+PLUS_BOARDS = {'none': None,
+               'relay': pifacerelayplus.RELAY,
+               'motor_dc': pifacerelayplus.MOTOR_DC,
+               'button': pifacerelayplus.BUTTON}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Share PiFace Relay Plus boards between processes.")
+    parser.add_argument('-p', '--plus-board', choices=sorted(PLUS_BOARDS),
+                        default='relay')
+    parser.add_argument('--socket', default=DEFAULT_SOCKET_PATH,
+                        help="Path of the command socket.")
+    parser.add_argument('--state', default=DEFAULT_STATE_PATH,
+                        help="Path of the state file.")
+    parser.add_argument('--poll-interval', type=float,
+                        default=DEFAULT_POLL_INTERVAL,
+                        help="Seconds between input reads.")
+    args = parser.parse_args(argv)
+
+    boards = pifacerelayplus.PiFaceRelayPlusBus(PLUS_BOARDS[args.plus_board],
+                                                shadow_registers=True)
+    daemon = BoardDaemon(boards, args.socket, args.state, args.poll_interval)
+    print("Serving {n}x PiFace Relay Plus on {socket}".format(
+        n=len(boards), socket=args.socket))
+    loop = asyncio.get_event_loop()
+    try:
+        loop.run_until_complete(daemon.serve_forever())
+    except KeyboardInterrupt:
+        daemon.close()
+
+
+if __name__ == '__main__':
+    main()
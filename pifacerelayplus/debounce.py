@@ -0,0 +1,234 @@
+"""Debouncing for the input port (GPIOB) of PiFace Relay Plus.
+
+A :class:`Debouncer` is given to an
+:class:`pifacerelayplus.InputEventListener` or an
+:class:`pifacerelayplus.aio.AsyncInputEventListener`. The first edge on a
+pin is passed on straight away and the pin's interrupt is then switched off
+on the board for the pin's debounce window, so contact bounce never reaches
+the Raspberry Pi. When the window ends the interrupt is switched back on
+comparing against the last passed on level (``INTCON``/``DEFVAL``), so if
+the pin settled in the other state the board interrupts again at once.
+
+>>> debouncer = pifacerelayplus.debounce.Debouncer(window=0.03)
+>>> debouncer.set_window(0, 0.1)  # a particularly bouncy button
+>>> debouncer.set_long_press(0, print, long_press=1, repeat_interval=0.2)
+>>> listener = pifacerelayplus.aio.AsyncInputEventListener(
+...     pfrp, debouncer=debouncer)
+>>> listener.register(0, pifacerelayplus.IODIR_ON, print)
+>>> listener.activate()
+"""
+import asyncio
+import collections
+import threading
+import time
+import pifacecommon.interrupts
+import pifacecommon.mcp23s17
+from .core import InputEvent
+
+
+DEFAULT_WINDOW = 0.02  # seconds
+DEFAULT_LONG_PRESS = 1.0  # seconds
+
+
+class HoldEvent(collections.namedtuple('HoldEvent',
+                                       ['chip', 'pin_num', 'repeat',
+                                        'held_time'])):
+    """A pin which has been held on (low). ``repeat`` is 0 for the long
+    press and counts up for each repeat after that.
+    """
+    __slots__ = ()
+
+
+class Debouncer(object):
+    """Filters the input events of one board.
+
+    :param window: Debounce window for every pin (seconds). Pins with a
+        window of 0 are not debounced.
+    :param mask_interrupts: Switch a pin's interrupt off on the board during
+        its window. Otherwise bounces are read and dropped in software.
+
+    :attribute: accepted -- Number of events passed on, per pin.
+    :attribute: suppressed -- Number of events dropped, per pin. Bounces
+        which happen while the pin's interrupt is switched off are never
+        seen so are not counted.
+    """
+
+    def __init__(self, window=DEFAULT_WINDOW, mask_interrupts=True):
+        self.windows = [window] * 8
+        self.mask_interrupts = mask_interrupts
+        self.accepted = [0] * 8
+        self.suppressed = [0] * 8
+        self.listener = None
+        self._holds = {}  # pin_num -> (long_press, repeat_interval, callback)
+        self._levels = [None] * 8  # last level passed on
+        self._capture = 0  # last levels seen on the port
+        self._window_handles = [None] * 8
+        self._hold_handles = [None] * 8
+        self._gpinten = self._defval = self._intcon = 0
+        self._original_gpinten = self._original_defval = 0
+        self._original_intcon = 0
+        # the threaded listener calls in from its dispatcher and timers
+        self._lock = threading.RLock()
+
+    def set_window(self, pin_num, window):
+        """Sets the debounce window (seconds) of one pin."""
+        self.windows[pin_num] = window
+
+    def set_long_press(self, pin_num, callback,
+                       long_press=DEFAULT_LONG_PRESS, repeat_interval=None):
+        """Calls ``callback`` with a :class:`HoldEvent` once the pin has been
+        held on for ``long_press`` seconds and then every
+        ``repeat_interval`` seconds (if given) until it is released.
+        Callbacks may be coroutine functions when the listener is an
+        :class:`pifacerelayplus.aio.AsyncInputEventListener`.
+        """
+        self._holds[pin_num] = (long_press, repeat_interval, callback)
+
+    def start(self, listener):
+        """Starts filtering the events of listener (called on
+        activation).
+        """
+        pcmcp = pifacecommon.mcp23s17
+        self.listener = listener
+        chip = listener.chip
+        gpinten, _, defval, _, intcon = chip.read_registers(pcmcp.GPINTENB, 5)
+        levels = chip.read(pcmcp.GPIOB)
+        self._capture = levels
+        self._levels = [(levels >> i) & 1 for i in range(8)]
+        self._gpinten = gpinten
+        self._original_gpinten = gpinten
+        self._original_defval = defval
+        self._original_intcon = intcon
+        if self.mask_interrupts:
+            debounced = sum(1 << i for i in range(8) if self.windows[i] > 0)
+            self._defval = (defval & ~debounced) | (levels & debounced)
+            self._intcon = intcon | debounced
+            chip.write(self._defval, pcmcp.DEFVALB)
+            chip.write(self._intcon, pcmcp.INTCONB)
+
+    def stop(self):
+        """Stops filtering and puts the interrupt registers back as they
+        were when it started, even if a window is still open.
+        """
+        pcmcp = pifacecommon.mcp23s17
+        with self._lock:
+            for handles in (self._window_handles, self._hold_handles):
+                for pin_num, handle in enumerate(handles):
+                    if handle is not None:
+                        handle.cancel()
+                        handles[pin_num] = None
+            if self.mask_interrupts and self.listener is not None:
+                chip = self.listener.chip
+                chip.write(self._original_defval, pcmcp.DEFVALB)
+                chip.write(self._original_intcon, pcmcp.INTCONB)
+                chip.write(self._original_gpinten, pcmcp.GPINTENB)
+            self.listener = None
+
+    def process(self, event):
+        """Passes the event on to the listener unless it is a bounce. Each
+        pin flagged in the event is filtered on its own.
+        """
+        with self._lock:
+            if self.listener is None:
+                return
+            self._capture = event.interrupt_capture
+            if len(event.changed_pins) == 1:
+                pin_events = [event]
+            else:
+                pin_events = [InputEvent(1 << pin_num,
+                                         event.interrupt_capture,
+                                         event.chip,
+                                         event.timestamp)
+                              for pin_num in event.changed_pins]
+            masked = 0
+            for pin_event in pin_events:
+                masked |= self._process_pin(pin_event)
+            if masked:
+                # one write for every pin opening a window
+                self._gpinten &= ~masked
+                event.chip.write(self._gpinten,
+                                 pifacecommon.mcp23s17.GPINTENB)
+
+    def _process_pin(self, event):
+        """Filters the event of one pin and returns the pin's bit if its
+        interrupt should be switched off for a window.
+        """
+        pin_num = event.pin_num
+        window = self.windows[pin_num]
+        if window <= 0:
+            self._accept(event)
+            return 0
+        if (self._window_handles[pin_num] is not None or
+                event.direction == self._levels[pin_num]):
+            self.suppressed[pin_num] += 1
+            return 0
+        self._accept(event)
+        self._window_handles[pin_num] = self._call_later(
+            window, self._end_window, pin_num)
+        return (1 << pin_num) if self.mask_interrupts else 0
+
+    def _call_later(self, delay, callback, *args):
+        """Schedules callback on the listener's event loop or, for the
+        threaded listener, on a timer thread.
+        """
+        loop = getattr(self.listener, 'loop', None)
+        if loop is not None:
+            return loop.call_later(delay, callback, *args)
+        timer = threading.Timer(delay, self._timer_expired,
+                                (callback,) + args)
+        timer.daemon = True
+        timer.start()
+        return timer
+
+    def _timer_expired(self, callback, *args):
+        with self._lock:
+            if self.listener is not None:  # not stopped meanwhile
+                callback(*args)
+
+    def _accept(self, event):
+        pin_num = event.pin_num
+        self._levels[pin_num] = event.direction
+        self.accepted[pin_num] += 1
+        if self._hold_handles[pin_num] is not None:
+            self._hold_handles[pin_num].cancel()
+            self._hold_handles[pin_num] = None
+        if (event.direction == pifacecommon.interrupts.IODIR_ON and
+                pin_num in self._holds):
+            self._hold_handles[pin_num] = self._call_later(
+                self._holds[pin_num][0], self._hold, event.chip, pin_num, 0,
+                event.timestamp)
+        self.listener.dispatch(event)
+
+    def _end_window(self, pin_num):
+        self._window_handles[pin_num] = None
+        bit = 1 << pin_num
+        if self.mask_interrupts:
+            # the board interrupts straight away if the pin has changed
+            chip = self.listener.chip
+            self._defval = ((self._defval & ~bit) |
+                            (self._levels[pin_num] << pin_num))
+            chip.write(self._defval, pifacecommon.mcp23s17.DEFVALB)
+            self._gpinten |= bit
+            chip.write(self._gpinten, pifacecommon.mcp23s17.GPINTENB)
+        else:
+            # the last capture can be older than the last bounce (edges
+            # aren't captured while an interrupt is pending), so read the pin
+            chip = self.listener.chip
+            self._capture = chip.read(pifacecommon.mcp23s17.GPIOB)
+            if (self._capture >> pin_num) & 1 != self._levels[pin_num]:
+                # settled in the other state during the window
+                self._accept(InputEvent(bit, self._capture, chip,
+                                        time.time()))
+
+    def _hold(self, chip, pin_num, repeat, pressed_time):
+        self._hold_handles[pin_num] = None
+        long_press, repeat_interval, callback = self._holds[pin_num]
+        event = HoldEvent(chip, pin_num, repeat, time.time() - pressed_time)
+        if repeat_interval is not None:
+            self._hold_handles[pin_num] = self._call_later(
+                repeat_interval, self._hold, chip, pin_num, repeat + 1,
+                pressed_time)
+        if asyncio.iscoroutinefunction(callback):
+            self.listener.loop.create_task(callback(event))
+        else:
+            callback(event)
@@ -0,0 +1,91 @@
+"""A small memory-mapped file holding the last values written to the output
+latches of each board, for warm restarts.
+
+>>> journal = pifacerelayplus.journal.StateJournal('/var/lib/pfrp.journal')
+>>> pfrp = pifacerelayplus.PiFaceRelayPlus(pifacerelayplus.RELAY,
+...                                        journal=journal, warm_start=True)
+
+Every output latch write (relays, LEDs and motors) is recorded in the
+journal. On a warm start the board is only written to where it differs
+from the journal, so outputs that are already right don't glitch. Motor
+states are worked out from the restored latches.
+
+Writes go to the page cache, so the journal survives the process being
+killed; call :meth:`StateJournal.flush` to also survive a power cut.
+"""
+import mmap
+import os
+import pifacecommon.mcp23s17
+from .core import MAX_BOARDS
+
+
+MAGIC = b'PFRJ'
+VERSION = 1
+HEADER_SIZE = 8
+RECORD_SIZE = 4
+JOURNAL_SIZE = HEADER_SIZE + RECORD_SIZE * MAX_BOARDS
+
+# record: flags, plus board, OLATA, OLATB
+_FLAGS, _PLUS_BOARD, _OLATA, _OLATB = range(RECORD_SIZE)
+_PORT_OFFSETS = {pifacecommon.mcp23s17.GPIOA: _OLATA,
+                 pifacecommon.mcp23s17.GPIOB: _OLATB}
+_PORT_FLAGS = {pifacecommon.mcp23s17.GPIOA: 0x1,
+               pifacecommon.mcp23s17.GPIOB: 0x2}
+_NO_PLUS_BOARD = 0xff
+
+
+class StateJournal(object):
+    """The journal file at ``path`` (created if it doesn't exist or isn't
+    a journal).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size != JOURNAL_SIZE:
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, JOURNAL_SIZE)
+            self._mmap = mmap.mmap(fd, JOURNAL_SIZE)
+        finally:
+            os.close(fd)
+        if self._mmap[:len(MAGIC) + 1] != MAGIC + bytes((VERSION,)):
+            self._mmap[:] = bytes(JOURNAL_SIZE)
+            self._mmap[:len(MAGIC) + 1] = MAGIC + bytes((VERSION,))
+
+    def _offset(self, hardware_addr):
+        return HEADER_SIZE + RECORD_SIZE * hardware_addr
+
+    def record(self, hardware_addr, plus_board, port, value):
+        """Records value being written to the output latch of port."""
+        offset = self._offset(hardware_addr)
+        plus_board = _NO_PLUS_BOARD if plus_board is None else plus_board
+        if self._mmap[offset + _PLUS_BOARD] != plus_board:
+            # a different plus board, forget the old one
+            self._mmap[offset + _FLAGS] = 0
+            self._mmap[offset + _PLUS_BOARD] = plus_board
+        self._mmap[offset + _PORT_OFFSETS[port]] = value
+        self._mmap[offset + _FLAGS] |= _PORT_FLAGS[port]
+
+    def latches(self, hardware_addr, plus_board):
+        """Returns {port: value} of the recorded output latches of a board
+        (empty if nothing is recorded for this plus board).
+        """
+        offset = self._offset(hardware_addr)
+        plus_board = _NO_PLUS_BOARD if plus_board is None else plus_board
+        if self._mmap[offset + _PLUS_BOARD] != plus_board:
+            return {}
+        flags = self._mmap[offset + _FLAGS]
+        return dict((port, self._mmap[offset + _PORT_OFFSETS[port]])
+                    for port, flag in _PORT_FLAGS.items() if flags & flag)
+
+    def clear(self, hardware_addr):
+        """Forgets what is recorded for a board."""
+        self._mmap[self._offset(hardware_addr) + _FLAGS] = 0
+
+    def flush(self):
+        """Writes the journal to disk."""
+        self._mmap.flush()
+
+    def close(self):
+        self._mmap.close()
@@ -0,0 +1,217 @@
+"""Declarative pin maps for the PiFace Relay Plus plus boards.
+
+A plus board is described by a :class:`BoardLayout`: named groups of
+logical channels (relays, x-pins, motor pins...) and named ports. Each
+channel is a bit of a GPIO register, inverted if the channel is on when
+the pin is low. The register masks and inversion (XOR) masks of each group
+are worked out up front, along with lookup tables, so a whole group is
+converted between a channel vector (channel ``i`` is bit ``i``) and raw
+register values with one table lookup per register.
+
+>>> layout = pifacerelayplus.LAYOUTS[pifacerelayplus.RELAY]
+>>> relays = layout.groups['relays']
+>>> relays.masks
+{18: 255}
+>>> relays.encode(0b00000001)  # relay 0 is GPIOA bit 3
+{18: (255, 8)}
+>>> relays.decode({18: 0x08})
+1
+
+The layouts of the plus boards are in :data:`pifacerelayplus.LAYOUTS`;
+adding a plus board is adding an entry.
+"""
+import collections
+
+
+MAX_CHANNELS = 8
+# mask -> shift of the ports which can be read and written as one value
+_PORT_MASKS = {0x0f: 0, 0xf0: 4, 0xff: 0}
+
+
+def _table(size, bits):
+    """Returns a lookup table mapping each value below size to the OR of
+    ``bits[i]`` for every bit ``i`` set in it.
+    """
+    table = [0] * size
+    for value in range(1, size):
+        lowest = value & -value
+        table[value] = (table[value ^ lowest] |
+                        bits.get(lowest.bit_length() - 1, 0))
+    return tuple(table)
+
+
+_VALUES = {}
+
+
+def _values(num_channels):
+    """Returns a table mapping each channel vector to its channel values
+    (shared by every group with the same number of channels).
+    """
+    if num_channels not in _VALUES:
+        _VALUES[num_channels] = tuple(
+            tuple((vector >> i) & 1 for i in range(num_channels))
+            for vector in range(1 << num_channels))
+    return _VALUES[num_channels]
+
+
+class Channel(collections.namedtuple('Channel',
+                                     ['address', 'bit_num', 'inverted'])):
+    """One bit of a GPIO register. Inverted channels are on when the pin is
+    low.
+    """
+    __slots__ = ()
+
+    @property
+    def mask(self):
+        return 1 << self.bit_num
+
+
+class Port(collections.namedtuple('Port', ['address', 'mask', 'inverted'])):
+    """A nibble (``mask`` 0x0f or 0xf0) or the whole (0xff) of a GPIO
+    register, read and written as one value.
+    """
+    __slots__ = ()
+
+    def decode(self, register_value):
+        """Returns the port value from the raw register value."""
+        value = (register_value & self.mask) >> _PORT_MASKS[self.mask]
+        if self.inverted:
+            value ^= self.mask >> _PORT_MASKS[self.mask]
+        return value
+
+    def encode(self, value):
+        """Returns (mask, bits) of the register for the port value."""
+        bits = (value << _PORT_MASKS[self.mask]) & self.mask
+        if self.inverted:
+            bits ^= self.mask
+        return self.mask, bits
+
+
+class ChannelGroup(object):
+    """An ordered group of up to :data:`MAX_CHANNELS` channels, which may be
+    spread over several registers.
+
+    :attribute: masks -- {register address: bits used by the group}.
+    :attribute: xor_masks -- {register address: inverted bits}.
+    """
+
+    def __init__(self, channels):
+        self.channels = tuple(Channel(*channel) for channel in channels)
+        if len(self.channels) > MAX_CHANNELS:
+            raise ValueError(
+                "A channel group can have at most {} channels.".format(
+                    MAX_CHANNELS))
+        self.vector_mask = (1 << len(self.channels)) - 1
+        self.masks = {}
+        self.xor_masks = {}
+        for channel in self.channels:
+            self.masks[channel.address] = (
+                self.masks.get(channel.address, 0) | channel.mask)
+            self.xor_masks[channel.address] = (
+                self.xor_masks.get(channel.address, 0) |
+                (channel.mask if channel.inverted else 0))
+
+        vectors = range(self.vector_mask + 1)
+        # per register: channel vector -> bits, and bits -> channel vector
+        self._encoders = []
+        self._decoders = []
+        for address in self.masks:
+            members = [(i, channel.bit_num)
+                       for i, channel in enumerate(self.channels)
+                       if channel.address == address]
+            encode = _table(len(vectors), dict(
+                (i, 1 << bit_num) for i, bit_num in members))
+            decode = _table(256, dict(
+                (bit_num, 1 << i) for i, bit_num in members))
+            self._encoders.append((address, encode,
+                                   self.xor_masks[address]))
+            self._decoders.append((address, decode,
+                                   self.xor_masks[address]))
+        self._values = _values(len(self.channels))
+
+    def __len__(self):
+        return len(self.channels)
+
+    def encode(self, vector, channels=None):
+        """Returns {register address: (mask, bits)} which set the channels
+        to vector. Only the channels in the ``channels`` vector are set
+        (default: all of them).
+        """
+        if channels is None:
+            channels = self.vector_mask
+        else:
+            channels &= self.vector_mask
+        vector &= channels
+        writes = {}
+        for address, encode, xor_mask in self._encoders:
+            mask = encode[channels]
+            if mask:
+                writes[address] = (mask, (encode[vector] ^ xor_mask) & mask)
+        return writes
+
+    def decode(self, registers, offset=0):
+        """Returns the channel vector from raw register values, where
+        ``registers[address - offset]`` is the value of each register.
+        """
+        vector = 0
+        for address, decode, xor_mask in self._decoders:
+            vector |= decode[registers[address - offset] ^ xor_mask]
+        return vector
+
+    def vector(self, values):
+        """Returns (vector, channels) for a sequence of channel values
+        (which may be shorter than the group).
+        """
+        if len(values) > len(self.channels):
+            raise ValueError(
+                "Too many values ({}) for {} channels.".format(
+                    len(values), len(self.channels)))
+        vector = 0
+        for i, value in enumerate(values):
+            if value:
+                vector |= 1 << i
+        return vector, (1 << len(values)) - 1
+
+    def values(self, vector):
+        """Returns the channel values of vector as a tuple of 0s and 1s."""
+        return self._values[vector & self.vector_mask]
+
+
+class BoardLayout(object):
+    """The pins of a plus board.
+
+    :param groups: {name: [(register address, bit number, inverted)]} of
+        the channel groups.
+    :param ports: {name: (register address, mask, inverted)} of the ports.
+    :param gpioa_conf: GPIOA configuration (value, direction and pullup).
+    :param gpiob_conf: GPIOB configuration.
+    :param motors: ``'dc'`` if the ``motors`` group is (pin1, pin2) of
+        each DC motor, ``'stepper'`` if it is 4 pins per stepper motor.
+    """
+
+    def __init__(self, groups, ports, gpioa_conf, gpiob_conf, motors=None):
+        self.groups = collections.OrderedDict(
+            (name, ChannelGroup(channels))
+            for name, channels in groups.items())
+        self.ports = collections.OrderedDict()
+        for name, port in ports.items():
+            port = Port(*port)
+            if (port.mask not in _PORT_MASKS or
+                    (port.mask == 0xff and port.inverted)):
+                raise ValueError(
+                    "Port `{}` must be a nibble or a whole (non-inverted) "
+                    "register.".format(name))
+            self.ports[name] = port
+        self.gpioa_conf = gpioa_conf
+        self.gpiob_conf = gpiob_conf
+        self.motors = motors
+
+    def shared_registers(self):
+        """Returns {register address: [(group name, channel index)]} for
+        every register used by a channel group.
+        """
+        registers = collections.OrderedDict()
+        for name, group in self.groups.items():
+            for i, channel in enumerate(group.channels):
+                registers.setdefault(channel.address, []).append((name, i))
+        return registers
@@ -0,0 +1,371 @@
+"""Software PWM for PiFace Relay Plus outputs.
+
+Every channel (on any number of boards) is driven from one timing thread.
+Channels can have their own frequency; channels with the same frequency
+share a period. At each edge the new bit pattern for each GPIO register is
+worked out from all of the channels and written with a single SPI write
+per register.
+"""
+import logging
+import threading
+import time
+import pifacecommon.mcp23s17
+from .core import (
+    MOTOR_DC_BRAKE_BITS,
+    MOTOR_DC_FORWARD_BITS,
+    MOTOR_DC_REVERSE_BITS,
+    MotorForwardReverseError,
+    MotorTooSoonError,
+)
+
+
+DEFAULT_FREQUENCY = 100  # Hz
+
+logger = logging.getLogger(__name__)
+
+_MOTOR_BITS = {'forward': MOTOR_DC_FORWARD_BITS,
+               'reverse': MOTOR_DC_REVERSE_BITS}
+
+
+def _pin_bits(pin, on):
+    """Returns (chip, address, mask, value) for setting pin to on."""
+    mask = 1 << pin.bit_num
+    if isinstance(pin, pifacecommon.mcp23s17.MCP23S17RegisterBitNeg):
+        on = not on
+    return pin.chip, pin.address, mask, mask if on else 0
+
+
+class PWMChannel(object):
+    """A PWM output. ``duty_cycle`` (0.0 to 1.0) and ``frequency`` (Hz, or
+    None to use the frequency of the :class:`SoftPWM`) can be changed at any
+    time and take effect from the next period.
+
+    :attribute: edges -- Number of edges driven (a channel at duty cycle 1
+        is switched on once a period).
+    :attribute: mean_jitter -- Mean lateness of the edges (seconds).
+    :attribute: max_jitter -- Worst lateness of an edge (seconds).
+    """
+
+    def __init__(self, pins_on, pins_off, duty_cycle=0, frequency=None):
+        self._pins_on = pins_on
+        self._pins_off = pins_off
+        self.duty_cycle = duty_cycle
+        self.frequency = frequency
+        self.edges = 0
+        self.max_jitter = 0
+        self._total_jitter = 0
+
+    @property
+    def duty_cycle(self):
+        return self._duty_cycle
+
+    @duty_cycle.setter
+    def duty_cycle(self, duty_cycle):
+        if not 0 <= duty_cycle <= 1:
+            raise ValueError("Duty cycle must be between 0 and 1.")
+        self._duty_cycle = duty_cycle
+
+    @property
+    def mean_jitter(self):
+        if self.edges == 0:
+            return 0
+        return self._total_jitter / self.edges
+
+    def bits(self, on):
+        """Returns the (chip, address, mask, value) of every pin of this
+        channel when it is on/off.
+        """
+        return self._pins_on if on else self._pins_off
+
+    def _start(self):
+        """Returns whether the channel is switched on this period."""
+        return self.duty_cycle > 0
+
+    def _switched_on(self):
+        """Called once the channel has been written on."""
+        pass
+
+    def _stop(self):
+        pass
+
+    def _record_edge(self, jitter):
+        self.edges += 1
+        self._total_jitter += jitter
+        if jitter > self.max_jitter:
+            self.max_jitter = jitter
+
+
+class PinPWMChannel(PWMChannel):
+    """PWM on a single output pin (a relay or LED)."""
+
+    def __init__(self, pin, duty_cycle=0, frequency=None):
+        self.pin = pin
+        super(PinPWMChannel, self).__init__([_pin_bits(pin, True)],
+                                            [_pin_bits(pin, False)],
+                                            duty_cycle, frequency)
+
+
+class MotorPWMChannel(PWMChannel):
+    """PWM speed control for a :class:`pifacerelayplus.MotorDC`. The motor
+    is driven in ``direction`` for the on part of each period and braked for
+    the rest.
+
+    Starting the motor (the first period with a non-zero duty cycle) uses
+    up the inrush budget of its board; if there is none left the motor
+    starts in a later period. The motor's state only changes to
+    ``direction`` once it has been driven.
+
+    :attribute: running -- Whether the motor has been started.
+    """
+
+    def __init__(self, motor, direction='forward', duty_cycle=0,
+                 frequency=None):
+        self.motor = motor
+        self.running = False
+        self._direction = None
+        super(MotorPWMChannel, self).__init__(None, None, duty_cycle,
+                                              frequency)
+        self.direction = direction
+
+    @property
+    def direction(self):
+        return self._direction
+
+    @direction.setter
+    def direction(self, direction):
+        if direction not in _MOTOR_BITS:
+            raise ValueError(
+                "Direction must be 'forward' or 'reverse'.")
+        with self.motor._lock:
+            if self._direction is None:
+                current_state = self.motor._current_state
+            elif self.duty_cycle > 0:
+                current_state = self._direction
+            else:
+                current_state = 'brake'
+            if current_state in _MOTOR_BITS and current_state != direction:
+                raise MotorForwardReverseError(direction, current_state)
+            bits = _MOTOR_BITS[direction]
+            self._pins_on = [_pin_bits(self.motor.pin1, bits[0]),
+                             _pin_bits(self.motor.pin2, bits[1])]
+            self._pins_off = [
+                _pin_bits(self.motor.pin1, MOTOR_DC_BRAKE_BITS[0]),
+                _pin_bits(self.motor.pin2, MOTOR_DC_BRAKE_BITS[1])]
+            self._direction = direction
+
+    def _start(self):
+        if self.duty_cycle == 0:
+            # braked for the whole period, it has to start again
+            self.running = False
+            return False
+        if not self.running:
+            try:
+                self.motor.inrush_budget.start()
+            except MotorTooSoonError:
+                return False
+            self.running = True
+        return True
+
+    def _switched_on(self):
+        with self.motor._lock:
+            self.motor._current_state = self._direction
+
+    def _stop(self):
+        self.running = False
+        with self.motor._lock:
+            self.motor._current_state = 'brake'
+
+
+class SoftPWM(object):
+    """Drives PWM channels from a single timing thread. Each period every
+    channel of that frequency with a non-zero duty cycle is switched on
+    together and then switched off at its own edge, with one SPI write per
+    GPIO register per edge. Edges are scheduled against absolute deadlines
+    so timing errors do not accumulate. Motors only start when the inrush
+    budget of their board allows (see :class:`MotorPWMChannel`).
+
+    If the timing thread fails, every channel is switched off, the error is
+    logged and :meth:`stop` raises it.
+
+    >>> pwm = pifacerelayplus.pwm.SoftPWM(frequency=50)
+    >>> motor = pwm.add_motor(pfrp.motors[0], 'forward', duty_cycle=0.3)
+    >>> pwm.start()
+    >>> motor.duty_cycle = 0.8
+    >>> led = pwm.add_pin(pfrp.leds[0], duty_cycle=0.5, frequency=2)
+    >>> pwm.stop()
+
+    :attribute: overruns -- Number of periods that started late because the
+        previous period could not be completed in time.
+    """
+
+    def __init__(self, frequency=DEFAULT_FREQUENCY):
+        self.frequency = frequency
+        self.channels = []
+        self.overruns = 0
+        self._thread = None
+        self._running = False
+        self._error = None
+        self._port_values = {}
+        # held while writing, so removed channels are not switched on again
+        self._lock = threading.Lock()
+
+    def add_pin(self, pin, duty_cycle=0, frequency=None):
+        """Adds a PWM channel for an output pin such as ``pfrp.leds[0]`` or
+        ``pfrp.relays[2]``.
+        """
+        return self.add_channel(PinPWMChannel(pin, duty_cycle, frequency))
+
+    def add_motor(self, motor, direction='forward', duty_cycle=0,
+                  frequency=None):
+        """Adds a PWM channel for the speed of a motor."""
+        return self.add_channel(
+            MotorPWMChannel(motor, direction, duty_cycle, frequency))
+
+    def add_channel(self, channel):
+        self.channels = self.channels + [channel]
+        return channel
+
+    def remove_channel(self, channel):
+        """Removes a channel and switches it off."""
+        with self._lock:
+            self.channels = [c for c in self.channels if c is not channel]
+            self._write(self._group_bits([(channel, False)]))
+        channel._stop()
+
+    def start(self):
+        """Starts the timing thread."""
+        self._running = True
+        self._error = None
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stops the timing thread and switches every channel off. Raises
+        the error that stopped the timing thread, if there was one.
+        """
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._switch_off()
+        error, self._error = self._error, None
+        if error is not None:
+            raise error
+
+    def _switch_off(self):
+        with self._lock:
+            self._port_values = {}
+            self._write(self._group_bits([(c, False)
+                                          for c in self.channels]))
+        for channel in self.channels:
+            channel._stop()
+
+    def _run(self):
+        try:
+            self._run_periods()
+        except Exception as error:
+            logger.exception("PWM timing thread failed")
+            self._error = error
+            self._running = False
+            try:
+                self._switch_off()
+            except Exception:
+                logger.exception("Could not switch the PWM channels off")
+
+    def _channel_frequency(self, channel):
+        if channel.frequency is None:
+            return self.frequency
+        return channel.frequency
+
+    def _run_periods(self):
+        period_starts = {}  # frequency -> start of its next period
+        off_edges = {}  # channel -> time it is switched off
+        while self._running:
+            channels = self.channels
+            now = time.perf_counter()
+            frequencies = set(self._channel_frequency(c) for c in channels)
+            for frequency in list(period_starts):
+                if frequency not in frequencies:
+                    del period_starts[frequency]
+            for frequency in frequencies:
+                period_starts.setdefault(frequency, now)
+            for channel in list(off_edges):
+                if channel not in channels:
+                    del off_edges[channel]
+            deadlines = list(period_starts.values()) + list(off_edges.values())
+            if not deadlines:
+                # no channels yet
+                self._sleep_until(now + 1.0 / self.frequency)
+                continue
+            deadline = min(deadlines)
+            self._sleep_until(deadline)
+            jitter = time.perf_counter() - deadline
+
+            states = []
+            edges = []
+            for channel, off_time in list(off_edges.items()):
+                if off_time <= deadline:
+                    del off_edges[channel]
+                    states.append((channel, False))
+                    edges.append(channel)
+            starting = [f for f, start in period_starts.items()
+                        if start <= deadline]
+            for channel in channels:
+                frequency = self._channel_frequency(channel)
+                if frequency not in starting:
+                    continue
+                on = channel._start()
+                states.append((channel, on))
+                if on:
+                    edges.append(channel)
+                    if channel.duty_cycle < 1:
+                        off_edges[channel] = (period_starts[frequency] +
+                                              channel.duty_cycle / frequency)
+            self._switch(states)
+            for channel in edges:
+                channel._record_edge(jitter)
+
+            now = time.perf_counter()
+            for frequency in starting:
+                period_starts[frequency] += 1.0 / frequency
+                if now > period_starts[frequency]:
+                    # fell behind, don't try to catch up
+                    self.overruns += 1
+                    period_starts[frequency] = now
+
+    def _sleep_until(self, deadline):
+        delay = deadline - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+
+    def _switch(self, channel_states):
+        """Switches the channels which haven't been removed on/off."""
+        with self._lock:
+            channels = self.channels
+            channel_states = [(c, on) for c, on in channel_states
+                              if c in channels]
+            self._write(self._group_bits(channel_states))
+            for channel, on in channel_states:
+                if on:
+                    channel._switched_on()
+
+    def _group_bits(self, channel_states):
+        """Returns {(chip, address): [mask, value]} for the given channel
+        states.
+        """
+        ports = {}
+        for channel, on in channel_states:
+            for chip, address, mask, value in channel.bits(on):
+                port = ports.setdefault((chip, address), [0, 0])
+                port[0] |= mask
+                port[1] = (port[1] & ~mask) | value
+        return ports
+
+    def _write(self, ports):
+        for (chip, address), (mask, value) in ports.items():
+            old_value = self._port_values.get((chip, address))
+            if old_value is not None and (old_value & mask) == value:
+                continue  # nothing changed on this register
+            self._port_values[(chip, address)] = chip._write_latch_bits(
+                address, mask, value)
@@ -0,0 +1,223 @@
+"""Samples the input port (GPIOB) at a fixed rate into a ring buffer.
+
+Each sample is one SPI read of GPIOB. Samples and their timestamps are
+stored in preallocated arrays (no Python object per sample) which can be
+exported without copying:
+
+>>> sampler = pifacerelayplus.sampler.InputSampler(pfrp, rate=2000)
+>>> sampler.start()
+>>> time.sleep(1)
+>>> sampler.stop()
+>>> values, timestamps = sampler.segments()[0]
+>>> numpy.frombuffer(values, dtype=numpy.uint8)
+
+:attr:`InputSampler.achieved_rate` and :attr:`InputSampler.dropped` show
+how closely the target rate was kept.
+
+Sampling can also stop itself a number of samples after a trigger, keeping
+the samples before it (pre/post-trigger capture):
+
+>>> sampler.set_trigger(mask=0x10, value=0, pre_samples=100,
+...                     post_samples=400)  # x-pin 0 pressed
+>>> sampler.start()
+>>> sampler.wait()
+True
+
+Samples are the raw GPIOB value; use :func:`x_port` and :func:`y_port` to
+decode them. Reading GPIOB clears any pending interrupt on the board.
+
+If a read fails, sampling stops, the error is logged and :meth:`wait`
+raises it.
+"""
+import array
+import logging
+import threading
+import time
+import pifacecommon.mcp23s17
+
+
+DEFAULT_RATE = 1000  # Hz
+DEFAULT_CAPACITY = 65536  # samples
+
+logger = logging.getLogger(__name__)
+
+
+def x_port(sample):
+    """Returns the X-port value of a GPIOB sample."""
+    return (~sample >> 4) & 0xf
+
+
+def y_port(sample):
+    """Returns the Y-port (or button port) value of a GPIOB sample."""
+    return ~sample & 0xf
+
+
+class InputSampler(object):
+    """Samples a port of a board from a background thread.
+
+    :param rate: Target sample rate (Hz).
+    :param capacity: Number of samples kept (the oldest are overwritten).
+
+    :attribute: samples -- Number of samples taken since :meth:`start`.
+    :attribute: dropped -- Number of sample times which were missed
+        because the previous sample finished too late.
+    :attribute: trigger_index -- Sample number of the trigger, or None.
+    """
+
+    def __init__(self, chip, rate=DEFAULT_RATE, capacity=DEFAULT_CAPACITY,
+                 address=pifacecommon.mcp23s17.GPIOB):
+        self.chip = chip
+        self.rate = rate
+        self.capacity = capacity
+        self.address = address
+        self.values = array.array('B', bytes(capacity))
+        self.timestamps = array.array('d', bytes(8 * capacity))
+        self.samples = 0
+        self.dropped = 0
+        self.trigger_index = None
+        self._trigger = None  # (mask, value, pre_samples, post_samples)
+        self._first_time = self._last_time = 0
+        self._running = False
+        self._thread = None
+        self._error = None
+        self._done = threading.Event()
+
+    def set_trigger(self, mask, value, pre_samples=0, post_samples=None):
+        """Stops sampling ``post_samples`` samples after the first sample
+        where ``sample & mask == value``, keeping ``pre_samples`` samples
+        from before the trigger. ``post_samples`` defaults to filling the
+        rest of the buffer.
+        """
+        if post_samples is None:
+            post_samples = self.capacity - pre_samples - 1
+        if pre_samples + 1 + post_samples > self.capacity:
+            raise ValueError(
+                "The capture ({} samples) does not fit in the buffer ({} "
+                "samples).".format(pre_samples + 1 + post_samples,
+                                   self.capacity))
+        self._trigger = (mask, value & mask, pre_samples, post_samples)
+
+    def clear_trigger(self):
+        self._trigger = None
+
+    def start(self):
+        """Empties the buffer and starts sampling."""
+        self.samples = 0
+        self.dropped = 0
+        self.trigger_index = None
+        self._error = None
+        self._done.clear()
+        self._running = True
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stops sampling."""
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def wait(self, timeout=None):
+        """Waits for a triggered capture (or sampling) to finish. Returns
+        False if it timed out and raises the error that stopped sampling,
+        if there was one.
+        """
+        finished = self._done.wait(timeout)
+        if self._error is not None:
+            raise self._error
+        return finished
+
+    @property
+    def achieved_rate(self):
+        """The actual sample rate (Hz)."""
+        if self.samples < 2 or self._last_time == self._first_time:
+            return 0
+        return (self.samples - 1) / (self._last_time - self._first_time)
+
+    def segments(self):
+        """Returns the buffered samples, oldest first, as a list of
+        (values, timestamps) memoryviews of the buffers (one pair, or two
+        if the buffer has wrapped around). Timestamps are
+        :func:`time.perf_counter` values.
+        """
+        start, count = self._window()
+        end = start + count
+        values = memoryview(self.values)
+        timestamps = memoryview(self.timestamps)
+        if end <= self.capacity:
+            return [(values[start:end], timestamps[start:end])]
+        end -= self.capacity
+        return [(values[start:], timestamps[start:]),
+                (values[:end], timestamps[:end])]
+
+    def write_to(self, values_file, timestamps_file=None):
+        """Writes the buffered samples (one byte each) and, optionally,
+        their timestamps (native doubles) to binary files.
+        """
+        for values, timestamps in self.segments():
+            values_file.write(values)
+            if timestamps_file is not None:
+                timestamps_file.write(timestamps)
+
+    def _window(self):
+        """Returns (start index, count) of the samples to export."""
+        last = self.samples
+        if self._trigger is not None and self.trigger_index is not None:
+            pre_samples, post_samples = self._trigger[2:]
+            last = min(last, self.trigger_index + post_samples + 1)
+            count = min(last, pre_samples + 1 + post_samples,
+                        last - self.trigger_index + pre_samples)
+        else:
+            count = min(last, self.capacity)
+        return (last - count) % self.capacity, count
+
+    def _run(self):
+        try:
+            self._sample()
+        except Exception as error:
+            logger.exception("Input sampling failed")
+            self._error = error
+        finally:
+            self._running = False
+            self._done.set()
+
+    def _sample(self):
+        read = self.chip.read
+        address = self.address
+        values = self.values
+        timestamps = self.timestamps
+        capacity = self.capacity
+        trigger = self._trigger
+        period = 1.0 / self.rate
+        deadline = time.perf_counter()
+        self._first_time = deadline
+        while self._running:
+            delay = deadline - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            value = read(address)
+            now = time.perf_counter()
+            index = self.samples % capacity
+            values[index] = value
+            timestamps[index] = now
+            if self.samples == 0:
+                self._first_time = now
+            self._last_time = now
+            self.samples += 1
+
+            if trigger is not None:
+                if (self.trigger_index is None and
+                        value & trigger[0] == trigger[1]):
+                    self.trigger_index = self.samples - 1
+                if (self.trigger_index is not None and
+                        self.samples - 1 - self.trigger_index >= trigger[3]):
+                    self._running = False
+
+            deadline += period
+            missed = int((now - deadline) / period)
+            if missed > 0:
+                # fell behind, skip the sample times that have passed
+                self.dropped += missed
+                deadline += missed * period
@@ -0,0 +1,168 @@
+"""Queues motor commands and runs them as soon as the inrush budget of the
+motor's board allows, instead of raising
+:class:`pifacerelayplus.MotorTooSoonError`.
+"""
+import collections
+import threading
+import time
+from concurrent.futures import Future
+from .core import MotorTooSoonError
+
+
+# commands that turn a motor on (and so draw inrush current)
+_START_COMMANDS = ('forward', 'reverse')
+_COMMANDS = _START_COMMANDS + ('coast', 'brake')
+# shortest wait for a start slot, so clock rounding can't make it spin
+_MIN_WAIT = 0.001  # seconds
+
+
+class MotorScheduler(object):
+    """Runs motor commands for any number of boards. Each command returns a
+    :class:`concurrent.futures.Future` which completes once the command has
+    been carried out (or holds the exception it raised, such as
+    :class:`pifacerelayplus.MotorForwardReverseError`).
+
+    Commands that don't draw extra current (coast, brake, or a motor that is
+    already in the requested state) run straight away. Commands that turn a
+    motor on are queued in order for each board and released as soon as
+    the inrush budget of that motor's board allows, so boards don't hold
+    each other up. A new command for a motor cancels any command still
+    queued for it.
+
+    The scheduler only removes the waiting, not the budget: with the
+    default budget (one start per ``MOTOR_CONTROL_WINDOW``) starting the
+    four motors of one board still takes three windows (450 ms). Motors on
+    different boards start together, and ``inrush_budget.max_starts`` can
+    be raised if the power supply can take more than one inrush at a time.
+
+    >>> scheduler = pifacerelayplus.scheduler.MotorScheduler()
+    >>> futures = [scheduler.forward(motor) for motor in pfrp.motors]
+    >>> concurrent.futures.wait(futures)
+
+    Use :func:`asyncio.wrap_future` to await the futures from asyncio.
+    """
+
+    def __init__(self):
+        # inrush budget -> deque of (motor, command, future), in order
+        self._queues = collections.OrderedDict()
+        self._condition = threading.Condition()
+        self._thread = None
+        self._running = False
+
+    def forward(self, motor):
+        return self.submit(motor, 'forward')
+
+    def reverse(self, motor):
+        return self.submit(motor, 'reverse')
+
+    def coast(self, motor):
+        return self.submit(motor, 'coast')
+
+    def brake(self, motor):
+        return self.submit(motor, 'brake')
+
+    def submit(self, motor, command):
+        """Schedules ``command`` ('forward', 'reverse', 'coast' or 'brake')
+        on ``motor`` and returns a future.
+        """
+        if command not in _COMMANDS:
+            raise ValueError("Unknown motor command `{}`.".format(command))
+        future = Future()
+        with self._condition:
+            self._cancel_queued(motor)
+            if motor._current_state == command:
+                # already there, nothing to do
+                future.set_running_or_notify_cancel()
+                future.set_result(command)
+            elif command not in _START_COMMANDS:
+                self._run(motor, command, future)
+            else:
+                queue = self._queues.setdefault(motor.inrush_budget,
+                                                collections.deque())
+                queue.append((motor, command, future))
+                self._start_thread()
+                self._condition.notify()
+        return future
+
+    def close(self):
+        """Cancels every queued command and stops the scheduler thread."""
+        with self._condition:
+            self._running = False
+            for queue in self._queues.values():
+                for motor, command, future in queue:
+                    future.cancel()
+            self._queues.clear()
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _cancel_queued(self, motor):
+        queue = self._queues.get(motor.inrush_budget, ())
+        for queued in [q for q in queue if q[0] is motor]:
+            queue.remove(queued)
+            queued[2].cancel()
+
+    def _run(self, motor, command, future):
+        """Runs the command and completes the future.
+
+        :raises: MotorTooSoonError -- the command was not run, the future
+            is left pending.
+        """
+        if future.cancelled():
+            return
+        try:
+            getattr(motor, command)()
+        except MotorTooSoonError:
+            raise
+        except Exception as e:
+            if future.set_running_or_notify_cancel():
+                future.set_exception(e)
+        else:
+            if future.set_running_or_notify_cancel():
+                future.set_result(command)
+
+    def _start_thread(self):
+        if self._thread is None:
+            self._running = True
+            self._thread = threading.Thread(target=self._release_commands)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _release_commands(self):
+        with self._condition:
+            while self._running:
+                timeout = self._release_ready()
+                self._condition.wait(timeout)
+
+    def _release_ready(self):
+        """Runs the queued commands whose board has inrush budget left, in
+        the order they were queued, and returns how long to wait for the
+        next start slot (or None).
+        """
+        next_time = None
+        for budget, queue in list(self._queues.items()):
+            while queue:
+                motor, command, future = queue[0]
+                if future.cancelled():
+                    queue.popleft()
+                    continue
+                now = time.time()
+                start_time = budget.next_start_time(now)
+                if start_time > now:
+                    break
+                try:
+                    self._run(motor, command, future)
+                except MotorTooSoonError:
+                    # something else turned a motor on, it stays first in
+                    # line for the next slot
+                    start_time = budget.next_start_time()
+                    break
+                queue.popleft()
+            if not queue:
+                del self._queues[budget]
+            elif next_time is None or start_time < next_time:
+                next_time = start_time
+        if next_time is None:
+            return None
+        return max(next_time - time.time(), _MIN_WAIT)
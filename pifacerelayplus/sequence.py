@@ -0,0 +1,141 @@
+"""Timed sequences of output changes (relays, LEDs, ports) on any number of
+boards.
+
+Every event is scheduled against an absolute deadline from the start of the
+sequence so timing errors do not accumulate, and events that fall at the
+same time (to the microsecond) are merged into one SPI write per GPIO
+register.
+
+>>> seq = pifacerelayplus.sequence.Sequence()
+>>> seq.pulse(pfrp.relays[4], start=0, duration=1.5)
+>>> seq.pulse(pfrp.relays[5], start=0, duration=0.5)
+>>> seq.add(1.0, pfrp.relays[6], 1)
+>>> results = seq.play()
+
+Each :class:`EventResult` records how late its event reached the board.
+"""
+import asyncio
+import collections
+import time
+import pifacecommon.mcp23s17
+from . import core
+
+
+# events are grouped by their time rounded to this many decimal places
+# (microseconds), so 0.1 + 0.2 and 0.3 fall at the same time
+TIME_DIGITS = 6
+
+class EventResult(collections.namedtuple('EventResult',
+                                         ['time', 'target', 'value',
+                                          'error'])):
+    """An event that has been played. ``error`` is how late (in seconds)
+    the event reached the board.
+    """
+    __slots__ = ()
+
+
+def _target_bits(target, value):
+    """Returns (chip, address, mask, bits) for setting target (a pin, nibble
+    or register) to value.
+    """
+    pcmcp = pifacecommon.mcp23s17
+    if isinstance(target, pcmcp.MCP23S17RegisterBit):
+        mask = 1 << target.bit_num
+        on = bool(value)
+        if isinstance(target, pcmcp.MCP23S17RegisterBitNeg):
+            on = not on
+        bits = mask if on else 0
+    elif isinstance(target, core._PortRegister):
+        mask, bits = target.port.encode(value)
+    elif isinstance(target, pcmcp.MCP23S17RegisterNibble):
+        shift = 0 if target.nibble == pcmcp.LOWER_NIBBLE else 4
+        value &= 0xf
+        if isinstance(target, pcmcp.MCP23S17RegisterNibbleNeg):
+            value ^= 0xf
+        mask = 0xf << shift
+        bits = value << shift
+    elif isinstance(target, pcmcp.MCP23S17Register):
+        mask = 0xff
+        bits = value & 0xff
+    else:
+        raise TypeError(
+            "Cannot sequence `{}`, use a pin, nibble or register.".format(
+                target))
+    return target.chip, target.address, mask, bits
+
+
+class Sequence(object):
+    """A timeline of output changes. Times are in seconds from the start of
+    the sequence.
+    """
+
+    def __init__(self):
+        self.events = []  # (time, target, value, bits)
+
+    def add(self, time, target, value):
+        """Sets target (such as ``pfrp.relays[2]`` or ``pfrp.relay_port``)
+        to value at time.
+        """
+        self.events.append((time, target, value, _target_bits(target, value)))
+
+    def pulse(self, target, start, duration, on=1, off=0):
+        """Sets target to ``on`` at start and back to ``off`` duration
+        seconds later.
+        """
+        self.add(start, target, on)
+        self.add(start + duration, target, off)
+
+    def steps(self):
+        """Returns [(time, events, writes)] in time order, where writes is
+        {(chip, address): (mask, bits)} for all of the events at that time
+        (rounded to the microsecond). Later events override earlier ones on
+        the same pins.
+        """
+        steps = collections.OrderedDict()
+        events = [(round(event[0], TIME_DIGITS), event)
+                  for event in self.events]
+        for step_time, event in sorted(events, key=lambda e: e[0]):
+            events, writes = steps.setdefault(step_time, ([], {}))
+            events.append(event)
+            chip, address, mask, bits = event[3]
+            old_mask, old_bits = writes.get((chip, address), (0, 0))
+            writes[(chip, address)] = (old_mask | mask,
+                                       (old_bits & ~mask) | bits)
+        return [(t, events, writes) for t, (events, writes) in steps.items()]
+
+    def play(self):
+        """Plays the sequence, blocking until it has finished, and returns
+        an :class:`EventResult` for every event.
+        """
+        results = []
+        start = time.perf_counter()
+        for step_time, events, writes in self.steps():
+            delay = start + step_time - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            self._write(writes)
+            self._record(results, events, start + step_time)
+        return results
+
+    async def play_async(self):
+        """Plays the sequence from an asyncio task and returns an
+        :class:`EventResult` for every event.
+        """
+        results = []
+        start = time.perf_counter()
+        for step_time, events, writes in self.steps():
+            delay = start + step_time - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._write(writes)
+            self._record(results, events, start + step_time)
+        return results
+
+    def _write(self, writes):
+        for (chip, address), (mask, bits) in writes.items():
+            chip._write_latch_bits(address, mask, bits)
+
+    def _record(self, results, events, deadline):
+        error = time.perf_counter() - deadline
+        results.extend(EventResult(event_time, target, value, error)
+                       for event_time, target, value, bits in events)
@@ -0,0 +1,242 @@
+"""A simulated SPI bus of MCP23S17s for running PiFace Relay Plus code
+without hardware.
+
+>>> import pifacecommon.mcp23s17
+>>> import pifacerelayplus
+>>> import pifacerelayplus.simulator
+>>> spi = pifacerelayplus.simulator.SimulatedSPIBus(latency=0.0001)
+>>> pfrp = pifacerelayplus.PiFaceRelayPlus(pifacerelayplus.RELAY, spi=spi)
+>>> pfrp.relays[0].turn_on()
+>>> spi.set_input(0, pifacecommon.mcp23s17.GPIOB, 4, 0)  # press x-pin 0
+>>> pfrp.x_pins[0].value
+1
+>>> spi.transactions
+12
+"""
+import os
+import threading
+import time
+import pifacecommon.mcp23s17
+
+
+NUM_REGISTERS = 0x16
+_PORTS = (pifacecommon.mcp23s17.GPIOA, pifacecommon.mcp23s17.GPIOB)
+
+
+class MCP23S17Simulator(object):
+    """The register file of one MCP23S17 (IOCON.BANK = 0 only).
+
+    Input pins that are not driven with :meth:`set_input` read 1 if their
+    pull-up is enabled and 0 otherwise.
+    """
+
+    def __init__(self, hardware_addr=0):
+        self.hardware_addr = hardware_addr
+        self.registers = bytearray(NUM_REGISTERS)
+        # IODIR resets to all inputs
+        self.registers[pifacecommon.mcp23s17.IODIRA] = 0xff
+        self.registers[pifacecommon.mcp23s17.IODIRB] = 0xff
+        # externally driven input levels: port -> (mask, value)
+        self._driven = dict((port, [0, 0]) for port in _PORTS)
+        self._previous = dict((port, self.pin_levels(port))
+                              for port in _PORTS)
+
+    @property
+    def iocon(self):
+        return self.registers[pifacecommon.mcp23s17.IOCON]
+
+    @property
+    def sequential(self):
+        return not self.iocon & pifacecommon.mcp23s17.SEQOP_OFF
+
+    def responds_to(self, hardware_addr):
+        """Returns whether this chip answers to the given address."""
+        if self.iocon & pifacecommon.mcp23s17.HAEN_ON:
+            return hardware_addr == self.hardware_addr
+        # hardware address pins are ignored until HAEN is set
+        return hardware_addr == 0
+
+    def pin_levels(self, port):
+        """Returns the logic level of every pin of the port."""
+        r = self.registers
+        mask, driven = self._driven[port]
+        pullup = r[port - pifacecommon.mcp23s17.GPIOA +
+                   pifacecommon.mcp23s17.GPPUA]
+        inputs = (driven & mask) | (pullup & ~mask)
+        iodir = r[port - pifacecommon.mcp23s17.GPIOA +
+                  pifacecommon.mcp23s17.IODIRA]
+        olat = r[port + 2]
+        return ((inputs & iodir) | (olat & ~iodir)) & 0xff
+
+    def interrupt_asserted(self, port=pifacecommon.mcp23s17.GPIOB):
+        return self.registers[port - pifacecommon.mcp23s17.GPIOA +
+                              pifacecommon.mcp23s17.INTFA] != 0
+
+    def set_input(self, port, bit_num, level):
+        """Drives an input pin to level (0 or 1)."""
+        mask = 1 << bit_num
+        driven = self._driven[port]
+        driven[0] |= mask
+        driven[1] = (driven[1] & ~mask) | (mask if level else 0)
+        self._update_interrupts(port)
+
+    def release_input(self, port, bit_num):
+        """Stops driving an input pin (it floats to its pull-up)."""
+        self._driven[port][0] &= ~(1 << bit_num)
+        self._update_interrupts(port)
+
+    def read(self, address):
+        r = self.registers
+        pcmcp = pifacecommon.mcp23s17
+        if address in _PORTS:
+            value = self.pin_levels(address) ^ r[address - pcmcp.GPIOA +
+                                                 pcmcp.IPOLA]
+            self._clear_interrupt(address)
+            return value
+        if address in (pcmcp.INTCAPA, pcmcp.INTCAPB):
+            self._clear_interrupt(address - pcmcp.INTCAPA + pcmcp.GPIOA)
+        return r[address]
+
+    def write(self, data, address):
+        r = self.registers
+        pcmcp = pifacecommon.mcp23s17
+        if address in (pcmcp.INTFA, pcmcp.INTFB,
+                       pcmcp.INTCAPA, pcmcp.INTCAPB):
+            return  # read only
+        if address in _PORTS:
+            address += 2  # writing GPIO writes the output latch
+        if address in (pcmcp.IOCON, pcmcp.IOCON + 1):
+            r[pcmcp.IOCON] = r[pcmcp.IOCON + 1] = data & 0xfe
+            return
+        r[address] = data
+        for port in _PORTS:
+            self._update_interrupts(port)
+
+    def _clear_interrupt(self, port):
+        pcmcp = pifacecommon.mcp23s17
+        self.registers[port - pcmcp.GPIOA + pcmcp.INTFA] = 0
+
+    def _update_interrupts(self, port):
+        pcmcp = pifacecommon.mcp23s17
+        r = self.registers
+        offset = port - pcmcp.GPIOA
+        levels = self.pin_levels(port)
+        previous = self._previous[port]
+        self._previous[port] = levels
+        enabled = r[pcmcp.GPINTENA + offset] & r[pcmcp.IODIRA + offset]
+        intcon = r[pcmcp.INTCONA + offset]
+        # INTCON = 1 compares against DEFVAL, 0 against the previous value
+        changed = (((levels ^ r[pcmcp.DEFVALA + offset]) & intcon) |
+                   ((levels ^ previous) & ~intcon)) & enabled
+        if changed and r[pcmcp.INTFA + offset] == 0:
+            # flag the lowest pin, capture the port as it is now
+            r[pcmcp.INTFA + offset] = changed & -changed
+            r[pcmcp.INTCAPA + offset] = levels ^ r[pcmcp.IPOLA + offset]
+
+
+class SimulatedSPIBus(object):
+    """Simulated ``/dev/spidev<bus>.<chip_select>`` with an MCP23S17 at each
+    of ``hardware_addrs``. Give it to
+    :class:`pifacerelayplus.PiFaceRelayPlus` as ``spi``.
+
+    Every transaction takes ``latency`` plus ``byte_time`` per byte of
+    simulated time, which is added to :attr:`elapsed`. With
+    ``realtime=True`` the caller is also made to wait that long.
+
+    The simulated interrupt line is a pipe: ``interrupt_device`` can be
+    watched like the interrupt GPIO and a byte is written to it whenever a
+    chip raises an interrupt on GPIOB.
+
+    :attribute: transactions -- Number of SPI transactions.
+    :attribute: bytes_transferred -- Number of bytes sent.
+    :attribute: elapsed -- Total simulated transaction time (seconds).
+    """
+
+    def __init__(self, hardware_addrs=(0,), latency=0, byte_time=0,
+                 realtime=False):
+        self.chips = dict((addr, MCP23S17Simulator(addr))
+                          for addr in hardware_addrs)
+        self.latency = latency
+        self.byte_time = byte_time
+        self.realtime = realtime
+        self.transactions = 0
+        self.bytes_transferred = 0
+        self.elapsed = 0
+        self._lock = threading.Lock()
+        self._interrupt_read_fd = None
+        self._interrupt_write_fd = None
+        self._interrupt_asserted = False
+
+    @property
+    def interrupt_device(self):
+        """Path of the simulated interrupt line."""
+        if self._interrupt_read_fd is None:
+            self._interrupt_read_fd, self._interrupt_write_fd = os.pipe()
+            os.set_blocking(self._interrupt_write_fd, False)
+        return "/proc/self/fd/{}".format(self._interrupt_read_fd)
+
+    def reset_counters(self):
+        self.transactions = 0
+        self.bytes_transferred = 0
+        self.elapsed = 0
+
+    def set_input(self, hardware_addr, port, bit_num, level):
+        """Drives an input pin of the chip at hardware_addr."""
+        with self._lock:
+            self.chips[hardware_addr].set_input(port, bit_num, level)
+            self._signal_interrupt()
+
+    def release_input(self, hardware_addr, port, bit_num):
+        """Stops driving an input pin of the chip at hardware_addr."""
+        with self._lock:
+            self.chips[hardware_addr].release_input(port, bit_num)
+            self._signal_interrupt()
+
+    def spisend(self, bytes_to_send):
+        """Performs one SPI transaction and returns the bytes clocked in."""
+        duration = self.latency + self.byte_time * len(bytes_to_send)
+        with self._lock:
+            self.transactions += 1
+            self.bytes_transferred += len(bytes_to_send)
+            self.elapsed += duration
+            received = self._transfer(bytes(bytes_to_send))
+            self._signal_interrupt()
+        if self.realtime and duration > 0:
+            time.sleep(duration)
+        return received
+
+    def _transfer(self, data):
+        received = bytearray(len(data))
+        if len(data) < 2:
+            return bytes(received)
+        ctrl_byte, address = data[0], data[1]
+        if ctrl_byte & 0xf0 != 0x40:
+            return bytes(received)  # not an MCP23S17 opcode
+        hardware_addr = (ctrl_byte >> 1) & 0x7
+        read = ctrl_byte & pifacecommon.mcp23s17.READ_CMD
+        chips = [chip for chip in self.chips.values()
+                 if chip.responds_to(hardware_addr)]
+        for i, byte in enumerate(data[2:]):
+            for chip in chips:
+                if chip.sequential:
+                    register = (address + i) % NUM_REGISTERS
+                else:
+                    register = address
+                if read:
+                    # the first chip wins if several are listening
+                    if chip is chips[0]:
+                        received[i + 2] = chip.read(register)
+                else:
+                    chip.write(byte, register)
+        return bytes(received)
+
+    def _signal_interrupt(self):
+        asserted = any(chip.interrupt_asserted()
+                       for chip in self.chips.values())
+        if (asserted and not self._interrupt_asserted and
+                self._interrupt_write_fd is not None):
+            try:
+                os.write(self._interrupt_write_fd, b'0')
+            except BlockingIOError:
+                pass  # nobody is reading the line
+        self._interrupt_asserted = asserted
@@ -0,0 +1,252 @@
+"""Traces the SPI transactions of PiFace Relay Plus boards.
+
+Every register read and write is recorded with the register, the value,
+how long the transaction took and which part of the API caused it
+(``relay``, ``motor``, ``input`` or ``init``):
+
+>>> tracer = pifacerelayplus.trace.SPITracer(open('spi.csv', 'w'))
+>>> tracer.attach(pfrp)
+>>> pfrp.motors[0].forward()
+>>> tracer.detach(pfrp)
+>>> tracer.counters()
+{('motor', 'read', 'GPIOB'): 2, ('motor', 'write', 'GPIOB'): 2}
+>>> print(tracer.format_stats())
+
+Boards without a tracer only pay for one attribute check per transaction.
+With ``trace_file`` every transaction is also written to it as a line of
+CSV (``time,hardware_addr,operation,register,value,bytes,duration,api``)
+for offline analysis.
+"""
+import collections
+import sys
+import threading
+import pifacecommon.mcp23s17
+from . import core
+
+
+# duration histogram buckets: under 1us, 2us, 4us ... 2**(N - 2)us, longer
+HISTOGRAM_BUCKETS = 18
+MAX_FRAMES = 32
+
+_REGISTER_NAMES = dict(
+    (getattr(pifacecommon.mcp23s17, name), name)
+    for name in ('IODIRA', 'IODIRB', 'IPOLA', 'IPOLB', 'GPINTENA',
+                 'GPINTENB', 'DEFVALA', 'DEFVALB', 'INTCONA', 'INTCONB',
+                 'IOCON', 'GPPUA', 'GPPUB', 'INTFA', 'INTFB', 'INTCAPA',
+                 'INTCAPB', 'GPIOA', 'GPIOB', 'OLATA', 'OLATB'))
+
+# the functions and modules each part of the API is made of
+_API_FUNCTIONS = {
+    'motor': [core.MotorDC.coast, core.MotorDC.reverse,
+              core.MotorDC.forward, core.MotorDC.brake,
+              core.MotorStepper.set_stepper, core.MotorStepper.coast,
+              core.MotorStepper.reverse, core.MotorStepper.forward,
+              core.MotorStepper.brake,
+              core.PiFaceRelayPlus.set_motors],
+    'relay': [core.PiFaceRelayPlus.write_masked,
+              core.PiFaceRelayPlus.set_bits,
+              core.PiFaceRelayPlus.clear_bits,
+              core.PiFaceRelayPlus.toggle_bits,
+              core.PiFaceRelayPlus.set_relays,
+              core.PiFaceRelayPlus.set_leds],
+    'input': [core.PiFaceRelayPlus.snapshot,
+              core.PiFaceRelayPlus.read_input_event,
+              core.PiFaceRelayPlus.get_inputs,
+              core.PiFaceRelayPlusBus.read_interrupts],
+    'init': [core.PiFaceRelayPlus.init_board,
+             core.PiFaceRelayPlus.warm_start,
+             core.PiFaceRelayPlus.resync_registers,
+             core.PiFaceRelayPlus.enable_interrupts,
+             core.PiFaceRelayPlus.disable_interrupts],
+}
+_API_MODULES = {
+    'pifacerelayplus.aio': 'input',
+    'pifacerelayplus.debounce': 'input',
+    'pifacerelayplus.sampler': 'input',
+    'pifacerelayplus.scheduler': 'motor',
+    'pifacerelayplus.sequence': 'relay',
+    'pifacerelayplus.pwm': 'relay',
+}
+_INPUT_REGISTERS = (pifacecommon.mcp23s17.INTFA,
+                    pifacecommon.mcp23s17.INTFB,
+                    pifacecommon.mcp23s17.INTCAPA,
+                    pifacecommon.mcp23s17.INTCAPB)
+_PORT_B_REGISTERS = (pifacecommon.mcp23s17.GPIOB, pifacecommon.mcp23s17.OLATB)
+
+
+class TraceRecord(collections.namedtuple('TraceRecord',
+                                         ['time', 'hardware_addr',
+                                          'operation', 'register', 'value',
+                                          'bytes', 'duration', 'api'])):
+    """One SPI transaction. ``value`` is the byte read or written (a bytes
+    object for sequential transfers of more than one register).
+    """
+    __slots__ = ()
+
+    @property
+    def register_name(self):
+        return _REGISTER_NAMES.get(self.register, hex(self.register))
+
+
+def _register_api(chip, operation, register):
+    """Returns the API a transaction belongs to from its register, when it
+    wasn't made from a known API function.
+    """
+    pcmcp = pifacecommon.mcp23s17
+    if register in _INPUT_REGISTERS:
+        return 'input'
+    if register in _PORT_B_REGISTERS:
+        if operation == 'read':
+            return 'input'
+        if chip.plus_board in (core.MOTOR_DC, core.MOTOR_STEPPER):
+            return 'motor'
+        return 'relay'
+    if register in (pcmcp.GPIOA, pcmcp.OLATA):
+        return 'relay'
+    return 'init'
+
+
+def _boards(board):
+    if isinstance(board, core.PiFaceRelayPlusBus):
+        return list(board)
+    return [board]
+
+
+class SPITracer(object):
+    """Collects the SPI transactions of the boards it is attached to.
+
+    :param trace_file: Text file to write every transaction to (CSV).
+    :param records: Also keep every :class:`TraceRecord` in
+        :attr:`records`.
+    """
+
+    def __init__(self, trace_file=None, records=False):
+        self.trace_file = trace_file
+        self.records = [] if records else None
+        self._counts = collections.Counter()
+        self._durations = collections.Counter()
+        self._histograms = {}
+        self._lock = threading.Lock()
+        self._api_codes = {}
+        for api, functions in _API_FUNCTIONS.items():
+            for function in functions:
+                self.add_api_function(function, api)
+
+    def add_api_function(self, function, api):
+        """Counts transactions made from within function as api."""
+        self._api_codes[function.__code__] = api
+
+    def attach(self, board):
+        """Starts tracing a board (or every board of a
+        :class:`pifacerelayplus.PiFaceRelayPlusBus`).
+        """
+        for chip in _boards(board):
+            chip.tracer = self
+
+    def detach(self, board):
+        """Stops tracing a board (or bus)."""
+        for chip in _boards(board):
+            chip.tracer = None
+
+    def record(self, chip, sent, received, start, end):
+        """Records a transaction (called by the board)."""
+        if len(sent) < 3:
+            return
+        pcmcp = pifacecommon.mcp23s17
+        if sent[0] & pcmcp.READ_CMD:
+            operation, data = 'read', received[2:]
+        else:
+            operation, data = 'write', sent[2:]
+        register = sent[1]
+        value = data[0] if len(data) == 1 else bytes(data)
+        api = self._caller_api()
+        if api is None:
+            api = _register_api(chip, operation, register)
+        duration = end - start
+        key = (api, operation, _REGISTER_NAMES.get(register, hex(register)))
+        bucket = min(max(int(duration * 1e6), 0).bit_length(),
+                     HISTOGRAM_BUCKETS - 1)
+        with self._lock:
+            self._counts[key] += 1
+            self._durations[key] += duration
+            histogram = self._histograms.get(api)
+            if histogram is None:
+                histogram = self._histograms[api] = [0] * HISTOGRAM_BUCKETS
+            histogram[bucket] += 1
+            if self.records is not None or self.trace_file is not None:
+                record = TraceRecord(start, chip.hardware_addr, operation,
+                                     register, value, len(data), duration,
+                                     api)
+                if self.records is not None:
+                    self.records.append(record)
+                if self.trace_file is not None:
+                    self._write_record(record)
+
+    def _caller_api(self):
+        frame = sys._getframe(2)
+        for _ in range(MAX_FRAMES):
+            if frame is None:
+                return None
+            api = self._api_codes.get(frame.f_code)
+            if api is None:
+                api = _API_MODULES.get(frame.f_globals.get('__name__'))
+            if api is not None:
+                return api
+            frame = frame.f_back
+        return None
+
+    def _write_record(self, record):
+        if isinstance(record.value, bytes):
+            value = record.value.hex()
+        else:
+            value = "{:02x}".format(record.value)
+        self.trace_file.write("{:.6f},{},{},{},{},{},{:.9f},{}\n".format(
+            record.time, record.hardware_addr, record.operation,
+            record.register_name, value, record.bytes, record.duration,
+            record.api))
+
+    def counters(self):
+        """Returns {(api, operation, register name): transactions}."""
+        with self._lock:
+            return dict(self._counts)
+
+    def durations(self):
+        """Returns {(api, operation, register name): total seconds}."""
+        with self._lock:
+            return dict(self._durations)
+
+    def histograms(self):
+        """Returns {api: counts} of transaction durations, where
+        ``counts[i]`` is the number that took less than ``2 ** i``
+        microseconds (and at least half that). The last count includes
+        everything longer.
+        """
+        with self._lock:
+            return dict((api, list(counts))
+                        for api, counts in self._histograms.items())
+
+    def totals(self):
+        """Returns {api: transactions}."""
+        totals = collections.Counter()
+        for (api, operation, register), count in self.counters().items():
+            totals[api] += count
+        return dict(totals)
+
+    def reset(self):
+        with self._lock:
+            self._counts.clear()
+            self._durations.clear()
+            self._histograms.clear()
+            if self.records is not None:
+                del self.records[:]
+
+    def format_stats(self):
+        counts = self.counters()
+        durations = self.durations()
+        lines = ["{:<8}{:<7}{:<10}{:>10}{:>14}".format(
+            "api", "op", "register", "count", "mean (us)")]
+        for key in sorted(counts):
+            lines.append("{:<8}{:<7}{:<10}{:>10}{:>14.1f}".format(
+                key[0], key[1], key[2], counts[key],
+                durations[key] / counts[key] * 1e6))
+        return "\n".join(lines)
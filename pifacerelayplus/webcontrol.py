@@ -0,0 +1,417 @@
+"""An asyncio web server for controlling PiFace Relay Plus boards.
+
+It understands the same requests as ``examples/simplewebcontrol.py``::
+
+    http://<addr>:<port>/?b0_relay_port=0xAA
+    http://<addr>:<port>/?b1_relay_port__and=0x0F
+    http://<addr>:<port>/?b1_relay_port__or=0x80
+
+and replies with the status of every board as JSON. Board state is kept in
+a cache which is refreshed by a poller (and by interrupts, if enabled) so
+reading the status never touches the SPI bus. Relay port changes are
+collected and written once per board per tick, as one masked write against
+the board's output latch. Connections are kept alive (HTTP/1.1).
+
+Changes can also be streamed as
+`server-sent events <https://html.spec.whatwg.org/#server-sent-events>`_::
+
+    http://<addr>:<port>/events
+
+The first event holds the status of every board and each event after that
+holds only what changed, keyed by board index::
+
+    data: {"1": {"x_port": 2}}
+
+Run with::
+
+    $ python3 -m pifacerelayplus.webcontrol --num-boards 2
+"""
+import argparse
+import asyncio
+import json
+import urllib.parse
+import pifacecommon.mcp23s17
+import pifacerelayplus
+import pifacerelayplus.aio
+
+
+DEFAULT_PORT = 8000
+DEFAULT_POLL_INTERVAL = 0.05  # seconds
+DEFAULT_TICK = 0.005  # seconds
+RELAY_PORT_SET = "b{board_index}_relay_port"
+RELAY_PORT_AND = "b{board_index}_relay_port__and"
+RELAY_PORT_OR = "b{board_index}_relay_port__or"
+EVENTS_PATH = "/events"
+MAX_HEADER_SIZE = 8192
+
+RESPONSE_HEADERS = (
+    ("Content-type", "application/json"),
+    # for access from other sources
+    ("Access-Control-Allow-Origin", "*"),
+    ("Access-Control-Expose-Headers", "Access-Control-Allow-Origin"),
+    ("Access-Control-Allow-Headers",
+     "Origin, X-Requested-With, Content-Type, Accept"),
+)
+
+
+class BadRequest(Exception):
+    pass
+
+
+def parse_query_value(query_value):
+    try:
+        return int(query_value)  # dec
+    except ValueError:
+        return int(query_value, 16)  # hex
+
+
+def parse_relay_port_ops(path, num_boards):
+    """Returns {board_index: (op, value)} from the query string of path,
+    where op is 'set', 'and' or 'or'.
+    """
+    query = urllib.parse.parse_qs(urllib.parse.urlparse(path).query)
+    ops = {}
+    for index in range(num_boards):
+        for op, key in (('set', RELAY_PORT_SET),
+                        ('and', RELAY_PORT_AND),
+                        ('or', RELAY_PORT_OR)):
+            key = key.format(board_index=index)
+            if key in query:
+                try:
+                    ops[index] = (op, parse_query_value(query[key][0]))
+                except ValueError:
+                    raise BadRequest(
+                        "Bad value for {}: {}".format(key, query[key][0]))
+                break
+    return ops
+
+
+class Subscriber(object):
+    """A client of the event stream. Changes which have not been sent yet are
+    merged, so a slow client only ever has one pending change per board
+    (the latest) instead of a backlog.
+    """
+
+    def __init__(self):
+        self.pending = {}  # board index -> {field: value}
+        self.ready = asyncio.Event()
+
+    def push(self, index, delta):
+        self.pending.setdefault(index, {}).update(delta)
+        self.ready.set()
+
+    async def get(self):
+        """Waits for and returns the merged pending changes."""
+        await self.ready.wait()
+        self.ready.clear()
+        pending = self.pending
+        self.pending = {}
+        return pending
+
+
+class WebControlServer(object):
+    """Serves the status of ``boards`` and applies relay port changes.
+
+    :param boards: The boards (index in the list is the ``bN`` number).
+        With interrupts, the boards of a
+        :class:`pifacerelayplus.PiFaceRelayPlusBus` are watched through
+        their shared interrupt line.
+    :param poll_interval: How often to refresh the board state cache
+        (seconds), or ``None`` to rely on interrupts only.
+    :param use_interrupts: Refresh a board as soon as its inputs change.
+    :param tick: How long to collect relay port changes before writing them.
+    """
+
+    def __init__(self, boards, host='', port=DEFAULT_PORT,
+                 poll_interval=DEFAULT_POLL_INTERVAL, use_interrupts=False,
+                 tick=DEFAULT_TICK):
+        self.bus = (boards if isinstance(boards,
+                                         pifacerelayplus.PiFaceRelayPlusBus)
+                    else None)
+        self.boards = list(boards)
+        self.host = host
+        self.port = port
+        self.poll_interval = poll_interval
+        self.use_interrupts = use_interrupts
+        self.tick = tick
+        self.statuses = [None] * len(self.boards)
+        # board index -> (AND mask, OR value, future) of the queued changes
+        self._pending = {}
+        self._flush_handle = None
+        self._server = None
+        self._poller = None
+        self._listeners = []
+        self._writers = set()
+        self.subscribers = set()
+
+    async def start(self):
+        """Reads every board and starts serving."""
+        for index in range(len(self.boards)):
+            self.refresh(index)
+        if self.use_interrupts:
+            self._start_listeners()
+        if self.poll_interval is not None:
+            self._poller = asyncio.ensure_future(self._poll())
+        self._server = await asyncio.start_server(
+            self.handle_connection, self.host, self.port,
+            limit=MAX_HEADER_SIZE)
+
+    async def serve_forever(self):
+        await self.start()
+        try:
+            async with self._server:
+                await self._server.serve_forever()
+        finally:
+            self.close()
+            await self.wait_closed()
+
+    def close(self):
+        """Stops serving and closes the SPI bus of a
+        :class:`pifacerelayplus.PiFaceRelayPlusBus`.
+        """
+        if self._poller is not None:
+            self._poller.cancel()
+        for listener in self._listeners:
+            listener.deactivate()
+        self._listeners = []
+        # event streams only end when their connection does
+        for writer in self._writers:
+            writer.close()
+        if self._server is not None:
+            self._server.close()
+        if self.bus is not None:
+            self.bus.close()
+
+    async def wait_closed(self):
+        """Waits until the server has closed."""
+        if self._server is not None:
+            await self._server.wait_closed()
+
+    def refresh(self, index):
+        """Reads the state of a board into the cache."""
+        state = self.boards[index].snapshot(pifacecommon.mcp23s17.GPIOA,
+                                            pifacecommon.mcp23s17.GPIOB)
+        self.set_status(index, {"x_port": state.x_port,
+                                "y_port": state.y_port,
+                                "relay_port": state.relay_port})
+
+    def set_status(self, index, status):
+        """Updates the cache and tells subscribers what changed."""
+        old_status = self.statuses[index] or {}
+        self.statuses[index] = status
+        delta = dict((k, v) for k, v in status.items()
+                     if old_status.get(k) != v)
+        if delta:
+            for subscriber in self.subscribers:
+                subscriber.push(index, delta)
+
+    async def _poll(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            for index in range(len(self.boards)):
+                if index not in self._pending:
+                    self.refresh(index)
+
+    def _start_listeners(self):
+        if self.bus is not None:
+            # one interrupt line, only the boards that interrupted are read
+            bus_listener = pifacerelayplus.aio.AsyncBusEventListener(
+                self.bus)
+            listeners = [bus_listener[board.hardware_addr]
+                         for board in self.boards]
+        else:
+            bus_listener = None
+            listeners = [pifacerelayplus.aio.AsyncInputEventListener(board)
+                         for board in self.boards]
+        for index, listener in enumerate(listeners):
+            for pin_num in range(8):
+                listener.register(pin_num, pifacerelayplus.IODIR_BOTH,
+                                  lambda event, index=index:
+                                  self.refresh(index),
+                                  settle_time=0)
+        if bus_listener is not None:
+            listeners = [bus_listener]
+        for listener in listeners:
+            listener.activate()
+            self._listeners.append(listener)
+
+    def update_relay_port(self, index, op, value):
+        """Queues a relay port change for the next tick and returns a future
+        which is done (with the new relay port value) once it has been
+        written. AND and OR are applied to the output latch when it is
+        written, not to the cached status.
+        """
+        loop = asyncio.get_running_loop()
+        if index in self._pending:
+            and_mask, or_value, future = self._pending[index]
+        else:
+            and_mask, or_value = 0xff, 0
+            future = loop.create_future()
+        if op == 'set':
+            and_mask, or_value = 0, value
+        elif op == 'and':
+            and_mask &= value
+            or_value &= value
+        elif op == 'or':
+            or_value |= value
+        self._pending[index] = (and_mask, or_value, future)
+        if self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.tick, self._flush)
+        return future
+
+    def _flush(self):
+        self._flush_handle = None
+        pending = self._pending
+        self._pending = {}
+        for index, (and_mask, or_value, future) in pending.items():
+            try:
+                board = self.boards[index]
+                # bits cleared by the AND or set by the OR
+                mask = (~and_mask | or_value) & board.relay_port_mask
+                value = board.write_masked(or_value, mask)
+            except Exception as e:
+                future.set_exception(e)
+                continue
+            status = dict(self.statuses[index])
+            status["relay_port"] = value
+            self.set_status(index, status)
+            future.set_result(value)
+
+    async def handle_request(self, path):
+        """Applies the changes in the query string of path and returns the
+        JSON reply body.
+        """
+        ops = parse_relay_port_ops(path, len(self.boards))
+        futures = [self.update_relay_port(index, op, value)
+                   for index, (op, value) in ops.items()]
+        if futures:
+            await asyncio.gather(*futures)
+        return json.dumps(self.statuses).encode('utf-8')
+
+    async def handle_connection(self, reader, writer):
+        self._writers.add(writer)
+        try:
+            while True:
+                try:
+                    request = await reader.readuntil(b'\r\n\r\n')
+                except (asyncio.IncompleteReadError,
+                        asyncio.LimitOverrunError, ConnectionError):
+                    break
+                keep_alive = await self._respond(request, writer)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    async def _respond(self, request, writer):
+        lines = request.decode('latin-1').split('\r\n')
+        try:
+            method, path, version = lines[0].split(' ', 2)
+        except ValueError:
+            self._write_response(writer, 400, b'', 'HTTP/1.0', False)
+            return False
+        headers = dict((k.strip().lower(), v.strip()) for k, _, v in
+                       (line.partition(':') for line in lines[1:] if line))
+        connection = headers.get('connection', '').lower()
+        if version == 'HTTP/1.1':
+            keep_alive = connection != 'close'
+        else:
+            keep_alive = connection == 'keep-alive'
+        if ('transfer-encoding' in headers or
+                headers.get('content-length', '0') != '0'):
+            # the body is never read, so the connection can't be reused
+            keep_alive = False
+
+        if method not in ('GET', 'HEAD'):
+            self._write_response(writer, 405, b'', version, keep_alive)
+            return keep_alive
+        if method == 'GET' and urllib.parse.urlparse(path).path == EVENTS_PATH:
+            await self.stream_events(writer, version)
+            return False
+        try:
+            body = await self.handle_request(path)
+        except BadRequest as e:
+            self._write_response(writer, 400, str(e).encode('utf-8'),
+                                 version, keep_alive)
+            return keep_alive
+        except Exception as e:
+            self._write_response(writer, 500, str(e).encode('utf-8'),
+                                 version, keep_alive)
+            return keep_alive
+        if method == 'HEAD':
+            body = b''
+        self._write_response(writer, 200, body, version, keep_alive)
+        return keep_alive
+
+    async def stream_events(self, writer, version):
+        """Sends status changes to the client until it disconnects."""
+        head = ["{} 200 OK".format(version),
+                "Content-type: text/event-stream",
+                "Cache-Control: no-cache",
+                "Access-Control-Allow-Origin: *",
+                "Connection: close"]
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1'))
+        subscriber = Subscriber()
+        for index, status in enumerate(self.statuses):
+            subscriber.push(index, status)
+        self.subscribers.add(subscriber)
+        try:
+            while True:
+                delta = await subscriber.get()
+                writer.write(b'data: ' + json.dumps(delta).encode('utf-8') +
+                             b'\n\n')
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self.subscribers.discard(subscriber)
+
+    def _write_response(self, writer, code, body, version, keep_alive):
+        reasons = {200: 'OK', 400: 'Bad Request',
+                   405: 'Method Not Allowed', 500: 'Internal Server Error'}
+        head = ["{} {} {}".format(version, code, reasons[code])]
+        head.extend("{}: {}".format(k, v) for k, v in RESPONSE_HEADERS)
+        head.append("Content-Length: {}".format(len(body)))
+        head.append("Connection: {}".format(
+            'keep-alive' if keep_alive else 'close'))
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') +
+                     body)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Control PiFace Relay Plus boards over HTTP.")
+    parser.add_argument('-p', '--port', help='Port to use.',
+                        default=DEFAULT_PORT, type=int)
+    parser.add_argument('-nib', '--no_init_board', dest='init_board',
+                        action='store_false',
+                        help="Do not initialise the board.")
+    parser.add_argument('-n', '--num-boards',
+                        help='Number of PiFace Relay Plus boards attached.',
+                        default=1, type=int)
+    parser.add_argument('--poll-interval', type=float,
+                        default=DEFAULT_POLL_INTERVAL,
+                        help="Seconds between board state refreshes.")
+    parser.add_argument('--interrupts', action='store_true',
+                        help="Also refresh boards when their inputs change.")
+    args = parser.parse_args(argv)
+
+    boards = pifacerelayplus.PiFaceRelayPlusBus(
+        plus_boards=pifacerelayplus.RELAY,
+        hardware_addrs=range(args.num_boards),
+        init_board=args.init_board)
+    server = WebControlServer(boards, port=args.port,
+                              poll_interval=args.poll_interval,
+                              use_interrupts=args.interrupts)
+    print("Starting PiFace web control ({n}x PiFace Relay Plus) on port "
+          "{port}".format(n=len(boards), port=args.port))
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        print('^C received, shutting down server')
+
+
+if __name__ == '__main__':
+    main()
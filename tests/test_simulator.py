@@ -0,0 +1,1314 @@
+import asyncio
+import io
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import pifacerelayplus
+import pifacerelayplus.aio
+import pifacerelayplus.benchmark
+import pifacerelayplus.daemon
+import pifacerelayplus.debounce
+import pifacerelayplus.journal
+import pifacerelayplus.pwm
+import pifacerelayplus.sampler
+import pifacerelayplus.scheduler
+import pifacerelayplus.sequence
+import pifacerelayplus.simulator
+import pifacerelayplus.trace
+import pifacerelayplus.webcontrol
+from pifacecommon.mcp23s17 import (
+    GPIOA,
+    GPIOB,
+    DEFVALB,
+    GPINTENB,
+    INTCONB,
+    INTFB,
+    IOCON,
+    INTCAPB,
+)
+
+
+class TestSimulatedRelayBoard(unittest.TestCase):
+
+    def setUp(self):
+        self.spi = pifacerelayplus.simulator.SimulatedSPIBus()
+        self.pfrp = pifacerelayplus.PiFaceRelayPlus(
+            plus_board=pifacerelayplus.RELAY, spi=self.spi)
+        self.chip = self.spi.chips[0]
+        self.spi.reset_counters()
+
+    def test_relays(self):
+        self.pfrp.relays[0].turn_on()
+        self.pfrp.relays[7].turn_on()
+        self.assertEqual(self.chip.registers[GPIOA + 2], 0x88)
+        self.assertEqual(self.pfrp.relay_port.value, 0x88)
+        # read-modify-write for each relay
+        self.assertEqual(self.spi.transactions, 5)
+
+    def test_inputs(self):
+        self.assertEqual(self.pfrp.x_port.value, 0)
+        self.spi.set_input(0, GPIOB, 5, 0)
+        self.spi.set_input(0, GPIOB, 2, 0)
+        self.assertEqual(self.pfrp.x_pins[1].value, 1)
+        self.assertEqual(self.pfrp.x_port.value, 0b0010)
+        self.assertEqual(self.pfrp.y_port.value, 0b0100)
+
+    def test_interrupt_capture(self):
+        self.spi.set_input(0, GPIOB, 6, 0)
+        self.assertEqual(self.pfrp.read(INTFB), 0x40)
+        self.assertEqual(self.pfrp.read(INTCAPB), 0xbf)
+        # reading the capture register clears the interrupt
+        self.assertEqual(self.pfrp.read(INTFB), 0)
+
+    def test_input_event_str(self):
+        event = pifacerelayplus.InputEvent(0x01, 0xff, self.pfrp, 1.5)
+        self.assertEqual(str(event).splitlines(),
+                         ["interrupt_flag:    0b1",
+                          "interrupt_capture: 0b11111111",
+                          "pin_num:           0",
+                          "direction:         1",
+                          "chip:              {}".format(self.pfrp),
+                          "timestamp:         1.5"])
+
+    def test_snapshot(self):
+        self.pfrp.relays[1].turn_on()
+        self.spi.set_input(0, GPIOB, 4, 0)
+        self.spi.reset_counters()
+        state = self.pfrp.snapshot()
+        self.assertEqual(self.spi.transactions, 1)
+        self.assertEqual(state.relays, (0, 1, 0, 0, 0, 0, 0, 0))
+        self.assertEqual(state.x_pins, (1, 0, 0, 0))
+        self.assertEqual(state.y_port, 0)
+        self.assertIsNone(state.buttons)
+
+    def test_snapshot_without_sequential_mode(self):
+        self.pfrp.relays[1].turn_on()
+        # configured by something else, with sequential mode off
+        self.chip.registers[IOCON] = 0x28
+        pfrp = pifacerelayplus.PiFaceRelayPlus(
+            plus_board=pifacerelayplus.RELAY, spi=self.spi, init_board=False)
+        for _ in range(2):
+            self.spi.reset_counters()
+            state = pfrp.snapshot()
+            self.assertEqual(state.relays, (0, 1, 0, 0, 0, 0, 0, 0))
+            self.assertEqual(self.chip.iocon, 0x28)
+            # IOCON read, written, burst read, IOCON put back
+            self.assertEqual(self.spi.transactions, 4)
+
+    def test_batch(self):
+        with self.pfrp.batch():
+            self.pfrp.relays[0].turn_on()
+            self.pfrp.relays[4].turn_on()
+            self.pfrp.relays[0].turn_off()
+            self.assertEqual(self.chip.registers[GPIOA + 2], 0)
+        self.assertEqual(self.chip.registers[GPIOA + 2], 0x10)
+        # one latch read and one write
+        self.assertEqual(self.spi.transactions, 2)
+
+    def test_batch_error(self):
+        self.pfrp.relays[1].turn_on()
+        latch = self.chip.registers[GPIOA + 2]
+        with self.assertRaises(ZeroDivisionError):
+            with self.pfrp.batch():
+                self.pfrp.relays[0].turn_on()
+                1 / 0
+        # nothing written
+        self.assertEqual(self.chip.registers[GPIOA + 2], latch)
+        self.assertEqual(self.pfrp.relays[0].value, 0)
+        with self.pfrp.batch():
+            self.pfrp.relays[2].turn_on()
+        self.assertEqual(self.pfrp.relays[1].value, 1)
+        self.assertEqual(self.pfrp.relays[2].value, 1)
+
+    def test_batch_read_from_other_thread(self):
+        values = []
+        with self.pfrp.batch():
+            self.pfrp.relays[0].turn_on()
+            self.assertEqual(self.pfrp.relays[0].value, 1)
+            thread = threading.Thread(
+                target=lambda: values.append(self.pfrp.relays[0].value))
+            thread.start()
+            thread.join(5)
+        # not sent yet
+        self.assertEqual(values, [0])
+        self.assertEqual(self.pfrp.relays[0].value, 1)
+
+    def test_bit_operations(self):
+        self.assertEqual(self.pfrp.set_bits(0x81), 0x81)
+        self.assertEqual(self.pfrp.clear_bits(0x01), 0x80)
+        self.assertEqual(self.pfrp.toggle_bits(0xc0), 0x40)
+        self.assertEqual(self.pfrp.write_masked(0x0f, 0x03), 0x43)
+        self.assertEqual(self.chip.registers[GPIOA + 2], 0x43)
+        # the latch is read back before each write without shadow registers
+        self.assertEqual(self.spi.transactions, 8)
+
+
+class TestLayout(unittest.TestCase):
+
+    def test_encode_decode(self):
+        spi = pifacerelayplus.simulator.SimulatedSPIBus()
+        for plus_board in (pifacerelayplus.RELAY, pifacerelayplus.MOTOR_DC,
+                           pifacerelayplus.BUTTON):
+            pfrp = pifacerelayplus.PiFaceRelayPlus(plus_board=plus_board,
+                                                   spi=spi)
+            for name, group in pfrp.layout.groups.items():
+                if name in ('x_pins', 'y_pins', 'buttons'):
+                    continue  # inputs
+                pins = pfrp._pins(name)
+                for vector in (0, 0b0101, group.vector_mask):
+                    for address, (mask, bits) in group.encode(vector).items():
+                        pfrp._write_latch_bits(address, mask, bits)
+                    self.assertEqual(
+                        tuple(pin.value for pin in pins),
+                        group.values(vector), (plus_board, name, vector))
+                    registers = {GPIOA: pfrp.gpioa.value,
+                                 GPIOB: pfrp.gpiob.value}
+                    self.assertEqual(group.decode(registers), vector)
+
+    def test_shared_registers(self):
+        layout = pifacerelayplus.LAYOUTS[pifacerelayplus.MOTOR_DC]
+        self.assertEqual(layout.groups['motors'].masks,
+                         {GPIOA: 0xf0, GPIOB: 0x0f})
+        self.assertEqual(layout.groups['motors'].xor_masks,
+                         {GPIOA: 0, GPIOB: 0x0f})
+        self.assertEqual(layout.shared_registers()[GPIOA][:5],
+                         [('relays', 0), ('relays', 1), ('relays', 2),
+                          ('relays', 3), ('motors', 4)])
+        relays = pifacerelayplus.LAYOUTS[pifacerelayplus.RELAY].groups[
+            'relays']
+        self.assertEqual(relays.encode(0b10, channels=0b11),
+                         {GPIOA: (0b1100, 0b0100)})
+
+
+class TestVectorAPI(unittest.TestCase):
+
+    def board(self, plus_board):
+        self.spi = pifacerelayplus.simulator.SimulatedSPIBus()
+        pfrp = pifacerelayplus.PiFaceRelayPlus(
+            plus_board=plus_board, spi=self.spi, shadow_registers=True)
+        self.spi.reset_counters()
+        return pfrp
+
+    def test_relays_and_inputs(self):
+        pfrp = self.board(pifacerelayplus.RELAY)
+        pfrp.set_relays([1, 0, 1, 1, 0, 0, 0, 1])
+        self.assertEqual(self.spi.transactions, 1)
+        self.assertEqual([relay.value for relay in pfrp.relays],
+                         [1, 0, 1, 1, 0, 0, 0, 1])
+        pfrp.set_relays([0, 1])
+        self.assertEqual(pfrp.snapshot().relays, (0, 1, 1, 1, 0, 0, 0, 1))
+        pfrp.set_relays(0b10000000)
+        self.assertEqual(pfrp.snapshot().relays, (0, 0, 0, 0, 0, 0, 0, 1))
+
+        self.spi.set_input(0, GPIOB, 5, 0)  # x-pin 1
+        self.spi.set_input(0, GPIOB, 2, 0)  # y-pin 2
+        self.spi.reset_counters()
+        self.assertEqual(pfrp.get_inputs(), (0, 1, 0, 0, 0, 0, 1, 0))
+        self.assertEqual(self.spi.transactions, 1)
+
+    def test_leds(self):
+        pfrp = self.board(pifacerelayplus.BUTTON)
+        pfrp.set_leds(0b1010)
+        self.assertEqual(pfrp.led_port.value, 0b1010)
+        with self.assertRaises(AttributeError):
+            self.board(pifacerelayplus.RELAY).set_leds(0)
+
+    def test_motors(self):
+        pfrp = self.board(pifacerelayplus.MOTOR_DC)
+        pfrp.inrush_budget.max_starts = 3
+        pfrp.set_motors(['forward', 'reverse', None, 'forward'])
+        self.assertEqual(self.spi.transactions, 2)  # GPIOA and GPIOB
+        self.assertEqual([motor._current_state for motor in pfrp.motors],
+                         ['forward', 'reverse', 'brake', 'forward'])
+        self.assertEqual(pfrp.snapshot().gpioa, 0b01000000)
+        self.assertEqual(pfrp.snapshot().gpiob & 0x0f, 0b0110)
+
+        self.spi.reset_counters()
+        with self.assertRaises(pifacerelayplus.MotorForwardReverseError):
+            pfrp.set_motors(['brake', 'forward'])
+        with self.assertRaises(pifacerelayplus.MotorTooSoonError):
+            pfrp.set_motors([None, None, 'forward'])
+        self.assertEqual(self.spi.transactions, 0)
+        self.assertEqual(pfrp.motors[0]._current_state, 'forward')
+
+
+class TestShadowRegisters(unittest.TestCase):
+
+    def setUp(self):
+        self.spi = pifacerelayplus.simulator.SimulatedSPIBus()
+        self.pfrp = pifacerelayplus.PiFaceRelayPlus(
+            plus_board=pifacerelayplus.MOTOR_DC, shadow_registers=True,
+            spi=self.spi)
+        self.chip = self.spi.chips[0]
+        self.spi.reset_counters()
+
+    def test_batch_error(self):
+        self.pfrp.motors[0].brake()
+        registers = bytes(self.chip.registers)
+        with self.assertRaises(ZeroDivisionError):
+            with self.pfrp.batch():
+                self.pfrp.motors[0].coast()
+                self.pfrp.relays[1].turn_on()
+                1 / 0
+        self.assertEqual(bytes(self.chip.registers), registers)
+        self.assertEqual(self.pfrp.motors[0]._current_state, 'brake')
+        self.assertEqual(self.pfrp.relays[1].value, 0)
+
+    def test_writes_only(self):
+        self.pfrp.relays[0].turn_on()
+        self.assertEqual(self.pfrp.relays[0].value, 1)
+        self.pfrp.motors[3].forward()
+        self.assertEqual(self.chip.registers[GPIOA + 2], 0x48)
+        # motor 3 pin 2 is already low
+        self.assertEqual(self.spi.transactions, 2)
+        self.assertEqual(self.pfrp.spi_transactions_saved, 5)
+        self.assertEqual(self.pfrp.writes_suppressed, 1)
+
+    def test_suppressed_writes(self):
+        pfrp = self.pfrp
+        pfrp.inrush_budget.max_starts = 1
+        pfrp.motors[0].forward()
+        pfrp.relay_port.value = 0x5
+        self.spi.reset_counters()
+        pfrp.writes_suppressed = 0
+        for _ in range(3):
+            # re-asserting the same state
+            pfrp.relay_port.value = 0x5
+            pfrp.motors[0].forward()
+            pfrp.motors[2].brake()
+            pfrp.set_motors(['forward', None, 'brake'])
+            with pfrp.batch():
+                pfrp.relays[0].turn_on()
+                pfrp.relays[0].turn_off()
+        self.assertEqual(self.spi.transactions, 0)
+        self.assertEqual(pfrp.writes_suppressed, 3 * 8)
+        self.assertEqual(pfrp.inrush_budget.starts_suppressed, 3 * 2)
+        # the board may have been reset
+        self.chip.registers[GPIOA + 2] = 0
+        pfrp.init_board(pfrp.gpioa_conf, pfrp.gpiob_conf)
+        self.assertEqual(pfrp.motors[0]._current_state, 'coast')
+        pfrp.relay_port.value = 0
+        self.assertEqual(self.chip.registers[GPIOA + 2], 0)
+        pfrp.relay_port.value = 0x5
+        self.assertEqual(self.chip.registers[GPIOA + 2], 0x5)
+
+    def test_suppressed_writes_without_shadow_registers(self):
+        # two objects driving the same board
+        pfrp_a, pfrp_b = [
+            pifacerelayplus.PiFaceRelayPlus(
+                plus_board=pifacerelayplus.RELAY, spi=self.spi,
+                init_board=False)
+            for _ in range(2)]
+        pfrp_a.relays[0].turn_on()
+        pfrp_b.relays[0].turn_off()
+        pfrp_a.relays[0].turn_on()
+        self.assertEqual(self.chip.registers[GPIOA + 2] & 0x08, 0x08)
+        self.assertEqual(pfrp_a.writes_suppressed, 0)
+        pfrp_b.relays[0].turn_on()
+        self.assertEqual(pfrp_b.writes_suppressed, 1)
+        pfrp_a.relay_port.value = 0xff
+        pfrp_b.relay_port.value = 0
+        pfrp_a.relay_port.value = 0xff
+        self.assertEqual(self.chip.registers[GPIOA + 2], 0xff)
+
+    def test_masked_writes_without_shadow_registers(self):
+        pfrp_a, pfrp_b = [
+            pifacerelayplus.PiFaceRelayPlus(
+                plus_board=pifacerelayplus.RELAY, spi=self.spi,
+                init_board=False)
+            for _ in range(2)]
+        pfrp_a.set_bits(0x01)
+        pfrp_b.set_bits(0x80)
+        # the latch is read back, not taken from what pfrp_a last wrote
+        self.assertEqual(pfrp_a.write_masked(0x02, 0x02), 0x83)
+        self.assertEqual(pfrp_b.toggle_bits(0x01), 0x82)
+        self.assertEqual(pfrp_a.toggle_bits(0x80), 0x02)
+        self.assertEqual(self.chip.registers[GPIOA + 2], 0x02)
+
+    def test_resync(self):
+        self.chip.registers[GPIOB + 2] = 0x0c
+        self.pfrp.resync_registers()
+        self.assertEqual(self.pfrp.gpiob.value, 0x0c)
+
+
+class TestSequence(unittest.TestCase):
+
+    def setUp(self):
+        self.spi = pifacerelayplus.simulator.SimulatedSPIBus()
+        self.pfrp = pifacerelayplus.PiFaceRelayPlus(
+            plus_board=pifacerelayplus.RELAY, spi=self.spi)
+        self.chip = self.spi.chips[0]
+        self.sequence = pifacerelayplus.sequence.Sequence()
+        self.sequence.pulse(self.pfrp.relays[4], 0, 0.02)
+        self.sequence.pulse(self.pfrp.relays[5], 0, 0.01)
+        self.sequence.add(0.01, self.pfrp.relays[6], 1)
+        self.spi.reset_counters()
+
+    def test_play(self):
+        results = self.sequence.play()
+        self.assertEqual(len(results), 5)
+        self.assertTrue(all(r.error >= 0 for r in results))
+        self.assertEqual(self.chip.registers[GPIOA + 2], 0x40)
+        # one latch read and one write for each of the three times
+        self.assertEqual(self.spi.transactions, 6)
+
+    def test_play_async(self):
+        asyncio.run(self.sequence.play_async())
+        self.assertEqual(self.chip.registers[GPIOA + 2], 0x40)
+
+    def test_merged_writes(self):
+        self.sequence.add(0.01, self.pfrp.relay_port, 0x0f)
+        steps = self.sequence.steps()
+        self.assertEqual([t for t, events, writes in steps], [0, 0.01, 0.02])
+        self.assertEqual(steps[1][2], {(self.pfrp, GPIOA): (0xff, 0x0f)})
+
+    def test_rounded_times(self):
+        self.sequence.add(0.1 + 0.2, self.pfrp.relays[6], 1)
+        self.sequence.add(0.3, self.pfrp.relays[7], 1)
+        steps = self.sequence.steps()
+        self.assertEqual([t for t, events, writes in steps],
+                         [0, 0.01, 0.02, 0.3])
+        self.assertEqual(len(steps[3][1]), 2)
+        self.assertEqual(steps[3][2], {(self.pfrp, GPIOA): (0xc0, 0xc0)})
+
+
+class TestMotorScheduler(unittest.TestCase):
+
+    def setUp(self):
+        spi = pifacerelayplus.simulator.SimulatedSPIBus(
+            hardware_addrs=(0, 1))
+        self.boards = pifacerelayplus.PiFaceRelayPlusBus(
+            pifacerelayplus.MOTOR_DC, spi=spi, shadow_registers=True)
+        for board in self.boards:
+            board.inrush_budget.window = 0.05
+        self.scheduler = pifacerelayplus.scheduler.MotorScheduler()
+
+    def tearDown(self):
+        self.scheduler.close()
+
+    def test_budget_order(self):
+        done = []
+        futures = []
+        for i in (0, 1):
+            for board in self.boards:
+                future = self.scheduler.forward(board.motors[i])
+                future.add_done_callback(
+                    lambda f, key=(board.hardware_addr, i): done.append(key))
+                futures.append(future)
+        self.assertEqual([f.result(1) for f in futures], ['forward'] * 4)
+        # one start per board per window, the boards don't wait for each
+        # other
+        self.assertEqual(sorted(done[:2]), [(0, 0), (1, 0)])
+        self.assertEqual(sorted(done[2:]), [(0, 1), (1, 1)])
+
+    def test_too_soon_keeps_order(self):
+        motors = self.boards[0].motors
+        budget = self.boards[0].inrush_budget
+        next_start_time = budget.next_start_time
+        early = []
+
+        def too_soon(now=None):
+            # claim the slot is free once, so the start is refused
+            if not early:
+                early.append(now)
+                return now
+            return next_start_time(now)
+
+        self.scheduler.forward(motors[0])
+        done = []
+        futures = []
+        budget.next_start_time = too_soon
+        for motor in motors[1:]:
+            future = self.scheduler.forward(motor)
+            future.add_done_callback(
+                lambda f, motor=motor: done.append(motor))
+            futures.append(future)
+        self.assertEqual([f.result(1) for f in futures], ['forward'] * 3)
+        self.assertEqual(len(early), 1)
+        self.assertEqual(done, list(motors[1:]))
+
+    def test_coast_and_brake_run_now(self):
+        motors = self.boards[0].motors
+        self.scheduler.forward(motors[0])
+        queued = self.scheduler.forward(motors[1])
+        self.assertFalse(queued.done())
+        for command in ('coast', 'brake'):
+            future = self.scheduler.submit(motors[2], command)
+            self.assertTrue(future.done())
+            self.assertEqual(motors[2]._current_state, command)
+        self.assertEqual(queued.result(1), 'forward')
+
+    def test_forward_reverse_error(self):
+        motor = self.boards[0].motors[0]
+        motor.forward()
+        future = self.scheduler.reverse(motor)
+        self.assertIsInstance(future.exception(1),
+                              pifacerelayplus.MotorForwardReverseError)
+        self.assertEqual(motor._current_state, 'forward')
+
+    def test_new_command_cancels_queued(self):
+        motors = self.boards[0].motors
+        self.scheduler.forward(motors[0])
+        queued = self.scheduler.forward(motors[1])
+        braked = self.scheduler.brake(motors[1])
+        self.assertTrue(queued.cancelled())
+        self.assertEqual(braked.result(1), 'brake')
+        time.sleep(0.1)
+        self.assertEqual(motors[1]._current_state, 'brake')
+
+    def test_close(self):
+        motors = self.boards[0].motors
+        self.scheduler.forward(motors[0])
+        queued = self.scheduler.forward(motors[1])
+        self.scheduler.close()
+        self.assertTrue(queued.cancelled())
+        self.assertIsNone(self.scheduler._thread)
+        time.sleep(0.1)
+        self.assertEqual(motors[1]._current_state, 'brake')
+
+
+class TestStepper(unittest.TestCase):
+
+    def setUp(self):
+        self.spi = pifacerelayplus.simulator.SimulatedSPIBus()
+        self.pfrp = pifacerelayplus.PiFaceRelayPlus(
+            plus_board=pifacerelayplus.MOTOR_STEPPER, spi=self.spi,
+            shadow_registers=True)
+        self.chip = self.spi.chips[0]
+
+    def test_step_times(self):
+        step_times = pifacerelayplus.step_times
+        self.assertEqual(step_times(1, 0.01, 1000), [0.0])
+        self.assertEqual(step_times(3, 0.01), [0.0, 0.01, 0.02])
+        # as fast as possible
+        self.assertEqual(step_times(3, 0, 1000), [0.0, 0.0, 0.0])
+        times = step_times(101, 0.002, 10000)
+        intervals = [b - a for a, b in zip(times, times[1:])]
+        self.assertEqual(times[0], 0)
+        self.assertAlmostEqual(min(intervals), 0.002)
+        # ramps up and down symmetrically
+        self.assertTrue(all(a > b for a, b in zip(intervals[:10],
+                                                  intervals[1:11])))
+        for a, b in zip(intervals, reversed(intervals)):
+            self.assertAlmostEqual(a, b)
+        # too short to reach full speed
+        intervals = step_times(5, 0.002, 10000)
+        self.assertGreater(min(b - a for a, b in zip(intervals,
+                                                     intervals[1:])), 0.002)
+        with self.assertRaises(ValueError):
+            step_times(10, -0.001)
+        with self.assertRaises(ValueError):
+            step_times(10, 0.001, -1)
+
+    def test_patterns(self):
+        states = pifacerelayplus.MotorStepper.half_step_states
+        # stepper 0 is GPIOB bits 0-3 (inverted), stepper 1 GPIOA bits 4-7
+        self.assertEqual(self.pfrp.motors[0]._patterns,
+                         tuple(state ^ 0xf for state in states))
+        self.assertEqual(self.pfrp.motors[1]._patterns,
+                         tuple(state << 4 for state in states))
+        self.pfrp.relays[0].turn_on()
+        self.spi.reset_counters()
+        self.pfrp.motors[1].forward(4, step_delay=0)
+        # one write per step, the relays are left alone
+        self.assertEqual(self.spi.transactions, 4)
+        self.assertEqual(self.chip.registers[GPIOA + 2],
+                         states[4] << 4 | 0x08)
+        self.pfrp.motors[1].reverse(2, step_delay=0)
+        self.assertEqual(self.chip.registers[GPIOA + 2] >> 4, states[2])
+        self.pfrp.motors[0].brake()
+        self.assertEqual(self.chip.registers[GPIOB + 2] & 0xf, 0)
+
+
+class TestSoftPWM(unittest.TestCase):
+
+    def setUp(self):
+        self.spi = pifacerelayplus.simulator.SimulatedSPIBus()
+        self.pfrp = pifacerelayplus.PiFaceRelayPlus(
+            plus_board=pifacerelayplus.MOTOR_DC, spi=self.spi,
+            shadow_registers=True)
+        self.pwm = pifacerelayplus.pwm.SoftPWM(frequency=200)
+
+    def test_edges(self):
+        half = [self.pwm.add_pin(self.pfrp.relays[i], 0.5) for i in (0, 1)]
+        full = self.pwm.add_pin(self.pfrp.relays[2], 1)
+        self.spi.reset_counters()
+        self.pwm.start()
+        time.sleep(0.1)
+        self.pwm.stop()
+        # switched on once a period, and off again unless stopped in between
+        self.assertGreaterEqual(full.edges, 2)
+        self.assertIn(half[0].edges, (2 * full.edges - 1, 2 * full.edges))
+        self.assertEqual(half[0].edges, half[1].edges)
+        self.assertGreater(half[0].max_jitter, 0)
+        self.assertLessEqual(half[0].mean_jitter, half[0].max_jitter)
+        # the relays share GPIOA: one write per edge, and one to stop
+        self.assertEqual(self.spi.transactions, half[0].edges + 1)
+        self.assertEqual(self.pfrp.relay_port.value, 0)
+
+    def test_frequency_per_channel(self):
+        fast = self.pwm.add_pin(self.pfrp.relays[0], 0.5)
+        slow = self.pwm.add_pin(self.pfrp.relays[1], 0.5, frequency=50)
+        self.pwm.start()
+        time.sleep(0.2)
+        self.pwm.stop()
+        self.assertGreaterEqual(slow.edges, 4)
+        self.assertGreater(fast.edges, 3 * slow.edges)
+
+    def test_thread_error(self):
+        channel = self.pwm.add_pin(self.pfrp.relays[0], 1)
+        self.pwm.start()
+        time.sleep(0.02)
+        self.assertEqual(self.pfrp.relays[0].value, 1)
+
+        def fail():
+            raise IOError("SPI failed")
+
+        channel._start = fail
+        self.pwm._thread.join(1)
+        # switched off as soon as the thread stops
+        self.assertEqual(self.pfrp.relays[0].value, 0)
+        with self.assertRaises(IOError):
+            self.pwm.stop()
+        self.pwm.stop()
+
+    def test_motor_inrush(self):
+        motors = [self.pwm.add_motor(self.pfrp.motors[i], 'forward', 0.5)
+                  for i in (0, 1)]
+        states = [motor.motor._current_state for motor in motors]
+        self.pwm.start()
+        time.sleep(0.05)
+        running = [motor.running for motor in motors]
+        # the second motor hasn't been driven yet
+        self.assertEqual([motor.motor._current_state for motor in motors],
+                         ['forward', states[1]])
+        self.assertNotEqual(states[1], 'forward')
+        time.sleep(pifacerelayplus.core.MOTOR_CONTROL_WINDOW + 0.05)
+        self.pwm.stop()
+        # one start per window
+        self.assertEqual(running, [True, False])
+        self.assertGreater(motors[1].edges, 0)
+        self.assertEqual([motor.running for motor in motors], [False, False])
+        self.assertEqual([motor.motor._current_state for motor in motors],
+                         ['brake', 'brake'])
+
+    def test_remove_channel(self):
+        channel = self.pwm.add_pin(self.pfrp.relays[0], 1)
+        self.pwm.start()
+        for _ in range(10):
+            time.sleep(0.002)
+            self.pwm.remove_channel(channel)
+            time.sleep(2 / self.pwm.frequency)
+            self.assertEqual(self.pfrp.relays[0].value, 0)
+            self.pwm.add_channel(channel)
+        self.pwm.stop()
+
+
+class TestAsyncInputEventListener(unittest.TestCase):
+
+    def setUp(self):
+        self.spi = pifacerelayplus.simulator.SimulatedSPIBus()
+        self.pfrp = pifacerelayplus.PiFaceRelayPlus(
+            plus_board=pifacerelayplus.RELAY, spi=self.spi)
+        self.listener = pifacerelayplus.aio.AsyncInputEventListener(
+            self.pfrp, settle_time=0)
+
+    def test_events_on_loop(self):
+        events = []
+
+        def on_press(event):
+            events.append((event, asyncio.get_running_loop(),
+                           threading.get_ident()))
+
+        self.listener.register(4, pifacerelayplus.IODIR_ON, on_press)
+
+        async def press():
+            loop = asyncio.get_running_loop()
+            self.listener.activate()
+            iterator = self.listener.__aiter__()
+            self.spi.set_input(0, GPIOB, 4, 0)
+            event = await asyncio.wait_for(iterator.__anext__(), 1)
+            self.assertEqual(event.pin_num, 4)
+            self.assertEqual(event.direction, pifacerelayplus.IODIR_ON)
+            self.assertEqual(len(events), 1)
+            self.assertIs(events[0][0], event)
+            self.assertIs(events[0][1], loop)
+            self.assertEqual(events[0][2], threading.get_ident())
+
+            fd = self.listener.interrupt_line._epoll.fileno()
+            self.listener.deactivate()
+            self.assertIsNone(self.listener.interrupt_line)
+            # the loop is no longer watching the interrupt line
+            self.assertFalse(loop.remove_reader(fd))
+            self.spi.set_input(0, GPIOB, 4, 1)
+            self.spi.set_input(0, GPIOB, 4, 0)
+            await asyncio.sleep(0.02)
+            self.assertEqual(len(events), 1)
+
+        asyncio.run(press())
+
+
+class TestDebouncer(unittest.TestCase):
+
+    def bounce(self, mask_interrupts):
+        spi = pifacerelayplus.simulator.SimulatedSPIBus()
+        pfrp = pifacerelayplus.PiFaceRelayPlus(
+            plus_board=pifacerelayplus.RELAY, spi=spi)
+        # the window is well over the bounce time, even on a busy machine
+        debouncer = pifacerelayplus.debounce.Debouncer(
+            window=0.05, mask_interrupts=mask_interrupts)
+        holds = []
+        debouncer.set_long_press(4, holds.append, long_press=0.1,
+                                 repeat_interval=0.05)
+        listener = pifacerelayplus.aio.AsyncInputEventListener(
+            pfrp, debouncer=debouncer)
+        events = []
+        listener.register(4, pifacerelayplus.IODIR_BOTH, events.append)
+
+        async def press():
+            listener.activate()
+            # bouncing press, held, bouncing release
+            for levels, hold_time in (((0, 1, 0, 1, 0), 0.2),
+                                      ((1, 0, 1), 0.1),
+                                      # glitch shorter than the window
+                                      ((0, 1), 0.1)):
+                for level in levels:
+                    spi.set_input(0, GPIOB, 4, level)
+                    await asyncio.sleep(0.002)
+                await asyncio.sleep(hold_time)
+            listener.deactivate()
+
+        asyncio.run(press())
+        self.assertEqual([e.direction for e in events], [0, 1, 0, 1])
+        self.assertEqual([h.repeat for h in holds[:2]], [0, 1])
+        self.assertGreaterEqual(holds[0].held_time, 0.1)
+        self.assertEqual(debouncer.accepted[4], 4)
+        return debouncer
+
+    def test_masked_interrupts(self):
+        debouncer = self.bounce(True)
+        # bounces never reach the Pi
+        self.assertEqual(debouncer.suppressed[4], 0)
+
+    def test_software(self):
+        debouncer = self.bounce(False)
+        self.assertEqual(debouncer.suppressed[4], 7)
+
+    def test_stop_during_window(self):
+        spi = pifacerelayplus.simulator.SimulatedSPIBus()
+        pfrp = pifacerelayplus.PiFaceRelayPlus(
+            plus_board=pifacerelayplus.RELAY, spi=spi)
+        chip = spi.chips[0]
+        registers = [chip.registers[GPINTENB], chip.registers[DEFVALB],
+                     chip.registers[INTCONB]]
+        debouncer = pifacerelayplus.debounce.Debouncer(window=1)
+        listener = pifacerelayplus.aio.AsyncInputEventListener(
+            pfrp, debouncer=debouncer)
+
+        async def press():
+            listener.activate()
+            spi.set_input(0, GPIOB, 4, 0)
+            await asyncio.sleep(0.01)
+            self.assertEqual(chip.registers[GPINTENB], 0xef)
+            listener.deactivate()
+
+        asyncio.run(press())
+        self.assertEqual(debouncer.accepted[4], 1)
+        self.assertEqual([chip.registers[GPINTENB], chip.registers[DEFVALB],
+                          chip.registers[INTCONB]], registers)
+
+    def test_threaded_listener(self):
+        spi = pifacerelayplus.simulator.SimulatedSPIBus()
+        pfrp = pifacerelayplus.PiFaceRelayPlus(
+            plus_board=pifacerelayplus.RELAY, spi=spi)
+        debouncer = pifacerelayplus.debounce.Debouncer(window=0.05)
+        listener = pifacerelayplus.InputEventListener(
+            pfrp, debouncer=debouncer)
+        events = []
+        listener.register(4, pifacerelayplus.IODIR_BOTH, events.append)
+        listener.register(5, pifacerelayplus.IODIR_BOTH, events.append)
+        # the detector process needs the interrupt GPIO, so this test
+        # reads the board and queues the events itself
+        debouncer.start(listener)
+        listener.dispatcher.start()
+        for levels in ((0, 1, 0), (1, 0, 1)):
+            for level in levels:
+                spi.set_input(0, GPIOB, 4, level)
+                event = pfrp.read_input_event()
+                if event is not None:
+                    listener.event_queue.add_event(event)
+                time.sleep(0.002)
+            time.sleep(0.1)
+        # pins flagged together are debounced one by one
+        listener.event_queue.add_event(pifacerelayplus.InputEvent(
+            0x30, 0xcf, pfrp, time.time()))
+        time.sleep(0.01)
+        listener.event_queue.put(listener.TERMINATE_SIGNAL)
+        listener.dispatcher.join()
+        debouncer.stop()
+        self.assertEqual([(e.pin_num, e.direction) for e in events],
+                         [(4, 0), (4, 1), (4, 0), (5, 0)])
+        self.assertEqual(spi.chips[0].registers[GPINTENB], 0xff)
+
+
+class TestInputSampler(unittest.TestCase):
+
+    def setUp(self):
+        self.spi = pifacerelayplus.simulator.SimulatedSPIBus()
+        self.pfrp = pifacerelayplus.PiFaceRelayPlus(
+            plus_board=pifacerelayplus.RELAY, spi=self.spi)
+        self.sampler = pifacerelayplus.sampler.InputSampler(
+            self.pfrp, rate=2000, capacity=64)
+
+    def test_ring_buffer(self):
+        self.spi.reset_counters()
+        self.sampler.start()
+        time.sleep(0.1)
+        self.sampler.stop()
+        self.assertGreater(self.sampler.samples, 64)
+        self.assertEqual(self.spi.transactions, self.sampler.samples)
+        self.assertGreater(self.sampler.achieved_rate, 0)
+        segments = self.sampler.segments()
+        self.assertEqual(sum(len(values) for values, t in segments), 64)
+        timestamps = [t for values, ts in segments for t in ts]
+        self.assertEqual(timestamps, sorted(timestamps))
+
+    def test_trigger(self):
+        self.sampler.set_trigger(0x10, 0, pre_samples=10, post_samples=20)
+        self.sampler.start()
+        time.sleep(0.02)
+        self.spi.set_input(0, GPIOB, 4, 0)
+        self.assertTrue(self.sampler.wait(1))
+        self.sampler.stop()
+        values = b''.join(bytes(v) for v, t in self.sampler.segments())
+        self.assertEqual(len(values), 31)
+        x_ports = [pifacerelayplus.sampler.x_port(v) for v in values]
+        self.assertEqual(x_ports[:11], [0] * 10 + [1])
+
+    def test_read_error(self):
+        def fail(address):
+            raise IOError("SPI failed")
+
+        self.pfrp.read = fail
+        self.sampler.set_trigger(0x10, 0)
+        self.sampler.start()
+        with self.assertRaises(IOError):
+            self.sampler.wait(1)
+        self.assertEqual(self.sampler.samples, 0)
+        self.sampler.stop()
+
+
+class TestWarmStart(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.journal = pifacerelayplus.journal.StateJournal(self.path)
+        self.spi = pifacerelayplus.simulator.SimulatedSPIBus()
+        pfrp = pifacerelayplus.PiFaceRelayPlus(
+            plus_board=pifacerelayplus.MOTOR_DC, spi=self.spi,
+            journal=self.journal)
+        pfrp.relays[1].turn_on()
+        pfrp.motors[0].forward()
+        pfrp.motors[3].coast()
+
+    def tearDown(self):
+        self.journal.close()
+        os.remove(self.path)
+
+    def restart(self):
+        self.spi.reset_counters()
+        journal = pifacerelayplus.journal.StateJournal(self.path)
+        pfrp = pifacerelayplus.PiFaceRelayPlus(
+            plus_board=pifacerelayplus.MOTOR_DC, spi=self.spi,
+            journal=journal, warm_start=True)
+        states = [motor._current_state for motor in pfrp.motors]
+        self.assertEqual(states, ['forward', 'coast', 'brake', 'coast'])
+        self.assertEqual(self.spi.chips[0].registers[GPIOA + 2], 0xc4)
+        journal.close()
+
+    def test_process_restart(self):
+        self.restart()
+        # IOCON check and one burst read, nothing written
+        self.assertEqual(self.spi.transactions, 2)
+
+    def test_board_reset(self):
+        self.spi.chips[0] = pifacerelayplus.simulator.MCP23S17Simulator()
+        self.restart()
+
+
+class TestConcurrentAccess(unittest.TestCase):
+
+    def setUp(self):
+        # real transaction time lets threads interleave between the read
+        # and the write of a read-modify-write
+        self.spi = pifacerelayplus.simulator.SimulatedSPIBus(
+            latency=1e-5, realtime=True)
+        # every pin an output
+        self.pfrp = pifacerelayplus.PiFaceRelayPlus(
+            plus_board=pifacerelayplus.MOTOR_DC, spi=self.spi)
+        self.switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+
+    def tearDown(self):
+        sys.setswitchinterval(self.switch_interval)
+
+    def test_no_lost_updates(self):
+        def toggle(pin):
+            for i in range(201):
+                pin.toggle()
+
+        # every pin of the board, the relays are toggled by two threads
+        pins = (self.pfrp.relays + self.pfrp.x_pins +
+                self.pfrp._pins('motors'))
+        threads = [threading.Thread(target=toggle, args=(pin,))
+                   for pin in pins]
+        threads.append(threading.Thread(
+            target=lambda: [self.pfrp.toggle_bits(0x0f) for i in range(200)]))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # every pin was toggled an odd number of times
+        self.assertEqual(self.pfrp.gpioa.value, 0xff)
+        self.assertEqual(self.pfrp.gpiob.value, 0xff)
+        # a toggle always changes the latch, a write found to change
+        # nothing was a lost update
+        self.assertEqual(self.pfrp.writes_suppressed, 0)
+
+    def test_batch_and_motor_commands(self):
+        motor = self.pfrp.motors[0]
+        in_batch = threading.Event()
+
+        def batch():
+            with self.pfrp.batch():
+                in_batch.set()
+                time.sleep(0.01)  # the other thread commands the motor
+                motor.brake()
+
+        def command():
+            in_batch.wait()
+            motor.coast()
+
+        threads = [threading.Thread(target=batch),
+                   threading.Thread(target=command)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+            self.assertFalse(thread.is_alive(), "deadlocked")
+        self.assertEqual(motor._current_state, 'coast')
+
+    def test_port_toggle(self):
+        def toggle(pin):
+            for i in range(201):
+                pin.toggle()
+
+        # the relay port and the motor pins sharing GPIOA
+        pins = self.pfrp._pins('motors')[4:] + [self.pfrp.relay_port]
+        threads = [threading.Thread(target=toggle, args=(pin,))
+                   for pin in pins]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.pfrp.gpioa.value, 0xff)
+        self.assertEqual(self.pfrp.writes_suppressed, 0)
+
+
+class TestTrace(unittest.TestCase):
+
+    def test_trace(self):
+        spi = pifacerelayplus.simulator.SimulatedSPIBus()
+        pfrp = pifacerelayplus.PiFaceRelayPlus(
+            plus_board=pifacerelayplus.MOTOR_DC, spi=spi)
+        trace_file = io.StringIO()
+        tracer = pifacerelayplus.trace.SPITracer(trace_file, records=True)
+        tracer.attach(pfrp)
+        pfrp.motors[0].forward()
+        pfrp.relay_port.value = 0x3
+        pfrp.x_port.value
+        pfrp.init_board(pfrp.gpioa_conf, pfrp.gpiob_conf)
+        tracer.detach(pfrp)
+        pfrp.relay_port.value = 0
+
+        counters = tracer.counters()
+        # motor 0 pin 1 is already high
+        self.assertEqual(counters[('motor', 'write', 'GPIOB')], 1)
+        self.assertEqual(counters[('relay', 'write', 'GPIOA')], 1)
+        self.assertEqual(counters[('input', 'read', 'GPIOB')], 1)
+        self.assertEqual(tracer.totals(),
+                         {'motor': 3, 'relay': 2, 'input': 1, 'init': 9})
+        self.assertEqual(sum(map(sum, tracer.histograms().values())), 15)
+        self.assertEqual(len(tracer.records), 15)
+        lines = trace_file.getvalue().splitlines()
+        self.assertEqual(len(lines), 15)
+        self.assertEqual(lines[4].split(',')[2:6],
+                         ['write', 'GPIOA', '03', '1'])
+
+
+class TestSimulatedBus(unittest.TestCase):
+
+    def test_detect_boards(self):
+        spi = pifacerelayplus.simulator.SimulatedSPIBus(
+            hardware_addrs=(1, 3, 6))
+        boards = pifacerelayplus.PiFaceRelayPlusBus(
+            pifacerelayplus.RELAY, spi=spi)
+        self.assertEqual([board.hardware_addr for board in boards],
+                         [1, 3, 6])
+        spi.set_input(3, GPIOB, 7, 0)
+        events = boards.read_interrupts()
+        self.assertEqual(len(events), 1)
+        self.assertIs(events[0].chip, boards[3])
+        self.assertEqual(events[0].x_port, 0b1000)
+
+    def test_read_interrupts_until_released(self):
+        spi = pifacerelayplus.simulator.SimulatedSPIBus(
+            hardware_addrs=(0, 1))
+        boards = pifacerelayplus.PiFaceRelayPlusBus(
+            pifacerelayplus.RELAY, spi=spi)
+        spi.set_input(0, GPIOB, 4, 0)
+        spi.set_input(1, GPIOB, 5, 0)
+        checks = []
+
+        def line_asserted():
+            if not checks:
+                # board 0 flags again after it has been read
+                spi.set_input(0, GPIOB, 6, 0)
+            checks.append(True)
+            return any(chip.interrupt_asserted()
+                       for chip in spi.chips.values())
+
+        events = boards.read_interrupts(line_asserted)
+        self.assertEqual([(e.chip.hardware_addr, e.pin_num) for e in events],
+                         [(0, 4), (1, 5), (0, 6)])
+        self.assertFalse(line_asserted())
+
+    def test_read_input_event(self):
+        spi = pifacerelayplus.simulator.SimulatedSPIBus()
+        pfrp = pifacerelayplus.PiFaceRelayPlus(
+            plus_board=pifacerelayplus.RELAY, spi=spi)
+        self.assertIsNone(pfrp.read_input_event())
+        spi.set_input(0, GPIOB, 5, 0)
+        spi.set_input(0, GPIOB, 1, 0)
+        spi.reset_counters()
+        event = pfrp.read_input_event()
+        self.assertEqual(spi.transactions, 1)
+        self.assertEqual((event.pin_num, event.direction), (5, 0))
+        self.assertEqual(event.changed_pins, (5,))
+        # captured when pin 5 changed, before pin 1 did
+        self.assertEqual((event.x_port, event.y_port, event.button_port),
+                         (0b0010, 0, None))
+        with self.assertRaises(AttributeError):
+            event.x_port = 0
+        # the interrupt has been cleared
+        self.assertIsNone(pfrp.read_input_event())
+
+        queue = pifacerelayplus.core._InputEventQueue([], pfrp)
+        queue.put(event)
+        queue.put(pifacerelayplus.InputEventListener.TERMINATE_SIGNAL)
+        self.assertEqual(queue.get(), event)
+        self.assertEqual(queue.get(),
+                         pifacerelayplus.InputEventListener.TERMINATE_SIGNAL)
+
+    def test_detect_boards_probe(self):
+        spi = pifacerelayplus.simulator.SimulatedSPIBus(
+            hardware_addrs=(1, 3, 6))
+        self.assertEqual(pifacerelayplus.detect_boards(spi=spi), [1, 3, 6])
+        # one IOCON write then one read per address
+        self.assertEqual(spi.transactions, 1 + 8)
+
+    def test_detect_configured_boards(self):
+        spi = pifacerelayplus.simulator.SimulatedSPIBus(
+            hardware_addrs=(0, 1, 2))
+        # left with hardware addressing on but sequential mode off
+        for hardware_addr in (1, 2):
+            spi.chips[hardware_addr].registers[IOCON] = 0x28
+        self.assertEqual(pifacerelayplus.detect_boards(spi=spi), [0, 1, 2])
+        boards = pifacerelayplus.PiFaceRelayPlusBus(
+            pifacerelayplus.RELAY, spi=spi)
+        self.assertEqual([board.hardware_addr for board in boards],
+                         [0, 1, 2])
+        self.assertEqual([chip.iocon for chip in spi.chips.values()],
+                         [pifacerelayplus.core.IOCONFIG] * 3)
+
+    def test_lazy_attributes(self):
+        spi = pifacerelayplus.simulator.SimulatedSPIBus()
+        pfrp = pifacerelayplus.PiFaceRelayPlus(
+            plus_board=pifacerelayplus.MOTOR_DC, spi=spi)
+        self.assertNotIn('relays', vars(pfrp))
+        self.assertIs(pfrp.relays, pfrp.relays)
+        self.assertEqual(len(pfrp.motors), 4)
+        self.assertFalse(hasattr(pfrp, 'y_port'))
+        pfrp.motors[2].forward()
+        self.assertEqual(pfrp.gpioa.value, 0x10)
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_run_benchmarks(self):
+        spi = pifacerelayplus.simulator.SimulatedSPIBus()
+        pfrp = pifacerelayplus.PiFaceRelayPlus(
+            plus_board=pifacerelayplus.RELAY, spi=spi)
+        results = pifacerelayplus.benchmark.run_benchmarks(pfrp, 20)
+        results = dict((r.name, r) for r in results)
+        # the latch is read back before each write
+        self.assertEqual(results['relay port write'].transactions, 40)
+        self.assertEqual(results['input read'].transactions_per_operation, 1)
+        self.assertEqual(results['interrupt to callback'].operations, 2)
+
+
+class TestDaemon(unittest.TestCase):
+
+    def setUp(self):
+        self.spi = pifacerelayplus.simulator.SimulatedSPIBus(
+            hardware_addrs=(0, 1))
+        self.boards = [
+            pifacerelayplus.PiFaceRelayPlus(
+                plus_board=plus_board, hardware_addr=hardware_addr,
+                spi=self.spi, shadow_registers=True)
+            for hardware_addr, plus_board in ((0, pifacerelayplus.RELAY),
+                                              (1, pifacerelayplus.MOTOR_DC))]
+        self.tmpdir = tempfile.TemporaryDirectory()
+        socket_path = os.path.join(self.tmpdir.name, 'pfrp.sock')
+        state_path = os.path.join(self.tmpdir.name, 'pfrp.state')
+        self.daemon = pifacerelayplus.daemon.BoardDaemon(
+            self.boards, socket_path, state_path, poll_interval=None)
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever)
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self.daemon.start(),
+                                         self.loop).result()
+        self.relay, self.motor = [
+            pifacerelayplus.daemon.BoardClient(hardware_addr, socket_path,
+                                               state_path)
+            for hardware_addr in (0, 1)]
+
+    def tearDown(self):
+        self.relay.close()
+        self.motor.close()
+
+        async def close():
+            self.daemon.close()
+            await asyncio.sleep(0.01)  # let the connections finish
+
+        asyncio.run_coroutine_threadsafe(close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.tmpdir.cleanup()
+
+    def test_relays_and_inputs(self):
+        self.relay.relays[2].turn_on()
+        self.relay.relay_port.value |= 0x80
+        self.assertEqual(self.relay.relay_port.value,
+                         self.boards[0].relay_port.value)
+        self.assertEqual(self.boards[0].relays[2].value, 1)
+        self.assertEqual(self.relay.relays[2].value, 1)
+        self.assertEqual(self.relay.relays[7].value, 1)
+
+        self.spi.set_input(0, GPIOB, 5, 0)
+        self.assertEqual(self.relay.x_pins[1].value, 0)
+        self.daemon.poll()
+        self.assertEqual(self.relay.x_pins[1].value, 1)
+        self.assertEqual(self.relay.x_port.value, 0b0010)
+        self.assertEqual(self.relay.get_inputs()[:4], (0, 1, 0, 0))
+
+    def test_batch(self):
+        self.spi.reset_counters()
+        with self.relay.batch():
+            self.relay.relays[0].turn_on()
+            self.relay.relays[1].toggle()
+            self.relay.set_relays([0, 1, 1])
+            self.assertEqual(self.relay.relays[2].value, 0)
+        self.assertEqual([relay.value for relay in self.relay.relays[:4]],
+                         [0, 1, 1, 0])
+        # one latch write, the latch is cached
+        self.assertEqual(self.spi.transactions, 1)
+
+    def test_motors(self):
+        self.boards[1].inrush_budget.max_starts = 2
+        self.motor.motors[0].forward()
+        self.motor.set_motors(['coast', None, 'reverse'])
+        self.assertEqual([motor.state for motor in self.motor.motors],
+                         ['coast', 'brake', 'reverse', 'brake'])
+        self.assertEqual([motor._current_state
+                          for motor in self.boards[1].motors],
+                         ['coast', 'brake', 'reverse', 'brake'])
+        with self.assertRaises(pifacerelayplus.MotorForwardReverseError):
+            self.motor.motors[2].forward()
+        with self.assertRaises(pifacerelayplus.MotorTooSoonError):
+            self.motor.motors[1].forward()
+
+    def test_errors(self):
+        with self.assertRaises(IndexError):
+            self.relay.send(['set', 0, 'relays', 9, 1])
+        with self.assertRaises(pifacerelayplus.daemon.DaemonError):
+            self.relay.send(['set', 5, 'relays', 0, 1])
+        with self.assertRaises(pifacerelayplus.daemon.DaemonError):
+            self.relay.send(['set', 0, 'spi', 0, 1])
+        # commands before the one that failed are applied
+        with self.assertRaises(ValueError):
+            self.relay.send(['set', 0, 'relays', 3, 1],
+                            ['relays', 0, [0] * 9])
+        self.assertEqual(self.relay.relays[3].value, 1)
+
+    def test_stale_state(self):
+        # the daemon died half way through writing the state file
+        sequence = pifacerelayplus.daemon._SEQUENCE
+        offset = pifacerelayplus.daemon._SEQUENCE_OFFSET
+        state = self.daemon.state
+        sequence.pack_into(state._mmap, offset, state._sequence + 1)
+        self.relay.state.timeout = 0.05
+        with self.assertRaises(pifacerelayplus.daemon.StaleStateError):
+            self.relay.relay_port.value
+        sequence.pack_into(state._mmap, offset, state._sequence)
+        self.assertEqual(self.relay.relay_port.value, 0)
+
+    def test_permissions(self):
+        modes = [os.stat(path).st_mode & 0o777
+                 for path in (self.daemon.socket_path,
+                              self.daemon.state_path)]
+        self.assertEqual(modes, [pifacerelayplus.daemon.SOCKET_MODE,
+                                 pifacerelayplus.daemon.STATE_MODE])
+
+
+class TestWebControl(unittest.TestCase):
+
+    def setUp(self):
+        self.spi = pifacerelayplus.simulator.SimulatedSPIBus(
+            hardware_addrs=(0, 1))
+        self.boards = pifacerelayplus.PiFaceRelayPlusBus(
+            pifacerelayplus.RELAY, spi=self.spi)
+        self.server = pifacerelayplus.webcontrol.WebControlServer(
+            self.boards, host='127.0.0.1', port=0, poll_interval=None)
+
+    def get(self, paths):
+        async def get_all():
+            await self.server.start()
+            port = self.server._server.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            replies = []
+            # one connection for every request
+            for path in paths:
+                writer.write("GET {} HTTP/1.1\r\n\r\n".format(path).encode())
+                head = (await reader.readuntil(b'\r\n\r\n')).decode()
+                length = int(head.split("Content-Length: ")[1].split()[0])
+                body = await reader.readexactly(length)
+                replies.append((head.split()[1], body))
+            writer.close()
+            self.server.close()
+            await self.server.wait_closed()
+            return replies
+        return asyncio.run(get_all())
+
+    def test_status_from_cache(self):
+        self.spi.reset_counters()
+        replies = self.get(["/"] * 3)
+        self.assertEqual(replies[-1][0], '200')
+        self.assertEqual(json.loads(replies[-1][1].decode()),
+                         [{"x_port": 0, "y_port": 0, "relay_port": 0}] * 2)
+        # only the initial read of each board
+        self.assertEqual(self.spi.transactions, 2)
+
+    def test_relay_port(self):
+        replies = self.get(["/?b0_relay_port=0xaa",
+                            "/?b0_relay_port__and=0x0f&b1_relay_port__or=3",
+                            "/?b0_relay_port=zz"])
+        statuses = json.loads(replies[1][1].decode())
+        self.assertEqual([s["relay_port"] for s in statuses], [0x0a, 3])
+        self.assertEqual(self.boards[1].relay_port.value, 3)
+        self.assertEqual(replies[2][0], '400')
+
+    def test_relay_port_out_of_range(self):
+        replies = self.get(["/?b0_relay_port=0x1ff"])
+        statuses = json.loads(replies[0][1].decode())
+        self.assertEqual(statuses[0]["relay_port"], 0xff)
+        self.assertEqual(self.boards[0].relay_port.value, 0xff)
+        # the cache holds what the board holds
+        self.assertEqual(json.loads(self.get(["/"])[0][1].decode())[0],
+                         {"x_port": 0, "y_port": 0, "relay_port": 0xff})
+
+    def test_event_stream(self):
+        self.server.use_interrupts = True
+
+        async def stream():
+            await self.server.start()
+            port = self.server._server.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(b"GET /events HTTP/1.1\r\n\r\n")
+            await reader.readuntil(b'\r\n\r\n')
+            events = [await reader.readuntil(b'\n\n')]
+            self.spi.set_input(1, GPIOB, 5, 0)
+            events.append(await reader.readuntil(b'\n\n'))
+            # the boards share one interrupt line
+            self.assertEqual(len(self.server._listeners), 1)
+            self.assertIsInstance(self.server._listeners[0],
+                                  pifacerelayplus.aio.AsyncBusEventListener)
+            # closing the server ends the stream
+            self.server.close()
+            await asyncio.wait_for(self.server.wait_closed(), 1)
+            self.assertEqual(await reader.read(), b'')
+            writer.close()
+            return [json.loads(e[len(b'data: '):].decode()) for e in events]
+
+        events = asyncio.run(stream())
+        self.assertEqual(events[0]["1"],
+                         {"x_port": 0, "y_port": 0, "relay_port": 0})
+        self.assertEqual(events[1], {"1": {"x_port": 2}})
+
+    def test_relay_port_masks_the_latch(self):
+        # changed behind the server's back, the cache still says 0
+        self.boards[0].relay_port.value = 0xf0
+        replies = self.get(["/?b0_relay_port__or=0x01",
+                            "/?b0_relay_port__and=0x3f"])
+        statuses = [json.loads(body.decode())[0]["relay_port"]
+                    for code, body in replies]
+        self.assertEqual(statuses, [0xf1, 0x31])
+        self.assertEqual(self.boards[0].relay_port.value, 0x31)
+
+    def test_errors(self):
+        async def request(data):
+            await self.server.start()
+            port = self.server._server.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(data)
+            reply = await reader.read()  # the server closes the connection
+            writer.close()
+            self.server.close()
+            await self.server.wait_closed()
+            return reply
+
+        # the body isn't read, so the connection is closed after the reply
+        reply = asyncio.run(request(b"POST / HTTP/1.1\r\n"
+                                    b"Content-Length: 4\r\n\r\nGET "))
+        self.assertTrue(reply.startswith(b"HTTP/1.1 405 "))
+        self.assertIn(b"Connection: close", reply)
+
+        def broken(value, mask):
+            raise IOError("SPI bus gone")
+
+        self.boards[0].write_masked = broken
+        reply = asyncio.run(request(b"GET /?b0_relay_port=1 HTTP/1.1\r\n"
+                                    b"Connection: close\r\n\r\n"))
+        self.assertTrue(reply.startswith(b"HTTP/1.1 500 "))
+        self.assertTrue(reply.endswith(b"SPI bus gone"))
+
+    def test_slow_subscriber(self):
+        subscriber = pifacerelayplus.webcontrol.Subscriber()
+        self.server.subscribers.add(subscriber)
+        self.server.statuses = [{"x_port": 0}, {"x_port": 0}]
+        for x_port in range(1, 100):
+            self.server.set_status(0, {"x_port": x_port})
+        self.server.set_status(1, {"x_port": 4})
+        self.assertEqual(subscriber.pending, {0: {"x_port": 99},
+                                              1: {"x_port": 4}})
+
+
+if __name__ == "__main__":
+    unittest.main()